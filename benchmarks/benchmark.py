@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# coding=utf-8
+"""
+Time instruction parsing, document parsing, matching and serialization on a generated corpus
+
+Results are written as JSON so runs of different versions can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'xmlsrr'))
+
+from lxml import html
+from lxml import etree
+import instructionSet
+import xmlsrr
+import xpathSelector
+
+TAGS = ['div', 'p', 'span', 'em', 'strong', 'a', 'img', 'ul', 'li', 'section', 'table', 'td']
+CLASSES = ['red', 'blue', 'green', 'thumbnail', 'title', 'nav', 'item', 'active', 'hidden', 'wide']
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit']
+
+
+def argumentParser():
+    parser = argparse.ArgumentParser(description='Benchmark xmlsrr on a generated corpus', prog='benchmark')
+    parser.add_argument('-f', '--files', type=int, default=200)
+    parser.add_argument('-d', '--depth', type=int, default=6)
+    parser.add_argument('-b', '--breadth', type=int, default=4)
+    parser.add_argument('-n', '--instructions', type=int, default=20)
+    parser.add_argument('-c', '--complexity', type=int, default=2, help='maximum number of links per selector')
+    parser.add_argument('-l', '--chain-links', type=int, default=5, help='number of links of the chained selectors')
+    parser.add_argument('-p', '--replaced', type=int, default=20000, help='elements whose class is replaced at once')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='JSON report file, stdout by default')
+    return parser.parse_args()
+
+
+def generateElement(generator, depth, breadth):
+    tag = generator.choice(TAGS)
+    attributes = ''
+    if generator.random() < 0.5:
+        attributes += ' class="{0}"'.format(' '.join(generator.sample(CLASSES, generator.randint(1, 3))))
+    if generator.random() < 0.1:
+        attributes += ' id="id{0}"'.format(generator.randint(0, 1000))
+    if tag == 'img':
+        return '<img src="image{0}.png"{1}>'.format(generator.randint(0, 100), attributes)
+    text = ' '.join(generator.choice(WORDS) for number in range(generator.randint(1, 8)))
+    children = ''
+    if depth > 1:
+        children = ''.join(generateElement(generator, depth - 1, breadth)
+                           for number in range(generator.randint(1, breadth)))
+    return '<{0}{1}>{2}{3}</{0}>'.format(tag, attributes, text, children)
+
+
+def generateDocument(generator, depth, breadth):
+    body = ''.join(generateElement(generator, depth, breadth) for number in range(breadth))
+    return '<html><head><title>Benchmark</title></head><body>{0}</body></html>'.format(body)
+
+
+def generateCorpus(folder, files, depth, breadth, seed):
+    generator = random.Random(seed)
+    paths = []
+    for number in range(files):
+        path = os.path.join(folder, 'page{0}.htm'.format(number))
+        with open(path, 'w') as f:
+            f.write(generateDocument(generator, depth, breadth))
+        paths.append(path)
+    return paths
+
+
+def generateSelector(generator):
+    selector = ''
+    if generator.random() < 0.7:
+        selector += generator.choice(TAGS)
+    if generator.random() < 0.5 or not selector:
+        selector += '.' + generator.choice(CLASSES)
+    if generator.random() < 0.1:
+        selector += '[src]'
+    return selector
+
+
+def generateInstructions(count, complexity, seed, minimum=1):
+    generator = random.Random(seed)
+    lines = []
+    for number in range(count):
+        selector = ' '.join(generateSelector(generator) for link in range(generator.randint(minimum, complexity)))
+        mode = generator.random()
+        if mode < 0.4:
+            lines.append(selector)
+        elif mode < 0.6:
+            lines.append('/' + selector)
+        else:
+            lines.append('{0} -> {1}.{2}'.format(selector, generator.choice(TAGS), generator.choice(CLASSES)))
+    return lines
+
+
+def bestTime(function, repeat, setup=None):
+    """
+    Run function repeat times and return the fastest run, setup runs untimed before each one and its result is passed
+    to function
+    """
+    times = []
+    for number in range(repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def throughput(seconds, files=None, size=None, nodes=None, instructions=None):
+    result = {'seconds': seconds}
+    if files is not None:
+        result['files/s'] = files / seconds
+    if size is not None:
+        result['MB/s'] = size / seconds / 1e6
+    if nodes is not None:
+        result['nodes/s'] = nodes / seconds
+    if instructions is not None:
+        result['instructions/s'] = instructions / seconds
+    return result
+
+
+def clearInstructionCaches():
+    """
+    Forget the selectors and replacements parsed so far, so each run parses every instruction again
+    """
+    instructionSet.selectorCache.clear()
+    instructionSet.internedSelectors.clear()
+    instructionSet.replacementCache.clear()
+
+
+def parseCorpus(paths):
+    return [html.parse(path).getroot() for path in paths]
+
+
+def parseCorpusBytes(paths):
+    elements = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            elements.append(etree.fromstring(f.read(), xmlsrr.getParser('html')))
+    return elements
+
+
+def parseCorpusMapped(paths):
+    return [xmlsrr.parseMapped(path, 'html') for path in paths]
+
+
+def processCorpus(elements, instructions, backend):
+    for element in elements:
+        xmlsrr.processDocument(element, instructions, backend)
+
+
+def serializeCorpus(elements):
+    for element in elements:
+        etree.tostring(element)
+
+
+def runBenchmarks(arguments, folder):
+    paths = generateCorpus(folder, arguments.files, arguments.depth, arguments.breadth, arguments.seed)
+    lines = generateInstructions(arguments.instructions, arguments.complexity, arguments.seed)
+    size = sum(os.path.getsize(path) for path in paths)
+    nodes = sum(sum(1 for node in element.iter()) for element in parseCorpus(paths))
+    instructions = [instructionSet.InstructionSet(line) for line in lines]
+    repeat = arguments.repeat
+    results = {
+        'determinePattern': throughput(bestTime(lambda unused: [instructionSet.InstructionSet(line) for line in lines],
+                                                repeat, clearInstructionCaches), instructions=len(lines)),
+        'html.parse': throughput(bestTime(lambda unused: parseCorpus(paths), repeat), len(paths), size, nodes),
+        'etree.fromstring': throughput(bestTime(lambda unused: parseCorpusBytes(paths), repeat), len(paths), size,
+                                       nodes),
+        'mmap.feed': throughput(bestTime(lambda unused: parseCorpusMapped(paths), repeat), len(paths), size, nodes),
+        'processInstructions': throughput(bestTime(lambda elements: processCorpus(elements, instructions, 'python'),
+                                                   repeat, lambda: parseCorpus(paths)), len(paths), size, nodes),
+    }
+    xpathSelector.compileInstructions(instructions)
+    results['processInstructions.xpath'] = throughput(
+        bestTime(lambda elements: processCorpus(elements, instructions, 'xpath'), repeat, lambda: parseCorpus(paths)),
+        len(paths), size, nodes)
+    # Long descendant chains, where each link narrows down the matches of the one before
+    chains = [instructionSet.InstructionSet(line) for line in generateInstructions(
+        arguments.instructions, arguments.chain_links, arguments.seed, arguments.chain_links)]
+    xpathSelector.compileInstructions(chains)
+    for backend, name in ('python', 'processInstructions.chains'), ('xpath', 'processInstructions.chains.xpath'):
+        results[name] = throughput(bestTime(lambda elements: processCorpus(elements, chains, backend), repeat,
+                                            lambda: parseCorpus(paths)), len(paths), size, nodes)
+    # Replacing classes keeps the class index up to date, one document with many matches shows how that scales
+    replaced = [instructionSet.InstructionSet(line) for line in ['.red -> .blue', '.blue -> .green']]
+    results['replaceIndexed'] = throughput(bestTime(
+        lambda element: xmlsrr.processDocument(element, replaced), repeat,
+        lambda: etree.fromstring('<div>' + '<p class="red">text</p>' * arguments.replaced + '</div>')),
+        nodes=arguments.replaced + 1)
+    results['etree.tostring'] = throughput(bestTime(serializeCorpus, repeat, lambda: parseCorpus(paths)), len(paths),
+                                           size, nodes)
+    return {'parameters': vars(arguments), 'corpus': {'files': len(paths), 'bytes': size, 'nodes': nodes},
+            'python': platform.python_version(), 'lxml': '.'.join(str(part) for part in etree.LXML_VERSION),
+            'results': results}
+
+
+if __name__ == '__main__':
+    arguments = argumentParser()
+    folder = tempfile.mkdtemp(prefix='xmlsrr-benchmark-')
+    try:
+        report = runBenchmarks(arguments, folder)
+    finally:
+        shutil.rmtree(folder)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# coding=utf-8
+"""
+Time how long xmlsrr -V takes to start and verify a small instruction file, and fail when it is over budget
+
+xmlsrr is run with python -m, like an installed command, so its modules are loaded from compiled bytecode. The time of a
+bare interpreter is subtracted, so the budget only covers what xmlsrr itself imports and does. The run also fails when
+verifying imports lxml, which only processing documents should need.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def argumentParser():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of xmlsrr -V', prog='startup')
+    parser.add_argument('-r', '--repeat', type=int, default=20)
+    parser.add_argument('-b', '--budget', type=float, default=60.0,
+                        help='milliseconds xmlsrr -V may take over a bare interpreter')
+    parser.add_argument('-o', '--output', help='JSON report file, stdout by default')
+    return parser.parse_args()
+
+
+def bestTime(command, repeat):
+    """
+    Run command repeat times and return the fastest run, the first run also writes the bytecode of xmlsrr if needed
+    """
+    environment = dict(os.environ)
+    environment.pop('PYTHONDONTWRITEBYTECODE', None)
+    times = []
+    for number in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=root,
+                       env=environment)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def importedModules(command):
+    """
+    Get the name of every module imported by command, from the report of python -X importtime
+    """
+    process = subprocess.run(command[:1] + ['-X', 'importtime'] + command[1:], check=True, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True, cwd=root)
+    return [line.split('|')[-1].strip() for line in process.stderr.splitlines() if line.startswith('import time:')]
+
+
+def runBenchmark(arguments, folder):
+    instructionFile = os.path.join(folder, 'instructions.txt')
+    with open(instructionFile, 'w') as f:
+        f.write('h1#title\nimg.thumbnail[src]\n/p.translate span[lang=en-us]\n.old -> div.new\n')
+    verify = [sys.executable, '-m', 'xmlsrr', '-s', '-V', '-i', instructionFile, folder]
+    python = bestTime([sys.executable, '-c', 'pass'], arguments.repeat)
+    seconds = bestTime(verify, arguments.repeat)
+    lxmlModules = [name for name in importedModules(verify) if name.split('.')[0] == 'lxml']
+    overhead = (seconds - python) * 1000
+    return {'python': python, 'verify': seconds, 'overhead (ms)': overhead, 'budget (ms)': arguments.budget,
+            'lxml imported': bool(lxmlModules), 'passed': overhead <= arguments.budget and not lxmlModules}
+
+
+if __name__ == '__main__':
+    arguments = argumentParser()
+    folder = tempfile.mkdtemp(prefix='xmlsrr-startup-')
+    try:
+        report = runBenchmark(arguments, folder)
+    finally:
+        shutil.rmtree(folder)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    sys.exit(0 if report['passed'] else 1)
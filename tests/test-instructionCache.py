@@ -0,0 +1,82 @@
+# coding=utf-8
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import instructionCache
+
+
+class TestParseLines(unittest.TestCase):
+    def test_duplicate_lines(self):
+        instructions = instructionCache.parseLines(['p -> div\n', 'div p', 'p -> div'])
+        self.assertIs(instructions[0], instructions[2])
+        self.assertEqual(['p -> div', 'div p', 'p -> div'], [instruction.source for instruction in instructions])
+
+    def test_shared_selectors(self):
+        instructions = instructionCache.parseLines(['p', '/p', 'div p', 'span div p'])
+        self.assertIs(instructions[0].selector, instructions[1].selector)
+        self.assertIs(instructions[0].selector, instructions[2].selector.subMatch)
+        self.assertIs(instructions[2].selector, instructions[3].selector.subMatch)
+
+
+class TestLoadInstructions(unittest.TestCase):
+    lines = ['p.red -> div', '/img[src]', 'body .nav a']
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def describe(self, instructions):
+        return [instruction.describe() for instruction in instructions]
+
+    def test_no_cache(self):
+        instructions = instructionCache.loadInstructions(self.lines)
+        self.assertEqual(3, len(instructions))
+        self.assertEqual([], os.listdir(self.folder))
+
+    def test_cache_reused(self):
+        parsed = instructionCache.loadInstructions(self.lines, self.folder)
+        self.assertEqual([os.path.basename(instructionCache.cachePath(self.folder, self.lines))], os.listdir(self.folder))
+        loaded = instructionCache.loadInstructions(self.lines, self.folder)
+        self.assertEqual(self.describe(parsed), self.describe(loaded))
+        self.assertEqual([instruction.source for instruction in parsed], [instruction.source for instruction in loaded])
+
+    def test_changed_lines(self):
+        instructionCache.loadInstructions(self.lines, self.folder)
+        instructions = instructionCache.loadInstructions(self.lines + ['/em'], self.folder)
+        self.assertEqual('remove', instructions[3].mode)
+        self.assertEqual(2, len(os.listdir(self.folder)))
+
+    def test_broken_cache(self):
+        with open(instructionCache.cachePath(self.folder, self.lines), 'wb') as f:
+            f.write(b'not json')
+        instructions = instructionCache.loadInstructions(self.lines, self.folder)
+        self.assertEqual(self.describe(instructionCache.parseLines(self.lines)), self.describe(instructions))
+
+    def test_plain_data(self):
+        parsed = instructionCache.loadInstructions(self.lines + ['p.red -> div'], self.folder)
+        with open(instructionCache.cachePath(self.folder, self.lines + ['p.red -> div']), 'rb') as f:
+            data = json.loads(f.read().decode('utf-8'))
+        self.assertEqual([0, 1, 2, 0], data['lines'])
+        loaded = instructionCache.loadInstructions(self.lines + ['p.red -> div'], self.folder)
+        self.assertIs(loaded[0], loaded[3])
+        self.assertIs(parsed[2].selector, loaded[2].selector)
+        self.assertEqual('div', loaded[0].replacement.element)
+        self.assertEqual(frozenset(['red']), loaded[0].selector.classes)
+        self.assertEqual([('src', '')], list(loaded[1].selector.attributes))
+
+    def test_mismatched_cache(self):
+        path = instructionCache.cachePath(self.folder, self.lines)
+        with open(path, 'w') as f:
+            json.dump(instructionCache.dumpData(instructionCache.parseLines(['/p'])), f)
+        instructions = instructionCache.loadInstructions(self.lines, self.folder)
+        self.assertEqual(self.lines, [instruction.source for instruction in instructions])
+        with open(path, 'rb') as f:
+            self.assertEqual(3, len(json.loads(f.read().decode('utf-8'))['lines']))
+
+
+if __name__ == "__main__":
+    unittest.main()
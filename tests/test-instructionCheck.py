@@ -0,0 +1,58 @@
+# coding=utf-8
+import unittest
+import instructionCheck
+
+
+def findings(lines):
+    return [(finding['line'], finding['column'], finding['severity'], finding['message'])
+            for finding in instructionCheck.checkInstructions(lines)[1]]
+
+
+class TestSyntax(unittest.TestCase):
+    def test_valid(self):
+        parsed, found = instructionCheck.checkInstructions(['h1#title\n', '\n', 'p.translate span[lang=en-us]\n'])
+        self.assertEqual([], found)
+        self.assertEqual([1, 3], sorted(parsed))
+
+    def test_every_error_reported(self):
+        found = findings(['/p -> div\n', 'p->div->span\n', 'p -> div span\n', 'div[=x]\n', 'img[src\n', '-> div\n'])
+        self.assertEqual([(1, 4, 'error'), (2, 7, 'error'), (3, 9, 'error'), (4, 5, 'error'), (5, 4, 'error'),
+                          (6, 1, 'error')], [finding[:3] for finding in found])
+
+    def test_error_in_later_part(self):
+        self.assertEqual([(1, 10, 'error', "Attribute selector isn't closed with ]")], findings(['div.a img[src']))
+
+    def test_attributes_overwritten(self):
+        self.assertEqual([(1, 8, 'warning')], [finding[:3] for finding in findings(['a[href][title]'])])
+
+    def test_empty_parts(self):
+        self.assertEqual([(1, 2, 'warning', 'Empty class is ignored'), (1, 5, 'warning', 'Empty id is ignored')],
+                         findings(['p. a#']))
+
+    def test_replacement_ids(self):
+        self.assertEqual([(1, 13, 'warning')], [finding[:3] for finding in findings(['#x -> span#a#b'])])
+
+
+class TestRules(unittest.TestCase):
+    def test_duplicates(self):
+        self.assertEqual([(2, 1, 'warning', 'Duplicate of line 1'), (4, 1, 'warning', 'Duplicate of line 3')],
+                         findings(['.a.b', '.b.a', 'p -> div', 'p->div', 'p']))
+
+    def test_removed(self):
+        found = findings(['/div.ad', 'div.ad.wide', 'div.ad span -> em', 'div', '/img', 'p -> span', 'img'])
+        self.assertEqual([2, 3], [finding[0] for finding in found])
+
+    def test_removed_by_chain_not_decided(self):
+        self.assertEqual([], findings(['/div p', 'div p span']))
+
+
+class TestCost(unittest.TestCase):
+    def test_cost(self):
+        parsed = instructionCheck.checkInstructions(['h1', '#title', '.a', '[src]', 'div [src]', 'm:img'])[0]
+        costs = [instructionCheck.instructionCost(parsed[number]) for number in sorted(parsed)]
+        self.assertEqual([(1, 'element lookup'), (1, 'id lookup'), (1, 'class lookup'), (10, 'every element'),
+                          (20, 'every element'), (10, 'every element')], costs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import pickle
 from xmlsrr import instructionSet
 
 
@@ -258,5 +259,38 @@ class TestDetermineReplacement(unittest.TestCase):
         self.assertRaises(ValueError, instructionSet.determineReplacement, instruction)
 
 
+class TestSelector(unittest.TestCase):
+    def test_compiled_fields(self):
+        selector = instructionSet.InstructionSet('div.b.a#x[src=a.png] p').selector
+        self.assertEqual(frozenset(['div']), selector.elements)
+        self.assertEqual(frozenset(['a', 'b']), selector.classes)
+        self.assertEqual(frozenset(['x']), selector.ids)
+        self.assertEqual((('src', 'a.png'),), selector.attributes)
+        self.assertEqual(frozenset(['p']), selector.subMatch.elements)
+        self.assertEqual(None, selector.subMatch.subMatch)
+
+    def test_equal_selectors_shared(self):
+        first = instructionSet.InstructionSet('span .a.b').selector
+        second = instructionSet.InstructionSet('/span .b.a').selector
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertIs(first, second)
+
+    def test_immutable(self):
+        selector = instructionSet.InstructionSet('p').selector
+        self.assertRaises(AttributeError, setattr, selector, 'elements', frozenset(['div']))
+
+    def test_pickle(self):
+        selector = instructionSet.InstructionSet('div p[lang=en]').selector
+        self.assertEqual(selector, pickle.loads(pickle.dumps(selector)))
+
+    def test_replacement_order(self):
+        replacement = instructionSet.InstructionSet('p -> div.z.a#y[data-x=1]').replacement
+        self.assertEqual('div', replacement.element)
+        self.assertEqual(('z', 'a'), replacement.classes)
+        self.assertEqual('y', replacement.id)
+        self.assertEqual((('data-x', '1'),), replacement.attributes)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
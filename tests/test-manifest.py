@@ -0,0 +1,96 @@
+# coding=utf-8
+import unittest
+import os
+import shutil
+import tempfile
+import instructionSet
+import manifest
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'manifest')
+        self.instructions = [instructionSet.InstructionSet('p -> div')]
+        self.state = {'size': 10, 'mtime': 1000, 'hash': 'abc'}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_unknown_file(self):
+        fileManifest = manifest.Manifest(self.path, self.instructions)
+        self.assertEqual(None, fileManifest.lookup('index.htm'))
+        fileManifest.close()
+
+    def test_update_and_reload(self):
+        fileManifest = manifest.Manifest(self.path, self.instructions)
+        fileManifest.update('index.htm', self.state)
+        fileManifest.close()
+        fileManifest = manifest.Manifest(self.path, [instructionSet.InstructionSet('p -> div')])
+        self.assertEqual(self.state, fileManifest.lookup('index.htm'))
+        fileManifest.close()
+
+    def test_changed_instructions(self):
+        fileManifest = manifest.Manifest(self.path, self.instructions)
+        fileManifest.update('index.htm', self.state)
+        fileManifest.close()
+        fileManifest = manifest.Manifest(self.path, [instructionSet.InstructionSet('p -> span')])
+        self.assertEqual(None, fileManifest.lookup('index.htm'))
+        fileManifest.close()
+
+    def test_remove_state(self):
+        fileManifest = manifest.Manifest(self.path, self.instructions)
+        fileManifest.update('index.htm', self.state)
+        fileManifest.update('index.htm', None)
+        self.assertEqual(None, fileManifest.lookup('index.htm'))
+        fileManifest.close()
+
+
+class TestIsUnchanged(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'index.htm')
+        with open(self.path, 'wb') as f:
+            f.write(b'<html></html>')
+        self.state = manifest.fileState(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_unchanged(self):
+        self.assertTrue(manifest.isUnchanged(self.path, self.state))
+
+    def test_touched(self):
+        os.utime(self.path, ns=(0, self.state['mtime'] + 10 ** 9))
+        self.assertTrue(manifest.isUnchanged(self.path, self.state))
+
+    def test_same_size_changed(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'<xhtm></xhtm>'[:len(b'<html></html>')])
+        os.utime(self.path, ns=(0, self.state['mtime'] + 10 ** 9))
+        self.assertFalse(manifest.isUnchanged(self.path, self.state))
+
+    def test_size_changed(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'<html><body></body></html>')
+        self.assertFalse(manifest.isUnchanged(self.path, self.state))
+
+    def test_state_from_data(self):
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.state, manifest.fileState(self.path, f.read()))
+
+
+class TestInstructionHash(unittest.TestCase):
+    def test_same_instructions(self):
+        first = [instructionSet.InstructionSet(line) for line in ['/em', 'div p.red -> span']]
+        second = [instructionSet.InstructionSet(line) for line in ['/em ', ' div p.red -> span']]
+        self.assertEqual(manifest.instructionHash(first), manifest.instructionHash(second))
+
+    def test_instruction_order(self):
+        first = [instructionSet.InstructionSet(line) for line in ['/em', 'p -> span']]
+        second = [instructionSet.InstructionSet(line) for line in ['p -> span', '/em']]
+        self.assertNotEqual(manifest.instructionHash(first), manifest.instructionHash(second))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+# coding=utf-8
+import unittest
+import os
+import shutil
+import tempfile
+import outputTree
+
+
+class TestCopyAsset(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.sourceFolder = os.path.join(self.folder, 'source')
+        self.destinationFolder = os.path.join(self.folder, 'destination')
+        os.makedirs(os.path.join(self.sourceFolder, 'images'))
+        with open(os.path.join(self.sourceFolder, 'images', 'logo.png'), 'wb') as f:
+            f.write(b'image')
+        self.name = os.path.join('images', 'logo.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def assertCopied(self):
+        with open(os.path.join(self.destinationFolder, self.name), 'rb') as f:
+            self.assertEqual(b'image', f.read())
+
+    def test_link(self):
+        outputTree.copyAsset(self.sourceFolder, self.destinationFolder, self.name, 'link')
+        self.assertCopied()
+        self.assertTrue(os.path.samefile(os.path.join(self.sourceFolder, self.name),
+                                         os.path.join(self.destinationFolder, self.name)))
+
+    def test_reflink(self):
+        outputTree.copyAsset(self.sourceFolder, self.destinationFolder, self.name, 'reflink')
+        self.assertCopied()
+        self.assertFalse(os.path.samefile(os.path.join(self.sourceFolder, self.name),
+                                          os.path.join(self.destinationFolder, self.name)))
+
+    def test_copy(self):
+        outputTree.copyAsset(self.sourceFolder, self.destinationFolder, self.name, 'copy')
+        self.assertCopied()
+        self.assertFalse(os.path.samefile(os.path.join(self.sourceFolder, self.name),
+                                          os.path.join(self.destinationFolder, self.name)))
+
+    def test_symlink(self):
+        os.symlink('logo.png', os.path.join(self.sourceFolder, 'images', 'link.png'))
+        outputTree.copyAsset(self.sourceFolder, self.destinationFolder, os.path.join('images', 'link.png'))
+        self.assertEqual('logo.png', os.readlink(os.path.join(self.destinationFolder, 'images', 'link.png')))
+
+
+class TestWriteFile(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'index.htm')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_new_file(self):
+        outputTree.writeFile(self.path, b'<html></html>')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b'<html></html>', f.read())
+        self.assertEqual(0o666 & ~outputTree.umask, os.stat(self.path).st_mode & 0o777)
+        self.assertEqual(['index.htm'], os.listdir(self.folder))
+
+    def test_replace_keeps_mode(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'old')
+        os.chmod(self.path, 0o640)
+        outputTree.writeFile(self.path, b'new', 'each')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b'new', f.read())
+        self.assertEqual(0o640, os.stat(self.path).st_mode & 0o777)
+
+    def test_symlink_followed(self):
+        target = os.path.join(self.folder, 'real.htm')
+        with open(target, 'wb') as f:
+            f.write(b'old')
+        os.symlink('real.htm', self.path)
+        outputTree.writeFile(self.path, b'new')
+        self.assertEqual('real.htm', os.readlink(self.path))
+        with open(target, 'rb') as f:
+            self.assertEqual(b'new', f.read())
+
+    def test_hardlink_broken(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'old')
+        otherPath = os.path.join(self.folder, 'other.htm')
+        os.link(self.path, otherPath)
+        outputTree.writeFile(self.path, b'new')
+        self.assertFalse(os.path.samefile(self.path, otherPath))
+        with open(otherPath, 'rb') as f:
+            self.assertEqual(b'old', f.read())
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b'new', f.read())
+
+    def test_hardlink_kept(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'old')
+        otherPath = os.path.join(self.folder, 'other.htm')
+        os.link(self.path, otherPath)
+        outputTree.writeFile(self.path, b'new', 'each', 'keep')
+        self.assertTrue(os.path.samefile(self.path, otherPath))
+        with open(otherPath, 'rb') as f:
+            self.assertEqual(b'new', f.read())
+        self.assertEqual(['index.htm', 'other.htm'], sorted(os.listdir(self.folder)))
+
+    def test_output_hardlink_broken(self):
+        outputFolder = os.path.join(self.folder, 'out')
+        os.makedirs(os.path.join(outputFolder, 'sub'))
+        open(os.path.join(outputFolder, outputTree.markerName), 'w').close()
+        with open(self.path, 'wb') as f:
+            f.write(b'old')
+        outputPath = os.path.join(outputFolder, 'sub', 'index.htm')
+        os.link(self.path, outputPath)
+        outputTree.writeFile(outputPath, b'new', 'none', 'keep')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b'old', f.read())
+        with open(outputPath, 'rb') as f:
+            self.assertEqual(b'new', f.read())
+
+    @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0, "only root can give files to other users")
+    def test_replace_keeps_owner(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'old')
+        os.chown(self.path, 1234, 5678)
+        outputTree.writeFile(self.path, b'new')
+        status = os.stat(self.path)
+        self.assertEqual((1234, 5678), (status.st_uid, status.st_gid))
+
+    def test_failed_write(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'old')
+        self.assertRaises(TypeError, outputTree.writeFile, self.path, 'not bytes')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b'old', f.read())
+        self.assertEqual(['index.htm'], os.listdir(self.folder))
+
+    def test_batch(self):
+        outputTree.writeFile(self.path, b'new', 'batch')
+        self.assertEqual([os.path.realpath(self.path)], outputTree.batchState['unsynced'])
+        outputTree.syncPending()
+        self.assertEqual([], outputTree.batchState['unsynced'])
+        outputTree.writeFile(self.path, b'newer', 'batch')
+        os.remove(self.path)
+        outputTree.syncPending(self.folder)
+        self.assertEqual([], outputTree.batchState['unsynced'])
+
+
+class TestStaging(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.outputFolder = os.path.join(self.folder, 'output')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def writeStaging(self):
+        stagingFolder = outputTree.createStaging(self.outputFolder, self.folder)
+        self.assertEqual(self.folder, os.path.dirname(stagingFolder))
+        with open(os.path.join(stagingFolder, 'index.htm'), 'w') as f:
+            f.write('new')
+        return stagingFolder
+
+    def test_commit_new_output(self):
+        outputTree.commitStaging(self.writeStaging(), self.outputFolder)
+        self.assertEqual(['output'], os.listdir(self.folder))
+        self.assertEqual(['index.htm', outputTree.markerName], sorted(os.listdir(self.outputFolder), reverse=True))
+
+    def test_commit_existing_output(self):
+        outputTree.commitStaging(self.writeStaging(), self.outputFolder)
+        with open(os.path.join(self.outputFolder, 'old.htm'), 'w') as f:
+            f.write('old')
+        outputTree.commitStaging(self.writeStaging(), self.outputFolder)
+        self.assertEqual(['output'], os.listdir(self.folder))
+        self.assertEqual(['index.htm', outputTree.markerName], sorted(os.listdir(self.outputFolder), reverse=True))
+
+    def test_foreign_output_kept(self):
+        os.makedirs(self.outputFolder)
+        with open(os.path.join(self.outputFolder, 'notes.txt'), 'w') as f:
+            f.write('notes')
+        self.assertFalse(outputTree.isReplaceable(self.outputFolder))
+        stagingFolder = self.writeStaging()
+        self.assertRaises(ValueError, outputTree.commitStaging, stagingFolder, self.outputFolder)
+        self.assertEqual(['notes.txt'], os.listdir(self.outputFolder))
+        outputTree.commitStaging(stagingFolder, self.outputFolder, force=True)
+        self.assertEqual(['index.htm', outputTree.markerName], sorted(os.listdir(self.outputFolder), reverse=True))
+
+    def test_empty_output_replaced(self):
+        os.makedirs(self.outputFolder)
+        self.assertTrue(outputTree.isReplaceable(self.outputFolder))
+        outputTree.commitStaging(self.writeStaging(), self.outputFolder)
+        self.assertEqual(['output'], os.listdir(self.folder))
+
+    def test_discard(self):
+        outputTree.discardStaging(self.writeStaging())
+        self.assertEqual([], os.listdir(self.folder))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+# coding=utf-8
+import unittest
+import cProfile
+import csv
+import json
+from io import StringIO
+import instructionSet
+import profiling
+
+
+class TestTimingReport(unittest.TestCase):
+    def setUp(self):
+        self.instructions = [instructionSet.InstructionSet(line) for line in ['/em', 'p -> div']]
+        self.report = profiling.TimingReport(self.instructions)
+        for name, seconds in [('a.htm', 1.0), ('b.htm', 3.0)]:
+            timings = profiling.newTimings(self.instructions)
+            timings.update(total=seconds, parse=seconds / 2, match=seconds / 4)
+            timings['instructions'] = [seconds / 8, seconds / 8]
+            self.report.add(name, timings, [1, 2])
+
+    def test_totals(self):
+        self.assertEqual(4.0, self.report.phases['total'])
+        self.assertEqual(2.0, self.report.phases['parse'])
+        self.assertEqual([{'instruction': '/em', 'seconds': 0.5, 'matches': 2},
+                          {'instruction': 'p -> div', 'seconds': 0.5, 'matches': 4}], self.report.instructions())
+
+    def test_summary(self):
+        lines = self.report.summary(limit=1)
+        self.assertIn('b.htm', ''.join(lines))
+        self.assertNotIn('a.htm', ''.join(lines))
+
+    def test_json(self):
+        stream = StringIO()
+        self.report.write(stream)
+        report = json.loads(stream.getvalue())
+        self.assertEqual(['a.htm', 'b.htm'], [record['file'] for record in report['files']])
+        self.assertEqual(3, report['files'][1]['matches'])
+
+    def test_csv(self):
+        stream = StringIO()
+        self.report.write(stream, 'csv')
+        rows = list(csv.reader(StringIO(stream.getvalue())))
+        self.assertEqual(['type', 'name', 'matches', 'total', 'parse', 'match', 'mutate', 'serialize'], rows[0])
+        self.assertEqual(['file', 'b.htm', '3', '3.0', '1.5', '0.75', '0.0', '0.0'], rows[2])
+        self.assertEqual(['instruction', 'p -> div', '4', '0.5'], rows[4])
+
+
+class TestProfileStats(unittest.TestCase):
+    def test_merge(self):
+        result, stats = profiling.profileCall(sorted, [3, 1, 2])
+        self.assertEqual([1, 2, 3], result)
+        profiler = cProfile.Profile()
+        profiler.runcall(sorted, [2, 1])
+        profiler.create_stats()
+        collected = profiling.mergeStats(None, stats)
+        collected = profiling.mergeStats(collected, profiler.stats)
+        calls = [value[1] for key, value in collected.stats.items() if 'sorted' in key[2]]
+        self.assertEqual([2], calls)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+# coding=utf-8
+import unittest
+import concurrent.futures
+import os
+import shutil
+import tempfile
+from lxml import html
+from lxml import etree
+import xmlsrr
+
+
+class TestRuleSet(unittest.TestCase):
+    htmlText = b'<html><body><p id="someName" class="awesome time">Some Text</p><p class="sibling">sibling <em>text</em></p></body></html>'
+    resultText = b'<html><body><div id="someName" class="awesome time">Some Text</div><div class="sibling">sibling </div></body></html>'
+
+    def setUp(self):
+        self.rules = xmlsrr.RuleSet('/em\np -> div\n\n.sibling')
+
+    def test_instructions(self):
+        self.assertEqual(['/em', 'p -> div', '.sibling'], [instruction.source for instruction in self.rules.instructions])
+        self.assertEqual(3, len(xmlsrr.RuleSet(['/em', 'p -> div', '.sibling']).instructions))
+        self.assertRaises(ValueError, xmlsrr.RuleSet, '\n')
+        self.assertRaises(ValueError, xmlsrr.RuleSet, 'p', backend='css')
+        self.assertRaises(ValueError, xmlsrr.RuleSet, 'p', format='json')
+
+    def test_apply(self):
+        tree = html.fromstring(self.htmlText).getroottree()
+        self.assertEqual([1, 2, 1], self.rules.apply(tree))
+        self.assertEqual(self.resultText, etree.tostring(tree.getroot()))
+
+    def test_apply_bytes(self):
+        self.assertEqual(self.resultText, self.rules.apply_bytes(self.htmlText))
+        data = b'<html><body><span>text</span></body></html>'
+        self.assertIs(data, self.rules.apply_bytes(data))
+
+    def test_apply_bytes_xml(self):
+        rules = xmlsrr.RuleSet('item -> entry', format='auto')
+        data = b'<?xml version="1.0" encoding="UTF-8"?>\n<feed><item/></feed>'
+        self.assertEqual(b"<?xml version='1.0' encoding='UTF-8'?>\n<feed><entry/></feed>",
+                         rules.apply_bytes(data, 'feed.xml'))
+
+    def test_apply_bytes_threads(self):
+        rules = xmlsrr.RuleSet('/em\np -> div\n.sibling', backend='xpath')
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(rules.apply_bytes, [self.htmlText] * 200))
+        self.assertEqual([self.resultText] * 200, results)
+
+    def test_apply_iter(self):
+        folder = tempfile.mkdtemp()
+        paths = []
+        for number in range(3):
+            paths.append(os.path.join(folder, 'file{0}.htm'.format(number)))
+            with open(paths[-1], 'wb') as f:
+                f.write(self.htmlText)
+        results = list(self.rules.apply_iter(paths))
+        self.assertEqual(['file0.htm', 'file1.htm', 'file2.htm'], [result['name'] for result in results])
+        self.assertEqual([[1, 2, 1]] * 3, [result['matches'] for result in results])
+        with open(paths[2], 'rb') as f:
+            self.assertEqual(self.resultText, f.read())
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
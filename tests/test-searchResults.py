@@ -0,0 +1,92 @@
+# coding=utf-8
+import unittest
+import json
+from io import StringIO
+from lxml import html
+import xmlsrr
+import instructionSet
+import searchResults
+
+
+class TestResultWriter(unittest.TestCase):
+    htmlText = '<html><body><p id="someName" class="awesome time">Some Text</p><p class="sibling">sibling <em>text</em></p></body></html>'
+
+    def setUp(self):
+        self.instructions = [instructionSet.InstructionSet(line) for line in ['p', '/em', '.sibling']]
+        self.matches = [0] * len(self.instructions)
+        self.hits = []
+        xmlsrr.processDocument(html.fromstring(self.htmlText), self.instructions, counts=self.matches,
+                               hits=self.hits.append)
+
+    def test_hits(self):
+        self.assertEqual(['p', 'p', '.sibling'], [hit['instruction'] for hit in self.hits])
+        self.assertEqual('/html/body/p[1]', self.hits[0]['path'])
+        self.assertEqual({'id': 'someName', 'class': 'awesome time'}, self.hits[0]['attributes'])
+        self.assertEqual(1, self.hits[0]['line'])
+
+    def test_json_lines(self):
+        stream = StringIO()
+        writer = searchResults.ResultWriter(stream, self.instructions)
+        writer.add('index.htm', self.matches)
+        for hit in self.hits:
+            writer.writeHit('index.htm', hit)
+        writer.close()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(3, len(records))
+        self.assertEqual('index.htm', records[1]['file'])
+        self.assertEqual('/html/body/p[2]', records[1]['path'])
+        self.assertEqual('p', records[1]['tag'])
+
+    def test_csv(self):
+        stream = StringIO()
+        writer = searchResults.ResultWriter(stream, self.instructions, 'csv')
+        writer.add('index.htm', self.matches)
+        for hit in self.hits:
+            writer.writeHit('index.htm', hit)
+        writer.close()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual('file,instruction,path,line,tag,attributes', lines[0])
+        self.assertEqual(4, len(lines))
+
+    def test_count_only(self):
+        stream = StringIO()
+        writer = searchResults.ResultWriter(stream, self.instructions, countOnly=True)
+        writer.add('index.htm', self.matches)
+        writer.add('other.htm', [0, 0, 0])
+        writer.close()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([{'instruction': 'p', 'matches': 2, 'files': 1},
+                          {'instruction': '.sibling', 'matches': 1, 'files': 1}], records)
+
+
+class TestHitChunks(unittest.TestCase):
+    def test_chunks(self):
+        chunks = []
+        hitChunks = searchResults.HitChunks(chunks.append, 2)
+        for number in range(5):
+            hitChunks('index.htm', number)
+        self.assertEqual([[('index.htm', 0), ('index.htm', 1)], [('index.htm', 2), ('index.htm', 3)]], chunks)
+        hitChunks.flush()
+        hitChunks.flush()
+        self.assertEqual([('index.htm', 4)], chunks[-1])
+
+    def test_relay(self):
+        written = []
+        with searchResults.relayHits(lambda name, hit: written.append((name, hit)), 1) as hitQueue:
+            hitChunks = searchResults.HitChunks(hitQueue.put, 2)
+            for number in range(5):
+                hitChunks('index.htm', number)
+            hitChunks.flush()
+        self.assertEqual([('index.htm', number) for number in range(5)], written)
+
+    def test_relay_error(self):
+        def writeHit(name, hit):
+            raise OSError("Disk full")
+        with self.assertRaises(OSError):
+            with searchResults.relayHits(writeHit, 1) as hitQueue:
+                for number in range(3):
+                    hitQueue.put([('index.htm', number)])
+
+
+if __name__ == "__main__":
+    unittest.main()
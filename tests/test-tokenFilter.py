@@ -0,0 +1,72 @@
+# coding=utf-8
+import unittest
+import mmap
+import tempfile
+import instructionSet
+import tokenFilter
+
+
+def compiled(lines, documentFormat='html'):
+    return tokenFilter.compileFilter([instructionSet.InstructionSet(line) for line in lines], documentFormat)
+
+
+class TestCompileFilter(unittest.TestCase):
+    def test_tokens(self):
+        html, requirements = compiled(['img.thumbnail', 'div h1#title -> h2', 'a[href=/index.htm]'])
+        self.assertTrue(html)
+        self.assertEqual([[(b'<img',), (b'thumbnail',)], [(b'<div',), (b'<h1',), (b'title',)],
+                          [(b'<a',), (b'href',), (b'/index.htm',)]], requirements)
+
+    def test_xml_local_names(self):
+        html, requirements = compiled(['m:Item', 'Item[lang=en us]'], 'xml')
+        self.assertFalse(html)
+        self.assertEqual([[(b'Item',)], [(b'Item',), (b'lang',), (b'en',), (b'us',)]], requirements)
+
+    def test_unreliable_tokens_not_required(self):
+        self.assertEqual([[(b'<img',)], [(b'<img',), (b'alt',)]], compiled(['img.café', 'img[alt=a&b]'])[1])
+        self.assertEqual(None, compiled(['img', 'body']))
+        self.assertEqual(None, compiled(['.café']))
+
+
+class TestCanMatch(unittest.TestCase):
+    def test_html(self):
+        html = compiled(['img.thumbnail', 'div h1#title -> h2'])
+        self.assertTrue(tokenFilter.canMatch(b'<IMG class="thumbnail">', html))
+        self.assertTrue(tokenFilter.canMatch(b'<div><h1 id=title>', html))
+        self.assertFalse(tokenFilter.canMatch(b'<img class="large"><p class="thumb">', html))
+        self.assertFalse(tokenFilter.canMatch(b'<h1 id="title">', html))
+
+    def test_references_and_encodings(self):
+        html = compiled(['img.thumbnail'])
+        self.assertTrue(tokenFilter.canMatch(b'<img class="&#116;humbnail">', html))
+        self.assertTrue(tokenFilter.canMatch('<img class="thumbnail">'.encode('utf-16'), html))
+        xml = compiled(['item.new'], 'xml')
+        self.assertTrue(tokenFilter.canMatch(b'<!DOCTYPE r [<!ENTITY n "new">]><r><item class="&n;"/></r>', xml))
+        self.assertFalse(tokenFilter.canMatch(b'<r><ITEM class="new"/></r>', xml))
+
+    def test_named_references(self):
+        html = compiled(['a[href=http://x.org/]', '#a_b'])
+        self.assertTrue(tokenFilter.canMatch(b'<a href="http&colon;//x.org/">', html))
+        self.assertTrue(tokenFilter.canMatch(b'<p id="a&lowbar;b">', html))
+        self.assertTrue(tokenFilter.canMatch(b'<p id="&ltimes;">', html))
+        self.assertFalse(tokenFilter.canMatch(b'<p id="a&amp;b" title="&lt;&GT;&quot; &amp">', html))
+        xml = compiled(['item.new'], 'xml')
+        self.assertFalse(tokenFilter.canMatch(b'<r><item class="&amp;"/></r>', xml))
+        with tempfile.TemporaryFile() as f:
+            f.write(b'<html><p id="a&lowbar;b"></html>')
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                self.assertTrue(tokenFilter.canMatch(mapped, html))
+
+    def test_memory_map(self):
+        html = compiled(['img.thumbnail'])
+        with tempfile.TemporaryFile() as f:
+            f.write(b'<html><IMG Class="thumbnail"></html>')
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                self.assertTrue(tokenFilter.canMatch(mapped, html))
+                self.assertFalse(tokenFilter.canMatch(mapped, compiled(['img.large'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+# coding=utf-8
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.request
+import instructionSet
+import outputTree
+import watcher
+import xmlsrr
+
+
+def waitFor(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.05)
+
+
+class TestWatchers(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        with open(os.path.join(self.folder, 'old.htm'), 'w') as f:
+            f.write('<p>old</p>')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def writeFile(self, name, text='<p>new</p>'):
+        with open(os.path.join(self.folder, name), 'w') as f:
+            f.write(text)
+
+    def writeBurst(self):
+        for number in range(5):
+            self.writeFile('file{0}.htm'.format(number))
+            time.sleep(0.02)
+
+    def test_inotify(self):
+        try:
+            folderWatcher = watcher.InotifyWatcher(self.folder)
+        except (OSError, AttributeError):
+            self.skipTest("inotify isn't available")
+        self.writeFile('new.htm')
+        os.makedirs(os.path.join(self.folder, 'sub', 'deeper'))
+        self.writeFile(os.path.join('sub', 'deeper', 'page.htm'))
+        found = set()
+        for attempt in range(5):
+            found.update(folderWatcher.changes(0.2))
+        self.assertEqual({'new.htm', os.path.join('sub', 'deeper', 'page.htm')}, found)
+        os.rename(os.path.join(self.folder, 'new.htm'), os.path.join(self.folder, 'moved.htm'))
+        self.assertEqual({'moved.htm'}, folderWatcher.changes(1.0))
+        self.assertEqual(set(), folderWatcher.changes(0.0))
+        folderWatcher.close()
+
+    def test_polling(self):
+        folderWatcher = watcher.PollingWatcher(self.folder, 0.0)
+        self.assertEqual(set(), folderWatcher.changes(0.0))
+        self.writeFile('new.htm')
+        self.writeFile('old.htm', '<p>changed</p>')
+        self.assertEqual({'new.htm', 'old.htm'}, folderWatcher.changes(0.0))
+        self.assertEqual(set(), folderWatcher.changes(0.0))
+
+    def test_collect_changes(self):
+        folderWatcher = watcher.PollingWatcher(self.folder, 0.05)
+        writer = threading.Thread(target=self.writeBurst)
+        writer.start()
+        found = watcher.collectChanges(folderWatcher, 0.3, 1.0)
+        writer.join()
+        self.assertEqual({'file{0}.htm'.format(number) for number in range(5)}, found)
+
+
+class TestWatchFolder(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        with open(os.path.join(self.folder, 'old.htm'), 'w') as f:
+            f.write('<html><body><p>old</p></body></html>')
+        self.instructions = [instructionSet.InstructionSet('p -> div')]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def readFile(self, name):
+        with open(os.path.join(self.folder, name)) as f:
+            return f.read()
+
+    def test_watch_folder(self):
+        options = {'jobs': 1, 'backend': 'python', 'debounce': 0.1, 'pollInterval': 0.1, 'statusPort': 0,
+                   'readAhead': 2, 'writeBehind': 2}
+        stop = threading.Event()
+        run = threading.Thread(target=xmlsrr.watchFolder, args=(self.folder, self.instructions, options),
+                               kwargs={'stop': stop})
+        run.start()
+        try:
+            waitFor(lambda: '<div>' in self.readFile('old.htm'))
+            os.makedirs(os.path.join(self.folder, 'sub'))
+            with open(os.path.join(self.folder, 'sub', 'new.htm'), 'w') as f:
+                f.write('<html><body><p>new</p></body></html>')
+            with open(os.path.join(self.folder, 'notes.txt'), 'w') as f:
+                f.write('<p>not processed</p>')
+            waitFor(lambda: '<div>' in self.readFile(os.path.join('sub', 'new.htm')))
+            time.sleep(0.5)
+        finally:
+            stop.set()
+            run.join()
+        self.assertEqual('<p>not processed</p>', self.readFile('notes.txt'))
+
+    def test_batch_synced(self):
+        options = {'jobs': 1, 'backend': 'python', 'debounce': 0.1, 'pollInterval': 0.1, 'readAhead': 2,
+                   'writeBehind': 2, 'durability': 'batch'}
+        stop = threading.Event()
+        run = threading.Thread(target=xmlsrr.watchFolder, args=(self.folder, self.instructions, options),
+                               kwargs={'stop': stop})
+        run.start()
+        try:
+            waitFor(lambda: '<div>' in self.readFile('old.htm'))
+            # A batch far below outputTree.batchSize is still synced once it is done
+            waitFor(lambda: not outputTree.batchState['unsynced'])
+        finally:
+            stop.set()
+            run.join()
+
+    def test_status(self):
+        status = watcher.WatchStatus()
+        status.startBatch()
+        queued = status.queue(['a.htm', 'b.htm'])
+        next(queued)
+        self.assertEqual(1, status.describe()['queued'])
+        next(queued)
+        status.add({'error': None, 'skipped': False, 'filtered': True, 'bytes': 10})
+        server = watcher.serveStatus(status, 0)
+        try:
+            with urllib.request.urlopen('http://{0}:{1}/'.format(*server.server_address)) as response:
+                described = json.loads(response.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(1, described['queued'])
+        self.assertEqual(1, described['processed'])
+        self.assertEqual(1, described['filtered'])
+        self.assertEqual(10, described['bytes'])
+        self.assertGreater(described['files/s'], 0)
+        status.finishBatch()
+        self.assertEqual(2, status.describe()['lastBatch']['files'])
+
+
+class TestIsIncluded(unittest.TestCase):
+    def test_patterns(self):
+        self.assertTrue(xmlsrr.isIncluded(os.path.join('a', 'b.htm'), ['*.htm'], []))
+        self.assertFalse(xmlsrr.isIncluded('.b.htm.x1.tmp', ['*.htm'], []))
+        self.assertFalse(xmlsrr.isIncluded(os.path.join('drafts', 'b.htm'), ['*.htm'], ['drafts']))
+        self.assertFalse(xmlsrr.isIncluded(os.path.join('a', 'b.htm'), ['*.htm'], ['a/b.htm']))
+
+
+if __name__ == '__main__':
+    unittest.main()
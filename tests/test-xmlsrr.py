@@ -2,11 +2,17 @@
 import unittest
 import sys
 from io import StringIO
+from io import BytesIO
 import os
+import shutil
+import subprocess
+import tempfile
 from lxml import html
 from lxml import etree
 import xmlsrr
 import instructionSet
+import xpathSelector
+import manifest
 
 
 class TestValidateTarget(unittest.TestCase):
@@ -61,6 +67,68 @@ class TestValidateTarget(unittest.TestCase):
         self.assertRaises(PermissionError, xmlsrr.validateTarget, [targetFolder], False)
 
 
+class TestValidateOutput(unittest.TestCase):
+    # The tests above replace os.access, these need the real one
+    access = os.access
+
+    def setUp(self):
+        self.replacedAccess = os.access
+        os.access = TestValidateOutput.access
+        self.folder = tempfile.mkdtemp()
+        self.outputFolder = os.path.join(self.folder, 'precious')
+        os.makedirs(self.outputFolder)
+
+    def tearDown(self):
+        os.access = self.replacedAccess
+        shutil.rmtree(self.folder)
+
+    def test_foreign_folder_refused(self):
+        self.assertEqual(self.outputFolder, xmlsrr.validateOutput(self.outputFolder))
+        with open(os.path.join(self.outputFolder, 'notes.txt'), 'w') as f:
+            f.write('notes')
+        self.assertRaises(ValueError, xmlsrr.validateOutput, self.outputFolder)
+        self.assertEqual(self.outputFolder, xmlsrr.validateOutput(self.outputFolder, force=True))
+
+    def test_run_keeps_foreign_folder(self):
+        targetFolder = os.path.join(self.folder, 'source')
+        os.makedirs(targetFolder)
+        with open(os.path.join(targetFolder, 'index.htm'), 'w') as f:
+            f.write('<html><body><p>text</p></body></html>')
+        with open(os.path.join(self.outputFolder, 'notes.txt'), 'w') as f:
+            f.write('notes')
+        instructionFile = os.path.join(self.folder, 'instructions.txt')
+        with open(instructionFile, 'w') as f:
+            f.write('p -> div\n')
+        arguments = ['-s', '-i', instructionFile, '-o', self.outputFolder, targetFolder]
+        self.assertRaises(ValueError, xmlsrr.main, arguments)
+        self.assertEqual(['notes.txt'], os.listdir(self.outputFolder))
+        self.assertEqual(['instructions.txt', 'precious', 'source'], sorted(os.listdir(self.folder)))
+        self.assertEqual(0, xmlsrr.main(['--force'] + arguments))
+        self.assertEqual(['.xmlsrr-output', 'index.htm'], sorted(os.listdir(self.outputFolder)))
+
+    def test_in_place_run_on_output_keeps_source(self):
+        targetFolder = os.path.join(self.folder, 'source')
+        os.makedirs(targetFolder)
+        for name, text in [('a.htm', '<html><body><p>text</p></body></html>'),
+                           ('b.htm', '<html><body><span/></body></html>')]:
+            with open(os.path.join(targetFolder, name), 'w') as f:
+                f.write(text)
+        for instruction in 'p -> div', 'span -> em':
+            with open(os.path.join(self.folder, instruction[0] + '.txt'), 'w') as f:
+                f.write(instruction + '\n')
+        shutil.rmtree(self.outputFolder)
+        self.assertEqual(0, xmlsrr.main(['-s', '-i', os.path.join(self.folder, 'p.txt'), '-o', self.outputFolder,
+                                         targetFolder]))
+        self.assertTrue(os.path.samefile(os.path.join(targetFolder, 'b.htm'), os.path.join(self.outputFolder, 'b.htm')))
+        for hardlinks in 'break', 'keep':
+            self.assertEqual(0, xmlsrr.main(['-s', '--hardlinks', hardlinks, '-i', os.path.join(self.folder, 's.txt'),
+                                             self.outputFolder]))
+            with open(os.path.join(targetFolder, 'b.htm')) as f:
+                self.assertEqual('<html><body><span/></body></html>', f.read())
+        with open(os.path.join(self.outputFolder, 'b.htm')) as f:
+            self.assertEqual('<html><body><em/></body></html>', f.read())
+
+
 class TestValidateInstructionsExist(unittest.TestCase):
     def test_empty_instruction_list(self):
         instructionsList = []
@@ -179,5 +247,642 @@ class TestProcessInstructions(unittest.TestCase):
         self.assertEqual(resultText, etree.tostring(result))
 
 
+class TestProcessInstructionList(unittest.TestCase):
+    htmlText = '<html><body><p id="someName" class="awesome time">Some Text</p><p class="sibling">sibling <em>text</em></p></body></html>'
+
+    def sequentialResult(self, instructions):
+        element = html.fromstring(self.htmlText)
+        for instruction in instructions:
+            xmlsrr.processInstructions(element, instruction)
+        return etree.tostring(element)
+
+    def singlePassResult(self, instructions):
+        element = html.fromstring(self.htmlText)
+        return etree.tostring(xmlsrr.processInstructionList(element, instructions))
+
+    def test_replace_then_remove(self):
+        resultText = b'<html><body/></html>'
+        instructions = [instructionSet.InstructionSet(line) for line in ['p -> div', '/div']]
+        self.assertEqual(resultText, self.singlePassResult(instructions))
+        self.assertEqual(self.sequentialResult(instructions), self.singlePassResult(instructions))
+
+    def test_remove_then_replace(self):
+        resultText = b'<html><body><div id="someName" class="awesome time">Some Text</div><div class="sibling">sibling <em>text</em></div></body></html>'
+        instructions = [instructionSet.InstructionSet(line) for line in ['/div', 'p -> div']]
+        self.assertEqual(resultText, self.singlePassResult(instructions))
+        self.assertEqual(self.sequentialResult(instructions), self.singlePassResult(instructions))
+
+    def test_replace_class_then_descendant(self):
+        resultText = b'<html><body><p id="someName" class="time plain">Some Text</p><p class="sibling">sibling <strong>text</strong></p></body></html>'
+        instructions = [instructionSet.InstructionSet(line) for line in ['.awesome -> .plain', '.sibling em -> strong']]
+        self.assertEqual(resultText, self.singlePassResult(instructions))
+        self.assertEqual(self.sequentialResult(instructions), self.singlePassResult(instructions))
+
+    def test_remove_descendant(self):
+        resultText = b'<html><body><p id="someName" class="awesome time">Some Text</p><p class="sibling">sibling </p></body></html>'
+        instructions = [instructionSet.InstructionSet('/body p em')]
+        self.assertEqual(resultText, self.singlePassResult(instructions))
+
+    def test_document_changed(self):
+        instructions = [instructionSet.InstructionSet(line) for line in ['p', '/div', '#someName -> #someName']]
+        self.assertFalse(xmlsrr.processDocument(html.fromstring(self.htmlText), instructions))
+        instructions.append(instructionSet.InstructionSet('/em'))
+        self.assertTrue(xmlsrr.processDocument(html.fromstring(self.htmlText), instructions))
+
+    def test_remove_adjacent_siblings(self):
+        resultText = b'<html><body/></html>'
+        instructions = [instructionSet.InstructionSet('/p')]
+        self.assertEqual(resultText, self.singlePassResult(instructions))
+
+    def test_remove_after_descendant_match(self):
+        instructions = [instructionSet.InstructionSet(line) for line in ['[k] [m]', '/[k]', '[m]']]
+        element = etree.fromstring('<div><section k="1"><p m="1"/></section><p m="2"/></div>')
+        counts = [0, 0, 0]
+        hits = []
+        self.assertTrue(xmlsrr.processDocument(element, instructions, counts=counts, hits=hits.append))
+        self.assertEqual([1, 1, 1], counts)
+        self.assertEqual([('[k] [m]', '1'), ('[m]', '2')],
+                         [(hit['instruction'], hit['attributes']['m']) for hit in hits])
+        self.assertEqual(b'<div><p m="2"/></div>', etree.tostring(element))
+        sequentialCounts = [0, 0, 0]
+        xmlsrr.processEach(etree.fromstring('<div><section k="1"><p m="1"/></section><p m="2"/></div>'), instructions,
+                           'python', sequentialCounts, None, None)
+        self.assertEqual(sequentialCounts, counts)
+
+    def test_remove_root(self):
+        for lines in [['/html'], ['/[id]', '/html'], ['p', '/[lang]']]:
+            instructions = [instructionSet.InstructionSet(line) for line in lines]
+            for backend in 'python', 'xpath':
+                if backend == 'xpath':
+                    xpathSelector.compileInstructions(instructions)
+                element = html.fromstring('<html lang="en"><body><p>Some Text</p></body></html>')
+                with self.assertRaisesRegex(ValueError, 'remove the root element'):
+                    xmlsrr.processDocument(element, instructions, backend)
+        element = html.fromstring(self.htmlText)
+        self.assertTrue(xmlsrr.processDocument(element.find('body'), [instructionSet.InstructionSet('/body')]))
+        self.assertEqual(b'<html/>', etree.tostring(element))
+
+    def test_remove_root_file(self):
+        targetFolder = tempfile.mkdtemp()
+        for name in 'page.htm', 'feed.xml':
+            with open(os.path.join(targetFolder, name), 'w') as f:
+                f.write(self.htmlText)
+        for name, settings in ('page.htm', {}), ('feed.xml', {'format': 'xml', 'streamSize': 0}):
+            result = xmlsrr.processFile(targetFolder, name, [instructionSet.InstructionSet('/html')], **settings)
+            self.assertIn('remove the root element', result['error'])
+            with open(os.path.join(targetFolder, name)) as f:
+                self.assertEqual(self.htmlText, f.read())
+        self.assertEqual(['feed.xml', 'page.htm'], sorted(os.listdir(targetFolder)))
+        shutil.rmtree(targetFolder)
+
+    def test_deep_document(self):
+        root = element = etree.Element('div')
+        for depth in range(sys.getrecursionlimit() * 2):
+            element = etree.SubElement(element, 'div', {'data-depth': str(depth)})
+        etree.SubElement(element, 'em')
+        counts = [0, 0]
+        instructions = [instructionSet.InstructionSet(line) for line in ['[data-depth=1500] -> [class=deep]', '/em']]
+        self.assertTrue(xmlsrr.processDocument(root, instructions, counts=counts))
+        self.assertEqual([1, 1], counts)
+        self.assertEqual(0, len(root.findall('.//em')))
+
+    def test_deep_html_file(self):
+        targetFolder = tempfile.mkdtemp()
+        with open(os.path.join(targetFolder, 'deep.htm'), 'w') as f:
+            f.write('<div>' * 1000 + '<em>text</em>' + '</div>' * 1000)
+        result = xmlsrr.processFile(targetFolder, 'deep.htm', [instructionSet.InstructionSet('em')])
+        self.assertEqual([1], result['matches'])
+        shutil.rmtree(targetFolder)
+
+
+class TestClasses(unittest.TestCase):
+    def test_class_tokens(self):
+        self.assertEqual([], xmlsrr.classTokens(None))
+        self.assertEqual(['a', 'b', 'c'], xmlsrr.classTokens(' a\tb\n  c '))
+        self.assertEqual(['a\u00a0b', 'c'], xmlsrr.classTokens('a\u00a0b c'))
+
+    def test_whitespace_separated_classes(self):
+        element = html.fromstring('<div><p class="awesome\ttime">one</p><p class="\nawesome\n">two</p></div>')
+        counts = [0]
+        xmlsrr.processDocument(element, [instructionSet.InstructionSet('p.awesome')], counts=counts)
+        self.assertEqual([2], counts)
+
+    def test_replace_adjacent_classes(self):
+        element = html.fromstring('<p class="a b  c">text</p>')
+        xmlsrr.processDocument(element, [instructionSet.InstructionSet('p.b.a -> .d.c.e')])
+        self.assertEqual('c d e', element.get('class'))
+
+    def test_replace_keeps_order(self):
+        element = html.fromstring('<p class="z red y">text</p>')
+        xmlsrr.processDocument(element, [instructionSet.InstructionSet('.red -> .blue.a')])
+        self.assertEqual('z y blue a', element.get('class'))
+
+
+class TestSelectCandidates(unittest.TestCase):
+    htmlText = '<html><body><div class="a"><div class="b"><p id="x" class="a">one</p></div></div><p class="b">two</p></body></html>'
+
+    def select(self, line, element=None):
+        instruction = instructionSet.InstructionSet(line)
+        element = html.fromstring(self.htmlText) if element is None else element
+        return [match.text for match in xmlsrr.selectCandidates(element, instruction, xmlsrr.lastLink(instruction), {})]
+
+    def test_is_indexed(self):
+        for line, indexed in [('p', True), ('.a', True), ('#x', True), ('#x#y', False), ('[id]', False), ('m:p', False),
+                              ('p [id]', False), ('[id] p', True)]:
+            self.assertEqual(indexed, xmlsrr.isIndexed(xmlsrr.lastLink(instructionSet.InstructionSet(line))), line)
+
+    def test_descendant_chain(self):
+        self.assertEqual(['one'], self.select('div p'))
+        self.assertEqual(['one'], self.select('.a .b .a'))
+        self.assertEqual([], self.select('.b .a .b'))
+
+    def test_matched_ancestor(self):
+        # The selector doesn't look below an element it already matched
+        self.assertEqual([None], self.select('.a'))
+        self.assertEqual(['one', 'two'], self.select('p'))
+
+    def test_index_rebuilt_after_change(self):
+        instructions = [instructionSet.InstructionSet(line) for line in ['#x -> #y', '/#y', '.b -> .c', '/.c']]
+        element = html.fromstring(self.htmlText)
+        xmlsrr.processDocument(element, instructions)
+        self.assertEqual(b'<html><body><div class="a"/></body></html>', etree.tostring(element))
+
+    def test_index_kept_in_order(self):
+        instructions = [instructionSet.InstructionSet(line) for line in ['.a -> .c', '.b -> .c', '.c', '.c -> .d']]
+        element = etree.fromstring('<r><i id="1" class="b"/><i id="2" class="a"/><i id="3" class="b c"/></r>')
+        hits = []
+        counts = [0] * len(instructions)
+        xmlsrr.processDocument(element, instructions, counts=counts, hits=hits.append)
+        self.assertEqual([1, 2, 3, 3], counts)
+        self.assertEqual(['1', '2', '3'], [hit['attributes']['id'] for hit in hits])
+        self.assertEqual(['d', 'd', 'd'], [child.get('class') for child in element])
+
+
+class TestVerify(unittest.TestCase):
+    def test_verify_without_lxml(self):
+        folder = tempfile.mkdtemp()
+        instructionFile = os.path.join(folder, 'instructions.txt')
+        with open(instructionFile, 'w') as f:
+            f.write('h1#title\n/p.translate span[lang=en-us]\n.old -> div.new\n')
+        code = ('import sys, xmlsrr\n'
+                'status = xmlsrr.main(["-s", "-V", "-i", sys.argv[1], sys.argv[2]])\n'
+                'print(status, sorted(name for name in sys.modules if name.split(".")[0] == "lxml"))')
+        output = subprocess.check_output([sys.executable, '-c', code, instructionFile, folder],
+                                         cwd=os.path.dirname(os.path.abspath(xmlsrr.__file__)),
+                                         stderr=subprocess.DEVNULL, universal_newlines=True)
+        shutil.rmtree(folder)
+        self.assertEqual('0 []', output.strip())
+
+
+class TestValidateJobs(unittest.TestCase):
+    def test_negative_jobs(self):
+        self.assertRaises(ValueError, xmlsrr.validateJobs, -1)
+
+    def test_all_cores(self):
+        self.assertGreaterEqual(xmlsrr.validateJobs(0), 1)
+
+    def test_jobs(self):
+        self.assertEqual(4, xmlsrr.validateJobs(4))
+
+
+class TestValidateDepth(unittest.TestCase):
+    def test_negative_depth(self):
+        self.assertRaises(ValueError, xmlsrr.validateDepth, -1)
+
+    def test_depth(self):
+        self.assertEqual(0, xmlsrr.validateDepth(0))
+
+
+class TestProcessFiles(unittest.TestCase):
+    htmlText = '<html><body><p id="someName" class="awesome time">Some Text</p><p class="sibling">sibling <em>text</em></p></body></html>'
+
+    def setUp(self):
+        self.targetFolder = tempfile.mkdtemp()
+        self.fileList = []
+        for number in range(6):
+            name = 'file{0}.htm'.format(number)
+            with open(os.path.join(self.targetFolder, name), 'w') as f:
+                f.write(self.htmlText)
+            self.fileList.append(name)
+        with open(os.path.join(self.targetFolder, 'broken.htm'), 'w') as f:
+            f.write('')
+        self.fileList.insert(3, 'broken.htm')
+        self.instructions = [instructionSet.InstructionSet(line) for line in ['/em', 'p -> div', '.sibling']]
+
+    def tearDown(self):
+        shutil.rmtree(self.targetFolder)
+
+    def runFiles(self, jobs):
+        options = {'jobs': jobs, 'backend': 'python'}
+        return list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options))
+
+    def test_timings(self):
+        result = xmlsrr.processFile(self.targetFolder, 'file0.htm', self.instructions, timings=True)
+        timings = result['timings']
+        self.assertEqual([1, 2, 1], result['matches'])
+        self.assertEqual(3, len(timings['instructions']))
+        for phase in ['parse', 'match', 'mutate', 'serialize']:
+            self.assertGreater(timings[phase], 0)
+        self.assertGreaterEqual(timings['total'], timings['parse'] + timings['match'] + timings['mutate'])
+        self.assertEqual(None, xmlsrr.processFile(self.targetFolder, 'file1.htm', self.instructions)['timings'])
+
+    def test_timings_share_walk(self):
+        instructions = [instructionSet.InstructionSet(line) for line in ['[id]', '[class]', 'em']]
+        counts = [0] * len(instructions)
+        xmlsrr.processDocument(html.fromstring(self.htmlText), instructions, counts=counts)
+        walks = []
+        walk = xmlsrr.walkInstructions
+        xmlsrr.walkInstructions = lambda element, pending, *arguments: walks.append(len(pending)) or walk(
+            element, pending, *arguments)
+        try:
+            timings = xmlsrr.profiling.newTimings(instructions)
+            timedCounts = [0] * len(instructions)
+            xmlsrr.processDocument(html.fromstring(self.htmlText), instructions, counts=timedCounts, timings=timings)
+        finally:
+            xmlsrr.walkInstructions = walk
+        self.assertEqual([2], walks)
+        self.assertEqual(counts, timedCounts)
+        self.assertEqual(timings['instructions'][0], timings['instructions'][1])
+        self.assertGreater(timings['instructions'][2], 0)
+
+    def test_profile_workers(self):
+        options = {'jobs': 2, 'backend': 'python', 'profile': 'unused'}
+        results = list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options))
+        for result in results:
+            self.assertTrue(any(key[2] == 'processFile' for key in result['profile']))
+
+    def test_hits_written_as_found(self):
+        instructions = [instructionSet.InstructionSet(line) for line in ['p', '.sibling']]
+        for jobs in 1, 2:
+            hits = []
+            options = {'jobs': jobs, 'backend': 'python', 'hits': True}
+            for result in xmlsrr.processFiles(self.targetFolder, self.fileList, instructions, options,
+                                              writeHit=lambda name, hit: hits.append((name, hit['instruction']))):
+                if jobs == 1 and not result['error']:
+                    # Written before the result of the file comes back
+                    self.assertEqual(3, sum(1 for name, instruction in hits if name == result['name']))
+                self.assertNotIn('hits', result)
+            self.assertEqual(sorted((name, instruction) for name in self.fileList if name != 'broken.htm'
+                                    for instruction in ['p', 'p', '.sibling']), sorted(hits))
+
+    def test_process_file(self):
+        resultText = b'<html><body><div id="someName" class="awesome time">Some Text</div><div class="sibling">sibling </div></body></html>'
+        result = xmlsrr.processFile(self.targetFolder, 'file0.htm', self.instructions)
+        self.assertEqual(None, result['error'])
+        self.assertEqual([1, 2, 1], result['matches'])
+        self.assertEqual(len(resultText), result['bytes'])
+        with open(os.path.join(self.targetFolder, 'file0.htm'), 'rb') as f:
+            self.assertEqual(resultText, f.read())
+
+    def test_process_file_error(self):
+        result = xmlsrr.processFile(self.targetFolder, 'broken.htm', self.instructions)
+        self.assertNotEqual(None, result['error'])
+
+    def test_parallel_results_in_order(self):
+        results = self.runFiles(2)
+        self.assertEqual(self.fileList, [result['name'] for result in results])
+        self.assertNotEqual(None, results[3]['error'])
+        self.assertEqual([1, 2, 1], results[0]['matches'])
+
+    def test_parallel_matches_serial(self):
+        parallelResults = self.runFiles(3)
+        for name in self.fileList:
+            if name != 'broken.htm':
+                with open(os.path.join(self.targetFolder, name), 'w') as f:
+                    f.write(self.htmlText)
+        serialResults = self.runFiles(1)
+        for results in serialResults, parallelResults:
+            for result in results:
+                result.pop('state')
+        self.assertEqual(serialResults, parallelResults)
+
+    def test_pipeline_matches_serial(self):
+        options = {'jobs': 1, 'backend': 'python', 'readAhead': 2, 'writeBehind': 1}
+        pipelineResults = list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options))
+        with open(os.path.join(self.targetFolder, 'file5.htm'), 'rb') as f:
+            pipelineText = f.read()
+        for name in self.fileList:
+            if name != 'broken.htm':
+                with open(os.path.join(self.targetFolder, name), 'w') as f:
+                    f.write(self.htmlText)
+        serialResults = self.runFiles(1)
+        with open(os.path.join(self.targetFolder, 'file5.htm'), 'rb') as f:
+            self.assertEqual(f.read(), pipelineText)
+        self.assertEqual(serialResults, pipelineResults)
+
+    def test_pipeline_incremental(self):
+        options = {'jobs': 1, 'backend': 'python', 'readAhead': 4, 'writeBehind': 4}
+        fileManifest = manifest.Manifest(os.path.join(self.targetFolder, 'manifest'), self.instructions)
+        list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options, fileManifest))
+        with open(os.path.join(self.targetFolder, 'file1.htm'), 'w') as f:
+            f.write(self.htmlText)
+        results = list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options, fileManifest))
+        fileManifest.close()
+        self.assertEqual(['file1.htm', 'broken.htm'], [result['name'] for result in results if not result['skipped']])
+
+    def test_read_source(self):
+        self.assertEqual(self.htmlText.encode(), xmlsrr.readSource(self.targetFolder, 'file0.htm'))
+        self.assertEqual(None, xmlsrr.readSource(self.targetFolder, 'missing.htm'))
+        previous = manifest.fileState(os.path.join(self.targetFolder, 'file0.htm'))
+        self.assertEqual(None, xmlsrr.readSource(self.targetFolder, 'file0.htm', previous))
+
+    def test_mapped_file(self):
+        readResult = xmlsrr.processFile(self.targetFolder, 'file0.htm', self.instructions)
+        with open(os.path.join(self.targetFolder, 'file0.htm'), 'rb') as f:
+            readText = f.read()
+        self.assertEqual(None, xmlsrr.readSource(self.targetFolder, 'file1.htm', mapSize=1))
+        chunkSize = xmlsrr.mapChunkSize
+        xmlsrr.mapChunkSize = 16
+        try:
+            mappedResult = xmlsrr.processFile(self.targetFolder, 'file1.htm', self.instructions, mapSize=1)
+            brokenResult = xmlsrr.processFile(self.targetFolder, 'broken.htm', self.instructions, mapSize=0)
+        finally:
+            xmlsrr.mapChunkSize = chunkSize
+        mappedResult['name'] = 'file0.htm'
+        self.assertEqual(readResult, mappedResult)
+        with open(os.path.join(self.targetFolder, 'file1.htm'), 'rb') as f:
+            self.assertEqual(readText, f.read())
+        self.assertNotEqual(None, brokenResult['error'])
+
+    def test_prefilter(self):
+        instructions = [instructionSet.InstructionSet(line) for line in ['img.thumbnail', '#title -> h1']]
+        os.utime(os.path.join(self.targetFolder, 'file0.htm'), ns=(0, 0))
+        result = xmlsrr.processFile(self.targetFolder, 'file0.htm', instructions, prefilter=True)
+        self.assertTrue(result['filtered'])
+        self.assertEqual([0, 0], result['matches'])
+        self.assertEqual(0, os.stat(os.path.join(self.targetFolder, 'file0.htm')).st_mtime_ns)
+        mappedResult = xmlsrr.processFile(self.targetFolder, 'file1.htm', instructions, mapSize=1, prefilter=True)
+        self.assertTrue(mappedResult['filtered'])
+        instructions.append(instructionSet.InstructionSet('#someName -> div'))
+        result = xmlsrr.processFile(self.targetFolder, 'file2.htm', instructions, mapSize=1, prefilter=True)
+        self.assertFalse(result['filtered'])
+        self.assertEqual([0, 0, 1], result['matches'])
+        self.assertTrue(xmlsrr.processFile(self.targetFolder, 'broken.htm', instructions, prefilter=True)['error'])
+
+    def test_unchanged_file_not_written(self):
+        instructions = [instructionSet.InstructionSet(line) for line in ['p', '/div']]
+        os.utime(os.path.join(self.targetFolder, 'file0.htm'), ns=(0, 0))
+        result = xmlsrr.processFile(self.targetFolder, 'file0.htm', instructions)
+        self.assertEqual([2, 0], result['matches'])
+        self.assertFalse(result['changed'])
+        self.assertEqual(0, os.stat(os.path.join(self.targetFolder, 'file0.htm')).st_mtime_ns)
+
+    def test_unchanged_file_destination_folder(self):
+        destinationFolder = tempfile.mkdtemp()
+        instructions = [instructionSet.InstructionSet('p')]
+        result = xmlsrr.processFile(self.targetFolder, 'file0.htm', instructions, destinationFolder=destinationFolder)
+        self.assertFalse(result['changed'])
+        self.assertTrue(os.path.samefile(os.path.join(self.targetFolder, 'file0.htm'),
+                                         os.path.join(destinationFolder, 'file0.htm')))
+        shutil.rmtree(destinationFolder)
+
+    def test_destination_folder(self):
+        destinationFolder = tempfile.mkdtemp()
+        options = {'jobs': 2, 'backend': 'python'}
+        results = list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options,
+                                           destinationFolder=destinationFolder))
+        self.assertEqual(len(self.fileList), len(results))
+        with open(os.path.join(self.targetFolder, 'file0.htm')) as f:
+            self.assertEqual(self.htmlText, f.read())
+        with open(os.path.join(destinationFolder, 'file0.htm'), 'rb') as f:
+            self.assertIn(b'<div id="someName"', f.read())
+        self.assertFalse(os.path.exists(os.path.join(destinationFolder, 'broken.htm')))
+        shutil.rmtree(destinationFolder)
+
+    def test_incremental_destination_folder(self):
+        outputFolder = tempfile.mkdtemp()
+        options = {'jobs': 1, 'backend': 'python', 'output': outputFolder}
+        fileManifest = manifest.Manifest(os.path.join(self.targetFolder, 'manifest'), self.instructions)
+        list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options, fileManifest,
+                                 outputFolder))
+        stagingFolder = tempfile.mkdtemp()
+        results = list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options, fileManifest,
+                                           stagingFolder))
+        fileManifest.close()
+        self.assertEqual(['broken.htm'], [result['name'] for result in results if not result['skipped']])
+        with open(os.path.join(stagingFolder, 'file0.htm'), 'rb') as f:
+            self.assertIn(b'<div id="someName"', f.read())
+        shutil.rmtree(outputFolder)
+        shutil.rmtree(stagingFolder)
+
+    def test_incremental(self):
+        options = {'jobs': 1, 'backend': 'python'}
+        fileManifest = manifest.Manifest(os.path.join(self.targetFolder, 'manifest'), self.instructions)
+        results = list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options, fileManifest))
+        self.assertEqual([False] * len(self.fileList), [result['skipped'] for result in results])
+        with open(os.path.join(self.targetFolder, 'file1.htm'), 'w') as f:
+            f.write(self.htmlText)
+        results = list(xmlsrr.processFiles(self.targetFolder, self.fileList, self.instructions, options, fileManifest))
+        fileManifest.close()
+        self.assertEqual(['file1.htm', 'broken.htm'], [result['name'] for result in results if not result['skipped']])
+
+
+class TestScanFolder(unittest.TestCase):
+    def setUp(self):
+        self.targetFolder = tempfile.mkdtemp()
+        for name in ['index.htm', 'logo.png', os.path.join('drafts', 'draft.htm')]:
+            path = os.path.join(self.targetFolder, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('<html></html>')
+
+    def tearDown(self):
+        shutil.rmtree(self.targetFolder)
+
+    def test_assets(self):
+        scan = xmlsrr.scanFolder(self.targetFolder, exclude=['drafts'], assets=True)
+        self.assertEqual([(os.path.join('drafts', 'draft.htm'), False), ('index.htm', True), ('logo.png', False)],
+                         sorted(scan))
+
+    def test_copy_assets(self):
+        destinationFolder = tempfile.mkdtemp()
+        scan = xmlsrr.scanFolder(self.targetFolder, assets=True)
+        self.assertEqual(sorted(['index.htm', os.path.join('drafts', 'draft.htm')]),
+                         sorted(xmlsrr.copyAssets(self.targetFolder, destinationFolder, scan, 'link')))
+        self.assertEqual(['logo.png'], os.listdir(destinationFolder))
+        shutil.rmtree(destinationFolder)
+
+
+class TestGetFileList(unittest.TestCase):
+    def setUp(self):
+        self.targetFolder = tempfile.mkdtemp()
+        folderName = os.path.basename(self.targetFolder)
+        names = ['index.html', 'page.htm', 'notes.htm.bak', 'image.png', os.path.join(folderName, 'nested.htm'),
+                 os.path.join('drafts', 'draft.htm'), os.path.join('drafts', 'deep', 'old.html')]
+        for name in names:
+            path = os.path.join(self.targetFolder, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('<html></html>')
+        self.folderName = folderName
+
+    def tearDown(self):
+        shutil.rmtree(self.targetFolder)
+
+    def test_default_patterns(self):
+        fileList = xmlsrr.getFileList(self.targetFolder)
+        self.assertNotIsInstance(fileList, list)
+        self.assertEqual(sorted(['index.html', 'page.htm', os.path.join(self.folderName, 'nested.htm'),
+                                 os.path.join('drafts', 'draft.htm'), os.path.join('drafts', 'deep', 'old.html')]),
+                         sorted(fileList))
+
+    def test_include(self):
+        fileList = xmlsrr.getFileList(self.targetFolder, include=['*.png', '*.bak'])
+        self.assertEqual(['image.png', 'notes.htm.bak'], sorted(fileList))
+
+    def test_exclude_folder(self):
+        fileList = xmlsrr.getFileList(self.targetFolder, exclude=['drafts'])
+        self.assertEqual(sorted(['index.html', 'page.htm', os.path.join(self.folderName, 'nested.htm')]),
+                         sorted(fileList))
+
+    def test_exclude_path(self):
+        fileList = xmlsrr.getFileList(self.targetFolder, exclude=['drafts/deep/*', 'index.*'])
+        self.assertEqual(sorted(['page.htm', os.path.join(self.folderName, 'nested.htm'),
+                                 os.path.join('drafts', 'draft.htm')]), sorted(fileList))
+
+
+class TestProcessStream(unittest.TestCase):
+    xmlText = b'<?xml version="1.0"?><!--feed--><feed>start<item id="first" class="a b">one<title>Title</title>tail<img src="x"/></item>\n<item class="b"><title>Other</title><!-- note --><img/>end</item><?done?></feed>'
+
+    def streamResult(self, lines):
+        instructions = [instructionSet.InstructionSet(line) for line in lines]
+        output = BytesIO()
+        hits = []
+        changed = xmlsrr.processStream(BytesIO(self.xmlText), output, instructions, hits=hits.append)
+        return changed, output.getvalue(), hits
+
+    def treeResult(self, lines, counts=None, hits=None):
+        instructions = [instructionSet.InstructionSet(line) for line in lines]
+        tree = etree.parse(BytesIO(self.xmlText), xmlsrr.newParser('xml'))
+        xmlsrr.processDocument(tree.getroot(), instructions, counts=counts, hits=hits)
+        return xmlsrr.serializeTree(tree)
+
+    def test_matches_tree(self):
+        for lines in [['/img'], ['/item'], ['item.a title -> h1'], ['.b -> .c', '/.c img'], ['/[src]'], ['feed'],
+                      ['item title', 'item img', '/item', 'title'], ['feed [src]', '/.a', '.b -> .a', 'img']]:
+            counts = [0] * len(lines)
+            hits = []
+            treeOutput = self.treeResult(lines, counts, hits.append)
+            instructions = [instructionSet.InstructionSet(line) for line in lines]
+            streamCounts = [0] * len(lines)
+            streamHits = []
+            output = BytesIO()
+            xmlsrr.processStream(BytesIO(self.xmlText), output, instructions, streamCounts, streamHits.append)
+            self.assertEqual(treeOutput, output.getvalue(), lines)
+            self.assertEqual(counts, streamCounts, lines)
+            # The tree engine can find the hits of each instruction in turn, the stream finds them in document order
+            self.assertEqual(sorted((hit['instruction'], hit['line'], hit['tag'], sorted(hit['attributes'].items()))
+                                    for hit in hits),
+                             sorted((hit['instruction'], hit['line'], hit['tag'], sorted(hit['attributes'].items()))
+                                    for hit in streamHits), lines)
+
+    def test_changed(self):
+        self.assertFalse(self.streamResult(['item', 'title'])[0])
+        self.assertTrue(self.streamResult(['/title'])[0])
+
+    def test_hits(self):
+        changed, output, hits = self.streamResult(['title', '/img'])
+        self.assertEqual(['/feed[1]/item[1]/title[1]', '/feed[1]/item[2]/title[1]'], [hit['path'] for hit in hits])
+        self.assertEqual('title', hits[0]['tag'])
+
+    def test_prolog_and_epilog(self):
+        for text in [b'<!DOCTYPE feed SYSTEM "feed.dtd"><!--c--><?p x?><feed><ad/></feed><!-- end --><?done?>',
+                     b'<!DOCTYPE feed PUBLIC "-//Feed//EN" "feed.dtd"><feed>&co; <ad/>&a;&b;<x>&c;</x></feed>',
+                     b'<!--c--><!DOCTYPE feed SYSTEM "feed.dtd"><feed><ad/></feed><!-- end -->']:
+            self.xmlText = text
+            for lines in [['/ad'], ['x']]:
+                self.assertEqual(self.treeResult(lines), self.streamResult(lines)[1], (text, lines))
+
+    def test_internal_subset_not_streamed(self):
+        self.xmlText = b'<!DOCTYPE feed [<!ENTITY co "ACME">]><feed a="&co;">&co; <ad/></feed>'
+        output = BytesIO()
+        self.assertRaises(xmlsrr.NotStreamable, xmlsrr.processStream, BytesIO(self.xmlText), output,
+                          [instructionSet.InstructionSet('/ad')])
+        self.assertEqual(b'', output.getvalue())
+        targetFolder = tempfile.mkdtemp()
+        with open(os.path.join(targetFolder, 'feed.xml'), 'wb') as f:
+            f.write(self.xmlText)
+        result = xmlsrr.processFile(targetFolder, 'feed.xml', [instructionSet.InstructionSet('/ad')], streamSize=0,
+                                    format='xml')
+        self.assertEqual([1], result['matches'])
+        with open(os.path.join(targetFolder, 'feed.xml'), 'rb') as f:
+            written = f.read()
+        self.assertIn(b'<!ENTITY co "ACME">', written)
+        self.assertIn(b'<feed a="&co;">&co; </feed>', written)
+        shutil.rmtree(targetFolder)
+
+    def test_stream_file(self):
+        targetFolder = tempfile.mkdtemp()
+        with open(os.path.join(targetFolder, 'feed.xml'), 'wb') as f:
+            f.write(self.xmlText)
+        instructions = [instructionSet.InstructionSet('/img')]
+        result = xmlsrr.processFile(targetFolder, 'feed.xml', instructions, streamSize=0, format='auto')
+        self.assertEqual([2], result['matches'])
+        self.assertTrue(result['changed'])
+        with open(os.path.join(targetFolder, 'feed.xml'), 'rb') as f:
+            self.assertEqual(self.treeResult(['/img']), f.read())
+        self.assertEqual(['feed.xml'], os.listdir(targetFolder))
+        shutil.rmtree(targetFolder)
+
+
+class TestXmlFormat(unittest.TestCase):
+    xmlText = b'<?xml version="1.0" encoding="UTF-8"?>\n<!--feed-->\n<feed xmlns="urn:feed" xmlns:m="urn:media"><item class="a"><m:img/><img/></item></feed>'
+
+    def test_file_format(self):
+        self.assertEqual('html', xmlsrr.fileFormat('page.HTM', 'auto'))
+        self.assertEqual('xml', xmlsrr.fileFormat('feed.xml', 'auto'))
+        self.assertEqual('xml', xmlsrr.fileFormat('page.htm', 'xml'))
+
+    def test_namespaced_names(self):
+        root = etree.fromstring(self.xmlText)
+        counts = [0, 0, 0]
+        instructions = [instructionSet.InstructionSet(line) for line in ['img', 'm:img', 'feed item.a']]
+        xmlsrr.processDocument(root, instructions, counts=counts)
+        self.assertEqual([2, 1, 1], counts)
+
+    def test_replace_keeps_namespace(self):
+        root = etree.fromstring(self.xmlText)
+        instructions = [instructionSet.InstructionSet('item -> entry'), instructionSet.InstructionSet('m:img -> m:thumbnail')]
+        xmlsrr.processDocument(root, instructions)
+        self.assertEqual(['{urn:feed}feed', '{urn:feed}entry', '{urn:media}thumbnail', '{urn:feed}img'],
+                         [element.tag for element in root.iter()])
+
+    def test_process_file(self):
+        targetFolder = tempfile.mkdtemp()
+        with open(os.path.join(targetFolder, 'feed.xml'), 'wb') as f:
+            f.write(self.xmlText)
+        result = xmlsrr.processFile(targetFolder, 'feed.xml', [instructionSet.InstructionSet('/m:img')], format='xml')
+        self.assertEqual([1], result['matches'])
+        with open(os.path.join(targetFolder, 'feed.xml'), 'rb') as f:
+            self.assertEqual(b"<?xml version='1.0' encoding='UTF-8'?>\n<!--feed--><feed xmlns=\"urn:feed\" "
+                             b"xmlns:m=\"urn:media\"><item class=\"a\"><img/></item></feed>", f.read())
+        shutil.rmtree(targetFolder)
+
+    def test_declaration_kept(self):
+        targetFolder = tempfile.mkdtemp()
+        for text, expected in [(b'<feed><img/></feed>', b'<feed/>'),
+                               (b'<?xml version="1.0" encoding="ISO-8859-1" standalone="yes"?>\n<feed>caf\xe9<img/></feed>',
+                                b"<?xml version='1.0' encoding='ISO-8859-1' standalone='yes'?>\n<feed>caf\xe9</feed>")]:
+            for streamSize in None, 0:
+                with open(os.path.join(targetFolder, 'feed.xml'), 'wb') as f:
+                    f.write(text)
+                xmlsrr.processFile(targetFolder, 'feed.xml', [instructionSet.InstructionSet('/img')], format='xml',
+                                   streamSize=streamSize)
+                with open(os.path.join(targetFolder, 'feed.xml'), 'rb') as f:
+                    self.assertEqual(expected, f.read(), (text, streamSize))
+        shutil.rmtree(targetFolder)
+
+    def test_entities_not_resolved(self):
+        targetFolder = tempfile.mkdtemp()
+        with open(os.path.join(targetFolder, 'secret.txt'), 'w') as f:
+            f.write('secret')
+        with open(os.path.join(targetFolder, 'feed.xml'), 'w') as f:
+            f.write('<!DOCTYPE feed [<!ENTITY e SYSTEM "secret.txt">]><feed><item>&e;</item></feed>')
+        xmlsrr.processFile(targetFolder, 'feed.xml', [instructionSet.InstructionSet('item -> entry')], format='xml')
+        with open(os.path.join(targetFolder, 'feed.xml')) as f:
+            self.assertIn('<entry>&e;</entry>', f.read())
+        shutil.rmtree(targetFolder)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
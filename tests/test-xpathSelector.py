@@ -0,0 +1,86 @@
+# coding=utf-8
+import unittest
+from lxml import html
+from lxml import etree
+import xmlsrr
+import instructionSet
+import xpathSelector
+
+
+class TestXpathLiteral(unittest.TestCase):
+    def test_plain_value(self):
+        self.assertEqual("'red'", xpathSelector.xpathLiteral('red'))
+
+    def test_single_quote(self):
+        self.assertEqual('"it\'s"', xpathSelector.xpathLiteral("it's"))
+
+    def test_both_quotes(self):
+        literal = xpathSelector.xpathLiteral('a\'b"c')
+        self.assertEqual('a\'b"c', etree.XPath('string({0})'.format(literal))(etree.Element('x')))
+
+
+class TestCompileSelector(unittest.TestCase):
+    def test_invalid_attribute(self):
+        instruction = instructionSet.InstructionSet('[on click]')
+        self.assertRaises(ValueError, xpathSelector.compileSelector, instruction)
+
+    def test_compile_instructions(self):
+        instructions = [instructionSet.InstructionSet('p.red'), instructionSet.InstructionSet('div p')]
+        xpathSelector.compileInstructions(instructions)
+        for instruction in instructions:
+            self.assertIsInstance(instruction.xpath, xpathSelector.SelectorQuery)
+
+    def test_linear_expressions(self):
+        lengths = [sum(len(expression) for expression in
+                       xpathSelector.selectorExpressions(instructionSet.InstructionSet(' '.join(['div.a'] * links))))
+                   for links in range(1, 9)]
+        growth = [second - first for first, second in zip(lengths, lengths[1:])]
+        self.assertEqual(1, len(set(growth[1:])))
+
+
+class TestBackendsMatch(unittest.TestCase):
+    documents = [
+        '<html><body><p id="someName" class="awesome time">Some Text</p><p class="sibling">sibling <em>text</em></p></body></html>',
+        '<html><body><div class="a"><div class="b"><p class="a">one <em>two</em></p></div></div><p>three</p></body></html>',
+        '<html><body><div><p>one<p>two</p></p><span><div><p class="x  y">three</p></div></span></div></body></html>',
+        '<html><body><!-- comment --><img src="a.png" class="thumbnail"/><img class="thumbnail"/><img src=""/></body></html>',
+        '<p class="a b">fragment <em lang="en-us">text</em></p>',
+        '<html><body><div class="a"><span><div><div class="a"><em>one</em></div></div></span></div></body></html>',
+        '<div><p class="a\tb">one</p><p class="\nb\r\na ">two</p></div>',
+    ]
+    selectors = ['p', '.a', '#someName', '[src]', '[lang=en-us]', 'img.thumbnail[src]', 'div p', 'div div p', '.a .a',
+                 'div p em', 'body .y', 'span div', 'div.a div', '.a.b', 'div div div p', 'body div .a p em',
+                 '.a div .a em']
+
+    def assertBackendsMatch(self, instructions):
+        for document in self.documents:
+            pythonResult = xmlsrr.processInstructionList(html.fromstring(document), instructions)
+            xpathSelector.compileInstructions(instructions)
+            xpathResult = xmlsrr.processInstructionList(html.fromstring(document), instructions, 'xpath')
+            self.assertEqual(etree.tostring(pythonResult), etree.tostring(xpathResult), document)
+
+    def test_matched_elements(self):
+        # Mark every match so the compared documents show which elements each backend selected
+        for selector in self.selectors:
+            self.assertBackendsMatch([instructionSet.InstructionSet(selector + ' -> [data-hit=1]')])
+
+    def test_removed_elements(self):
+        for selector in self.selectors:
+            self.assertBackendsMatch([instructionSet.InstructionSet('/' + selector)])
+
+    def test_instruction_list(self):
+        instructions = ['p.a -> .c', '/em', 'div p -> span', '.x -> .z', '[src] -> [alt=image]', 'span -> div', '/div div p']
+        self.assertBackendsMatch([instructionSet.InstructionSet(line) for line in instructions])
+
+    def test_namespaced_names(self):
+        document = b'<feed xmlns="urn:feed" xmlns:m="urn:media"><item><m:img/><img/></item></feed>'
+        for selector in ['img', 'm:img', 'feed img', 'item']:
+            instructions = [instructionSet.InstructionSet(selector + ' -> [data-hit=1]')]
+            pythonResult = xmlsrr.processInstructionList(etree.fromstring(document), instructions)
+            xpathSelector.compileInstructions(instructions)
+            xpathResult = xmlsrr.processInstructionList(etree.fromstring(document), instructions, 'xpath')
+            self.assertEqual(etree.tostring(pythonResult), etree.tostring(xpathResult), selector)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1 +1,13 @@
-# coding=utf-8
\ No newline at end of file
+# coding=utf-8
+"""
+Search, remove, and replace content in a set of XML documents, see RuleSet to use it from other programs
+"""
+__all__ = ['RuleSet']
+
+
+def __getattr__(name):
+    # Importing the package, as python -m xmlsrr does, shouldn't import lxml before a document is processed
+    if name == 'RuleSet':
+        from .ruleSet import RuleSet
+        return RuleSet
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
@@ -0,0 +1,5 @@
+# coding=utf-8
+import sys
+from .xmlsrr import main
+
+sys.exit(main())
@@ -0,0 +1,143 @@
+# coding=utf-8
+"""
+Parse each distinct instruction once, and keep parsed instruction files in a cache folder between runs
+"""
+import gc
+import json
+import logging
+import os
+try:
+    from . import instructionSet, outputTree
+except ImportError:
+    import instructionSet
+    import outputTree
+
+# Bumped whenever parsed instructions change shape, so older cache files are never loaded
+cacheVersion = 3
+
+
+def parseLines(lines):
+    """
+    Parse instruction lines, identical lines share the same InstructionSet
+    """
+    parsed = {}
+    instructions = []
+    for line in lines:
+        source = line.strip()
+        if source not in parsed:
+            parsed[source] = instructionSet.InstructionSet(line)
+        instructions.append(parsed[source])
+    return instructions
+
+
+def cachePath(cacheFolder, lines):
+    # Loading OpenSSL for hashlib is a noticeable part of starting up, and only runs with a cache need it
+    import hashlib
+    digest = hashlib.sha256('{0}\n'.format(cacheVersion).encode('utf-8'))
+    for line in lines:
+        digest.update(line.strip().encode('utf-8') + b'\n')
+    return os.path.join(cacheFolder, 'instructions-{0}.json'.format(digest.hexdigest()))
+
+
+def loadInstructions(lines, cacheFolder=None):
+    """
+    Parse instruction lines, or load them from cacheFolder if the same lines were parsed before
+
+    Cache files are named after the hash of the instructions, so editing the instruction file never loads stale
+    instructions. They only hold plain data, so loading one can't run code. A cache file that can't be read is parsed
+    again and replaced.
+    """
+    if cacheFolder is None:
+        return parseLines(lines)
+    path = cachePath(cacheFolder, lines)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Loading creates a lot of small objects at once, collecting garbage in between only slows it down
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            instructions = loadData(json.loads(data.decode('utf-8')), lines)
+        finally:
+            if collecting:
+                gc.enable()
+        logging.debug("Loaded instructions from cache {0}".format(path))
+        return instructions
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        logging.warning("Unable to load instruction cache {0}: {1}".format(path, error))
+    instructions = parseLines(lines)
+    os.makedirs(cacheFolder, exist_ok=True)
+    outputTree.writeFile(path, json.dumps(dumpData(instructions)).encode('utf-8'))
+    logging.debug("Saved instructions to cache {0}".format(path))
+    return instructions
+
+
+def dumpData(instructions):
+    """
+    Get parsed instructions as data that json can write, each distinct instruction is kept once
+    """
+    records = {}
+    for instruction in instructions:
+        if instruction.source not in records:
+            records[instruction.source] = len(records), {
+                'source': instruction.source, 'mode': instruction.mode, 'pattern': instruction.pattern,
+                'replacePattern': instruction.replacePattern, 'selector': dumpSelector(instruction.selector),
+                'replacement': dumpReplacement(instruction.replacement)}
+    return {'version': cacheVersion, 'instructions': [record for index, record in records.values()],
+            'lines': [records[instruction.source][0] for instruction in instructions]}
+
+
+def dumpSelector(selector):
+    if selector is None:
+        return None
+    return {'elements': sorted(selector.elements), 'classes': sorted(selector.classes), 'ids': sorted(selector.ids),
+            'attributes': [list(attribute) for attribute in selector.attributes],
+            'subMatch': dumpSelector(selector.subMatch)}
+
+
+def dumpReplacement(replacement):
+    if replacement is None:
+        return None
+    return {'element': replacement.element, 'classes': list(replacement.classes), 'id': replacement.id,
+            'attributes': [list(attribute) for attribute in replacement.attributes]}
+
+
+def loadData(data, lines):
+    """
+    Rebuild the instructions written by dumpData, raising ValueError when they aren't the instructions of lines
+    """
+    if data['version'] != cacheVersion:
+        raise ValueError("Cache version {0} isn't {1}".format(data['version'], cacheVersion))
+    parsed = []
+    for record in data['instructions']:
+        instruction = instructionSet.InstructionSet()
+        instruction.source = record['source']
+        instruction.mode = record['mode']
+        instruction.pattern = record['pattern']
+        instruction.replacePattern = record['replacePattern']
+        instruction.selector = loadSelector(record['selector'])
+        instruction.replacement = loadReplacement(record['replacement'])
+        parsed.append(instruction)
+    instructions = [parsed[index] for index in data['lines']]
+    if [instruction.source for instruction in instructions] != [line.strip() for line in lines]:
+        raise ValueError("Cached instructions don't match the instruction file")
+    return instructions
+
+
+def loadSelector(data):
+    if data is None:
+        return None
+    selector = instructionSet.Selector(data['elements'], data['classes'], data['ids'],
+                                       [(name, value) for name, value in data['attributes']],
+                                       loadSelector(data['subMatch']))
+    # Equal selectors are shared, as they are when instructions are parsed
+    return instructionSet.internedSelectors.setdefault(selector, selector)
+
+
+def loadReplacement(data):
+    if data is None:
+        return None
+    return instructionSet.Replacement(data['element'], data['classes'], data['id'],
+                                      [(name, value) for name, value in data['attributes']])
@@ -0,0 +1,232 @@
+# coding=utf-8
+"""
+Check a whole instruction file at once, reporting every problem with its line and column
+
+Besides the syntax errors that stop a run, instructions are checked for parts determinePattern silently drops,
+duplicates, and instructions that can never match because an earlier one removed everything they could match. The
+cost of each instruction on a document is estimated from how xmlsrr.processDocument finds its elements.
+"""
+try:
+    from . import instructionSet
+except ImportError:
+    import instructionSet
+
+# Relative cost of a selector part that visits every element of a document, against one that looks its elements up
+walkCost = 10
+
+
+def checkInstructions(lines):
+    """
+    Check instruction lines, returning the parsed instructions by line number and a list of findings
+
+    Each finding is a dict with the line and column it is about, counted from 1, a severity of error or warning, and a
+    message. Blank lines are skipped but still counted. Lines with errors have no parsed instruction.
+    """
+    findings = []
+    parsed = {}
+    for number, line in enumerate(lines, 1):
+        text = line.rstrip('\r\n')
+        if text.strip() == '':
+            continue
+        lineFindings = syntaxFindings(text)
+        for finding in lineFindings:
+            finding['line'] = number
+        findings.extend(lineFindings)
+        try:
+            instruction = instructionSet.InstructionSet(text)
+        except ValueError as error:
+            if not any(finding['severity'] == 'error' for finding in lineFindings):
+                findings.append(newFinding(number, 1, 'error', str(error) or "Invalid instruction"))
+            continue
+        if not any(finding['severity'] == 'error' for finding in lineFindings):
+            parsed[number] = instruction
+    findings.extend(ruleFindings(parsed))
+    findings.sort(key=lambda finding: (finding['line'], finding['column']))
+    return parsed, findings
+
+
+def newFinding(line, column, severity, message):
+    return {'line': line, 'column': column, 'severity': severity, 'message': message}
+
+
+def syntaxFindings(text):
+    """
+    Find the problems of a single instruction line, following determineType, splitReplacement and determinePattern
+    """
+    findings = []
+    arrow = text.find('->')
+    if text[0] == '/' and arrow > 0:
+        findings.append(newFinding(None, arrow + 1, 'error', "A remove instruction can't also replace"))
+        return findings
+    if text.lstrip()[:1] == '/' and text[0] != '/':
+        findings.append(newFinding(None, 1, 'warning', "Instructions only remove when / is the first character, "
+                                                        "this searches for an element named /"))
+    if arrow == 0:
+        findings.append(newFinding(None, 1, 'error', "Replacement without a pattern to match"))
+        return findings
+    if arrow > 0:
+        second = text.find('->', arrow + 2)
+        if second >= 0:
+            findings.append(newFinding(None, second + 1, 'error', "Only one replacement per instruction"))
+            return findings
+        replacement = text[arrow + 2:]
+        stripped = replacement.strip()
+        space = stripped.find(' ')
+        if space >= 0:
+            column = arrow + 3 + len(replacement) - len(replacement.lstrip()) + space
+            findings.append(newFinding(None, column, 'error', "A replacement can only have one part"))
+            return findings
+        patternFindings(text[:arrow], 0, findings)
+        patternFindings(replacement, arrow + 2, findings, replacement=True)
+    elif text[0] == '/':
+        patternFindings(text[1:], 1, findings)
+    else:
+        patternFindings(text, 0, findings)
+    return findings
+
+
+def patternFindings(pattern, offset, findings, replacement=False):
+    """
+    Scan a pattern like determinePattern does, offset is the number of characters of the line before pattern
+    """
+    if pattern.strip() == '':
+        findings.append(newFinding(None, offset + 1, 'error', "Pattern is empty"))
+        return
+    base = offset + len(pattern) - len(pattern.lstrip()) + 1
+    text = pattern.strip()
+    state = 'element'
+    value = ''
+    bracket = None
+    attributes = 0
+    ids = 0
+    for index, c in enumerate(text):
+        column = base + index
+        if state in ('attributeName', 'attributeValue'):
+            if state == 'attributeName' and c in '=]' and value == '':
+                findings.append(newFinding(None, column, 'error', "Attribute selector without a name"))
+                return
+            if c == '=' and state == 'attributeName':
+                state = 'attributeValue'
+            elif c == ']':
+                state = 'element'
+            else:
+                value += c
+                continue
+            value = ''
+            continue
+        if c in '.#[ ':
+            if state in ('class', 'id') and value == '':
+                findings.append(newFinding(None, column - 1, 'warning', "Empty {0} is ignored".format(state)))
+            if c == '#':
+                ids += 1
+                if replacement and ids == 2:
+                    findings.append(newFinding(None, column, 'warning', "A replacement only sets its first id"))
+            if c == '[':
+                attributes += 1
+                if attributes == 2:
+                    findings.append(newFinding(None, column, 'warning', "Only the last attribute selector of a part "
+                                                                        "is kept, the ones before it are ignored"))
+                bracket = column
+            if c == ' ':
+                if not replacement:
+                    patternFindings(text[index + 1:], column, findings)
+                return
+            state = {'.': 'class', '#': 'id', '[': 'attributeName'}[c]
+            value = ''
+        else:
+            value += c
+    if state in ('attributeName', 'attributeValue'):
+        findings.append(newFinding(None, bracket, 'error', "Attribute selector isn't closed with ]"))
+    elif state in ('class', 'id') and value == '':
+        findings.append(newFinding(None, base + len(text) - 1, 'warning', "Empty {0} is ignored".format(state)))
+
+
+def ruleFindings(parsed):
+    """
+    Find duplicate instructions and instructions that can't match anything left by earlier ones
+    """
+    findings = []
+    seen = {}
+    numbers = sorted(parsed)
+    for position, number in enumerate(numbers):
+        instruction = parsed[number]
+        key = (instruction.mode, instruction.selector, instruction.replacement)
+        if key in seen:
+            findings.append(newFinding(number, 1, 'warning', "Duplicate of line {0}".format(seen[key])))
+            continue
+        seen[key] = number
+        for earlierNumber in reversed(numbers[:position]):
+            earlier = parsed[earlierNumber]
+            if removedBy(instruction, earlier):
+                findings.append(newFinding(number, 1, 'warning', "Can never match, every element it could match was "
+                                                                 "removed by line {0}".format(earlierNumber)))
+                break
+            if earlier.mode == 'replace':
+                # Elements renamed or given new classes could match anything from here on
+                break
+    return findings
+
+
+def removedBy(instruction, earlier) -> bool:
+    """
+    Check whether earlier removed every element instruction could match
+
+    This is only decided when earlier has a single part: each element matching a part of instruction then matched
+    earlier itself, so it was removed along with everything in it. Replacements aren't followed the same way, since
+    elements nested in a matched element aren't matched again and keep their name.
+    """
+    general = earlier.selector
+    if earlier.mode != 'remove' or general.subMatch is not None:
+        return False
+    link = instruction.selector
+    while link is not None:
+        if linkCovers(general, link):
+            return True
+        link = link.subMatch
+    return False
+
+
+def linkCovers(general, specific) -> bool:
+    """
+    Check whether every element matching the selector part specific also matches general
+    """
+    if general.elements and not (specific.elements and specific.elements <= general.elements):
+        return False
+    if not general.classes <= specific.classes:
+        return False
+    if general.ids and not (specific.ids and specific.ids <= general.ids):
+        return False
+    attributes = dict(specific.attributes)
+    for name, value in general.attributes:
+        if name not in attributes or (value != '' and attributes[name] != value):
+            return False
+    return True
+
+
+def instructionCost(instruction):
+    """
+    Estimate the cost of an instruction on a document, along with how the elements of its last part are found
+
+    Parts that xmlsrr.isIndexed can look up cost 1 and parts that visit every element cost walkCost, each part before
+    the last one adds the cost of checking the ancestors of every candidate.
+    """
+    links = 0
+    link = instruction.selector
+    while link.subMatch:
+        links += 1
+        link = link.subMatch
+    if link.elements and not any(':' in name for name in link.elements):
+        strategy = 'element lookup'
+    elif not link.elements and len(link.ids) == 1:
+        strategy = 'id lookup'
+    elif not link.elements and link.classes:
+        strategy = 'class lookup'
+    else:
+        strategy = 'every element'
+    cost = (walkCost if strategy == 'every element' else 1) * (links + 1)
+    return cost, strategy
+
+
+def formatFinding(source, finding):
+    return '{0}:{1}:{2}: {3}: {4}'.format(source, finding['line'], finding['column'], finding['severity'],
+                                          finding['message'])
@@ -1,6 +1,11 @@
 # coding=utf-8
 import logging
 
+# Compiled selectors by their text, and each distinct selector by itself, so equal selectors are shared
+selectorCache = {}
+internedSelectors = {}
+replacementCache = {}
+
 
 class InstructionSet:
     """
@@ -12,13 +17,45 @@ class InstructionSet:
             self.parseInstruction(instruction)
 
     def parseInstruction(self, instruction):
+        self.source = instruction.strip()
         self.mode = determineType(instruction)
+        self.replacePattern = None
+        self.replacement = None
         if self.mode == 'replace':
-            self.match, self.replace = determineReplacement(instruction)
+            self.pattern, self.replacePattern = splitReplacement(instruction)
+            self.replacement = cachedReplacement(self.replacePattern)
         elif self.mode == 'remove':
-            self.match = determinePattern(instruction[1:])
+            self.pattern = instruction[1:]
         else:
-            self.match = determinePattern(instruction)
+            self.pattern = instruction
+        self.selector = cachedSelector(self.pattern)
+
+    @property
+    def match(self):
+        """
+        The selector as parsed by determinePattern
+        """
+        return determinePattern(self.pattern)
+
+    @property
+    def replace(self):
+        return determinePattern(self.replacePattern) if self.replacePattern is not None else None
+
+    def describe(self):
+        """
+        Get the parsed instruction as plain data, with the subMatch chain expanded
+        """
+        description = {'mode': self.mode, 'match': describePattern(self.match)}
+        if self.mode == 'replace':
+            description['replace'] = describePattern(self.replace)
+        return description
+
+
+def describePattern(match):
+    description = dict(match)
+    if match['subMatch']:
+        description['subMatch'] = describePattern(match['subMatch'].match)
+    return description
 
 
 def determineType(instruction):
@@ -40,14 +77,107 @@ def determineType(instruction):
 
 
 def determineReplacement(instruction):
+    search, replace = splitReplacement(instruction)
+    searchInstruction = determinePattern(search)
+    replaceInstruction = determinePattern(replace)
+    return searchInstruction, replaceInstruction
+
+
+def splitReplacement(instruction):
     if len(instruction.split('->')) != 2:
         raise ValueError("Only one replacement per instruction")
     if len(instruction.split('->')[1].strip().split(' ')) > 1:
         raise ValueError("Replacement can only specify one match")
     search, replace = instruction.split('->')
-    searchInstruction = determinePattern(search)
-    replaceInstruction = determinePattern(replace)
-    return searchInstruction, replaceInstruction
+    return search, replace
+
+
+class Selector:
+    """
+    Compiled form of a pattern from determinePattern that elements are matched against
+
+    Selectors are immutable and hashable, so equal selectors can be shared. An element matches when its tag is one of
+    elements, it has every one of classes, its id is one of ids and it has each of attributes, given as (name, value)
+    pairs where an empty value only requires the attribute to be set. Empty sets match anything. subMatch is the
+    Selector the descendants of a matching element are matched against next, or None at the end of the chain.
+    """
+    __slots__ = ('elements', 'classes', 'ids', 'attributes', 'subMatch', 'hash')
+
+    def __init__(self, elements=(), classes=(), ids=(), attributes=(), subMatch=None):
+        object.__setattr__(self, 'elements', frozenset(elements))
+        object.__setattr__(self, 'classes', frozenset(classes))
+        object.__setattr__(self, 'ids', frozenset(ids))
+        object.__setattr__(self, 'attributes', tuple(attributes))
+        object.__setattr__(self, 'subMatch', subMatch)
+        object.__setattr__(self, 'hash', hash((self.elements, self.classes, self.ids, self.attributes, subMatch)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Selectors can't be changed")
+
+    def __delattr__(self, name):
+        raise AttributeError("Selectors can't be changed")
+
+    def __eq__(self, other):
+        return isinstance(other, Selector) and self.hash == other.hash and self.elements == other.elements \
+            and self.classes == other.classes and self.ids == other.ids and self.attributes == other.attributes \
+            and self.subMatch == other.subMatch
+
+    def __hash__(self):
+        return self.hash
+
+    def __reduce__(self):
+        return Selector, (self.elements, self.classes, self.ids, self.attributes, self.subMatch)
+
+
+class Replacement:
+    """
+    Compiled form of the replacement pattern of an instruction, classes are kept in the order they were given
+    """
+    __slots__ = ('element', 'classes', 'id', 'attributes')
+
+    def __init__(self, element=None, classes=(), id=None, attributes=()):
+        object.__setattr__(self, 'element', element)
+        object.__setattr__(self, 'classes', tuple(classes))
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'attributes', tuple(attributes))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Replacements can't be changed")
+
+    def __reduce__(self):
+        return Replacement, (self.element, self.classes, self.id, self.attributes)
+
+
+def cachedSelector(pattern):
+    """
+    Compile a pattern into a Selector, parsing each distinct pattern only once
+
+    Since determinePattern parses the subMatch chain through InstructionSet, the tail of a selector is shared too.
+    """
+    key = pattern.strip()
+    if key not in selectorCache:
+        selector = selectorFromPattern(determinePattern(pattern))
+        selectorCache[key] = internedSelectors.setdefault(selector, selector)
+    return selectorCache[key]
+
+
+def cachedReplacement(pattern):
+    key = pattern.strip()
+    if key not in replacementCache:
+        replacementCache[key] = replacementFromPattern(determinePattern(pattern))
+    return replacementCache[key]
+
+
+def selectorFromPattern(match):
+    subMatch = match['subMatch'].selector if match['subMatch'] else None
+    return Selector(match['elements'] or (), match['classes'] or (), match['ids'] or (),
+                    match['attributes'].items() if match['attributes'] else (), subMatch)
+
+
+def replacementFromPattern(match):
+    return Replacement(match['elements'][0] if match['elements'] else None, match['classes'] or (),
+                       match['ids'][0] if match['ids'] else None,
+                       match['attributes'].items() if match['attributes'] else ())
 
 
 def determinePattern(instruction):
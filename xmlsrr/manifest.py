@@ -0,0 +1,96 @@
+# coding=utf-8
+"""
+Remember the state of processed files so unchanged files can be skipped on the next run
+"""
+import hashlib
+import json
+import os
+import sqlite3
+
+
+class Manifest:
+    """
+    SQLite index of the size, mtime and content hash of each file after it was processed, along with the hash of the
+    instructions it was processed with
+    """
+
+    def __init__(self, path, instructions, batchSize=1000):
+        """
+        Changes are committed every batchSize updates, or only when closing if batchSize is None
+        """
+        self.instructionHash = instructionHash(instructions)
+        self.batchSize = batchSize
+        self.pending = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, '
+                                'mtime INTEGER, hash TEXT, instructions TEXT)')
+
+    def lookup(self, name):
+        """
+        Get the recorded state of a file, or None if it wasn't processed with the current instructions
+        """
+        row = self.connection.execute('SELECT size, mtime, hash, instructions FROM files WHERE name = ?',
+                                      (name,)).fetchone()
+        if row is None or row[3] != self.instructionHash:
+            return None
+        return {'size': row[0], 'mtime': row[1], 'hash': row[2]}
+
+    def update(self, name, state):
+        if state is None:
+            self.connection.execute('DELETE FROM files WHERE name = ?', (name,))
+        else:
+            self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                    (name, state['size'], state['mtime'], state['hash'], self.instructionHash))
+        self.pending += 1
+        if self.batchSize and self.pending >= self.batchSize:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self, commit=True):
+        if commit:
+            self.connection.commit()
+        else:
+            self.connection.rollback()
+        self.connection.close()
+
+
+def defaultPath(folder):
+    # Next to the folder rather than inside it, so it is never picked up as a file to process
+    return os.path.normpath(folder) + '.xmlsrr-manifest'
+
+
+def fileState(path, data=None):
+    """
+    Get the size, mtime and content hash of a file, data is used for the hash when the content is already in memory
+    """
+    stat = os.stat(path)
+    if data is None:
+        digest = fileHash(path)
+    else:
+        digest = hashlib.sha256(data).hexdigest()
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest}
+
+
+def fileHash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def isUnchanged(path, state) -> bool:
+    """
+    Check a file against its recorded state, only hashing the content when the size matches but the mtime doesn't
+    """
+    stat = os.stat(path)
+    if stat.st_size != state['size']:
+        return False
+    if stat.st_mtime_ns == state['mtime']:
+        return True
+    return fileHash(path) == state['hash']
+
+
+def instructionHash(instructions):
+    description = json.dumps([instruction.describe() for instruction in instructions], sort_keys=True)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
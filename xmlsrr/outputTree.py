@@ -0,0 +1,281 @@
+# coding=utf-8
+"""
+Build an output folder next to the target without copying the whole tree up front
+
+Processed files are written straight into a staging folder created next to the output folder, other files are linked
+or copied into it, and the staging folder only replaces the output folder once the run is done.
+"""
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import tempfile
+
+# ioctl request to clone a file's extents on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+# Files written with the batch durability policy between two syncs
+batchSize = 256
+# Paths this process wrote with the batch policy since the last sync
+batchState = {'unsynced': []}
+# Written into every output folder, only folders holding it are replaced without --force
+markerName = '.xmlsrr-output'
+# Temporary files are created owner-only, new files get the usual permissions instead
+umask = os.umask(0)
+os.umask(umask)
+
+
+def createStaging(outputFolder, sourceFolder):
+    outputFolder = os.path.normpath(os.path.abspath(outputFolder))
+    stagingFolder = tempfile.mkdtemp(prefix='.{0}.'.format(os.path.basename(outputFolder)), suffix='.partial',
+                                     dir=os.path.dirname(outputFolder))
+    # mkdtemp only allows the owner in, the output should have the permissions of the source folder
+    shutil.copymode(sourceFolder, stagingFolder)
+    return stagingFolder
+
+
+def isReplaceable(outputFolder) -> bool:
+    """
+    Check whether outputFolder can be replaced by a new output: it doesn't exist, is empty or was written by xmlsrr
+    """
+    if not os.path.isdir(outputFolder):
+        return not os.path.lexists(outputFolder)
+    return not os.listdir(outputFolder) or os.path.isfile(os.path.join(outputFolder, markerName))
+
+
+def commitStaging(stagingFolder, outputFolder, durability='none', force=False):
+    """
+    Put the staging folder in place of the output folder, removing the previous output if there was one
+
+    An existing output folder is only removed when isReplaceable allows it or force is set, otherwise ValueError is
+    raised and the staging folder is left for the caller to discard.
+    """
+    if not force and not isReplaceable(outputFolder):
+        raise ValueError("Output folder {0} wasn't written by xmlsrr, it is only replaced with --force".format(
+            outputFolder))
+    open(os.path.join(stagingFolder, markerName), 'w').close()
+    if durability != 'none':
+        # Everything in the staging folder has to be on disk before it becomes the output, including what workers
+        # wrote and the assets brought in
+        syncPending(stagingFolder)
+    if not os.path.exists(outputFolder):
+        os.rename(stagingFolder, outputFolder)
+    else:
+        previousFolder = stagingFolder[:-len('.partial')] + '.previous'
+        os.rename(outputFolder, previousFolder)
+        os.rename(stagingFolder, outputFolder)
+        shutil.rmtree(previousFolder)
+    if durability != 'none':
+        syncFolder(os.path.dirname(os.path.abspath(outputFolder)))
+
+
+def writeFile(path, data, durability='none', hardlinks='break'):
+    """
+    Write data to path through a temporary file in the same folder, so the file is never left half written
+
+    With the each durability policy the file and its folder are synced before returning. With batch, everything
+    written is synced every batchSize files and when syncPending is called at the end of the run. See commitTemporary
+    for hardlinks.
+    """
+    f, temporaryPath = createTemporary(path)
+    try:
+        f.write(data)
+        commitTemporary(f, temporaryPath, path, durability, hardlinks)
+    except BaseException:
+        discardTemporary(f, temporaryPath)
+        raise
+
+
+def createTemporary(path):
+    """
+    Open a temporary file in the folder of path to write its new content to, the folder of the file a link points to
+    """
+    path = os.path.realpath(path)
+    descriptor, temporaryPath = tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(path)), suffix='.tmp',
+                                                 dir=os.path.dirname(path))
+    return os.fdopen(descriptor, 'wb'), temporaryPath
+
+
+def commitTemporary(f, temporaryPath, path, durability='none', hardlinks='break'):
+    """
+    Close a temporary file from createTemporary and move it in place of path, see writeFile
+
+    Symbolic links are followed, the file they point to is replaced and the links are left as they are. The new file
+    keeps the mode of the file it replaces, and its owner and group where this process may set them. Hard links are
+    broken: path gets a file of its own and the other links keep the old content. With hardlinks set to keep, a file
+    with other hard links is overwritten in place instead, so every link sees the new content, at the cost of a reader
+    possibly seeing it half written. Files in an output folder are never overwritten in place, since they are linked
+    to the source files, see isOutputFile.
+    """
+    path = os.path.realpath(path)
+    if durability == 'each':
+        f.flush()
+        os.fsync(f.fileno())
+    f.close()
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        status = None
+    if status is None:
+        os.chmod(temporaryPath, 0o666 & ~umask)
+        os.replace(temporaryPath, path)
+    elif status.st_nlink > 1 and hardlinks == 'keep' and not isOutputFile(path):
+        overwriteFile(temporaryPath, path, durability)
+    else:
+        # Changing the owner can clear setuid and setgid bits, so the mode comes after it
+        keepOwner(temporaryPath, status)
+        os.chmod(temporaryPath, stat.S_IMODE(status.st_mode))
+        os.replace(temporaryPath, path)
+    if durability == 'each':
+        syncFolder(os.path.dirname(path))
+    elif durability == 'batch':
+        batchState['unsynced'].append(path)
+        if len(batchState['unsynced']) >= batchSize:
+            syncPending()
+
+
+def isOutputFile(path) -> bool:
+    """
+    Check whether path is in an output folder written by xmlsrr, where unchanged files are links to the source files
+    """
+    folder = os.path.dirname(path)
+    while True:
+        if os.path.isfile(os.path.join(folder, markerName)):
+            return True
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return False
+        folder = parent
+
+
+def overwriteFile(temporaryPath, path, durability):
+    """
+    Copy the content of a temporary file over path and remove the temporary file
+    """
+    with open(temporaryPath, 'rb') as source, open(path, 'r+b') as destination:
+        shutil.copyfileobj(source, destination)
+        destination.truncate()
+        if durability == 'each':
+            destination.flush()
+            os.fsync(destination.fileno())
+    os.remove(temporaryPath)
+
+
+def keepOwner(temporaryPath, status):
+    """
+    Give a temporary file the owner and group of the file it replaces, as far as this process is allowed to
+    """
+    temporary = os.stat(temporaryPath)
+    if (status.st_uid, status.st_gid) == (temporary.st_uid, temporary.st_gid):
+        return
+    try:
+        os.chown(temporaryPath, status.st_uid, status.st_gid)
+    except PermissionError:
+        # Other users can only be given files by root, the group can still be kept if this user is in it
+        try:
+            os.chown(temporaryPath, -1, status.st_gid)
+        except PermissionError:
+            pass
+
+
+def discardTemporary(f, temporaryPath):
+    f.close()
+    if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+
+
+def syncPending(folder=None):
+    """
+    Sync the files this process wrote with the batch policy along with their folders
+
+    With folder, the whole file system holding it is synced as well, which covers files written by other processes.
+    """
+    paths = batchState['unsynced']
+    batchState['unsynced'] = []
+    for path in paths:
+        try:
+            descriptor = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+    for parent in sorted(set(os.path.dirname(path) for path in paths)):
+        if os.path.isdir(parent):
+            syncFolder(parent)
+    if folder is not None:
+        syncFileSystem(folder)
+
+
+def syncFileSystem(folder):
+    """
+    Sync the file system holding folder with syncfs, or every file system where syncfs isn't available
+    """
+    # Only runs syncing a whole file system need ctypes, loading it up front would slow down every start
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'syncfs'):
+        os.sync()
+        return
+    descriptor = os.open(folder, os.O_RDONLY)
+    try:
+        if libc.syncfs(descriptor) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), folder)
+    finally:
+        os.close(descriptor)
+
+
+def syncFolder(folder):
+    descriptor = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def discardStaging(stagingFolder):
+    shutil.rmtree(stagingFolder, ignore_errors=True)
+
+
+def copyAsset(sourceFolder, destinationFolder, name, mode='link'):
+    """
+    Bring a file that isn't processed into the destination folder
+
+    mode is one of link (hardlink), reflink (copy-on-write clone) or copy, links and clones fall back to a copy when
+    the file system doesn't support them.
+    """
+    source = os.path.join(sourceFolder, name)
+    destination = os.path.join(destinationFolder, name)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), destination)
+        return
+    if mode == 'link':
+        try:
+            os.link(source, destination)
+            return
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    elif mode == 'reflink':
+        try:
+            cloneFile(source, destination)
+            return
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOTSUP, errno.ENOTTY, errno.EOPNOTSUPP):
+                raise
+    shutil.copy2(source, destination)
+
+
+def cloneFile(source, destination):
+    with open(source, 'rb') as sourceFile, open(destination, 'wb') as destinationFile:
+        try:
+            fcntl.ioctl(destinationFile.fileno(), FICLONE, sourceFile.fileno())
+        except OSError:
+            destinationFile.close()
+            os.remove(destination)
+            raise
+    shutil.copystat(source, destination)
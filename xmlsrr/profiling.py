@@ -0,0 +1,112 @@
+# coding=utf-8
+"""
+Collect the time spent on each file and instruction, and cProfile statistics, across worker processes
+
+Timings and statistics are gathered where files are processed and returned with the result of each file, so they come
+back to the parent process the same way whether files are processed there or in workers.
+"""
+import cProfile
+import csv
+import json
+import pstats
+
+phases = ['total', 'parse', 'match', 'mutate', 'serialize']
+
+
+def newTimings(instructions):
+    """
+    Start the timings of one file, in seconds for each phase and for each instruction
+
+    Files processed while they are parsed (see xmlsrr.processStream) only have a total.
+    """
+    timings = dict.fromkeys(phases, 0.0)
+    timings['instructions'] = [0.0] * len(instructions)
+    return timings
+
+
+class TimingReport:
+    """
+    Add up the timings of each file for a summary and a report of every file and instruction
+    """
+
+    def __init__(self, instructions):
+        self.sources = [instruction.source for instruction in instructions]
+        self.files = []
+        self.phases = dict.fromkeys(phases, 0.0)
+        self.instructionTimes = [0.0] * len(instructions)
+        self.instructionMatches = [0] * len(instructions)
+
+    def add(self, name, timings, matches):
+        record = {phase: timings[phase] for phase in phases}
+        record['file'] = name
+        record['matches'] = sum(matches)
+        self.files.append(record)
+        for phase in phases:
+            self.phases[phase] += timings[phase]
+        for index, seconds in enumerate(timings['instructions']):
+            self.instructionTimes[index] += seconds
+            self.instructionMatches[index] += matches[index]
+
+    def instructions(self):
+        return [{'instruction': source, 'seconds': seconds, 'matches': matches}
+                for source, seconds, matches in zip(self.sources, self.instructionTimes, self.instructionMatches)]
+
+    def summary(self, limit=10):
+        """
+        Get the lines of a table with the time spent in each phase and on the slowest files and instructions
+        """
+        lines = ['{0:>10}  {1}'.format('seconds', 'phase')]
+        lines.extend('{0:>10.4f}  {1}'.format(self.phases[phase], phase) for phase in phases)
+        lines.append('{0:>10}  {1:>8}  {2}'.format('seconds', 'matches', 'file'))
+        for record in sorted(self.files, key=lambda record: record['total'], reverse=True)[:limit]:
+            lines.append('{0:>10.4f}  {1:>8}  {2}'.format(record['total'], record['matches'], record['file']))
+        lines.append('{0:>10}  {1:>8}  {2}'.format('seconds', 'matches', 'instruction'))
+        for record in sorted(self.instructions(), key=lambda record: record['seconds'], reverse=True)[:limit]:
+            lines.append('{0:>10.4f}  {1:>8}  {2}'.format(record['seconds'], record['matches'],
+                                                         record['instruction']))
+        return lines
+
+    def write(self, stream, format='json'):
+        if format == 'csv':
+            writer = csv.writer(stream)
+            writer.writerow(['type', 'name', 'matches'] + phases)
+            for record in self.files:
+                writer.writerow(['file', record['file'], record['matches']] + [record[phase] for phase in phases])
+            for record in self.instructions():
+                writer.writerow(['instruction', record['instruction'], record['matches'], record['seconds']])
+        else:
+            json.dump({'phases': self.phases, 'files': self.files, 'instructions': self.instructions()}, stream,
+                      indent=2, sort_keys=True)
+            stream.write('\n')
+
+
+class CollectedStats:
+    """
+    Profile statistics sent back by a worker, in the form pstats.Stats loads them from a profiler
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def profileCall(function, *args, **kwargs):
+    """
+    Run function under cProfile, returning its result and the raw statistics, which can be pickled
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args, **kwargs)
+    profiler.create_stats()
+    return result, profiler.stats
+
+
+def mergeStats(collected, stats):
+    """
+    Add raw statistics from profileCall or a profiler to the pstats.Stats in collected, which may be None
+    """
+    if collected is None:
+        return pstats.Stats(CollectedStats(stats))
+    collected.add(CollectedStats(stats))
+    return collected
@@ -0,0 +1,65 @@
+# coding=utf-8
+"""
+Apply instructions from other programs, compiling them once for any number of documents
+"""
+import os
+from lxml import etree
+from . import instructionSet, xmlsrr, xpathSelector
+
+
+class RuleSet:
+    """
+    Instructions compiled once and applied to trees, byte strings or files
+
+    Every method can be called from several threads at once with different documents: compiled selectors are
+    immutable, the state of each call is local to it, and lxml serializes the use of a shared parser or XPath query.
+    format is html, xml or auto, see xmlsrr.fileFormat, and backend is python or xpath.
+    """
+
+    def __init__(self, instructions, format='html', backend='python'):
+        """
+        instructions is a string with one instruction per line, or a list of instruction strings
+        """
+        if isinstance(instructions, str):
+            instructions = instructions.splitlines()
+        self.instructions = tuple(instructionSet.InstructionSet(line) for line in instructions if line.strip())
+        if not self.instructions:
+            raise ValueError("No instructions given")
+        if format not in xmlsrr.formatPatterns:
+            raise ValueError("Unknown format: {0}".format(format))
+        if backend not in ('python', 'xpath'):
+            raise ValueError("Unknown backend: {0}".format(backend))
+        self.format = format
+        self.backend = backend
+        if backend == 'xpath':
+            xpathSelector.compileInstructions(self.instructions)
+
+    def apply(self, tree):
+        """
+        Apply the instructions to an element or element tree in place, returning the number of matches of each one
+        """
+        element = tree.getroot() if isinstance(tree, etree._ElementTree) else tree
+        counts = [0] * len(self.instructions)
+        xmlsrr.processDocument(element, self.instructions, self.backend, counts)
+        return counts
+
+    def apply_bytes(self, data, name=''):
+        """
+        Apply the instructions to a serialized document, returning the new document or data itself if nothing changed
+
+        With the auto format, name decides how data is parsed.
+        """
+        documentFormat = xmlsrr.fileFormat(name, self.format)
+        result = {'matches': [0] * len(self.instructions), 'timings': None, 'changed': False}
+        output = xmlsrr.processTree(data, name or None, self.instructions, self.backend, result, documentFormat)
+        return data if output is None else output
+
+    def apply_iter(self, paths, **settings):
+        """
+        Apply the instructions to each file in paths in place, yielding the result of each one as they are processed
+
+        settings are passed on to xmlsrr.processFile, see it for the result of each file.
+        """
+        for path in paths:
+            yield xmlsrr.processFile(os.path.dirname(path), os.path.basename(path), self.instructions,
+                                     self.backend, format=self.format, **settings)
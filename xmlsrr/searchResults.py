@@ -0,0 +1,129 @@
+# coding=utf-8
+"""
+Write search matches as JSON Lines or CSV records while files are processed
+"""
+import contextlib
+import csv
+import json
+import multiprocessing
+import threading
+
+
+class ResultWriter:
+    """
+    Write a record for each search match as it is found, and count the matches of each file as its result comes in
+
+    With countOnly, no record is written per match, only the number of matches and matching files of each search
+    instruction once the run is done. Records can be written from another thread than the one adding results.
+    """
+
+    def __init__(self, stream, instructions, format='jsonl', countOnly=False):
+        self.stream = stream
+        self.format = format
+        self.countOnly = countOnly
+        self.searches = [index for index, instruction in enumerate(instructions) if instruction.mode == 'search']
+        self.sources = [instruction.source for instruction in instructions]
+        self.matches = [0] * len(instructions)
+        self.files = [0] * len(instructions)
+        self.lock = threading.Lock()
+        if format == 'csv':
+            self.writer = csv.writer(stream)
+            if countOnly:
+                self.writer.writerow(['instruction', 'matches', 'files'])
+            else:
+                self.writer.writerow(['file', 'instruction', 'path', 'line', 'tag', 'attributes'])
+
+    def add(self, name, matches):
+        """
+        Take the match counts of one file
+        """
+        for index in self.searches:
+            self.matches[index] += matches[index]
+            if matches[index]:
+                self.files[index] += 1
+
+    def writeHit(self, name, hit):
+        """
+        Write the record of a hit found in the file name
+        """
+        if self.countOnly:
+            return
+        record = dict(hit, file=name)
+        with self.lock:
+            if self.format == 'csv':
+                self.writer.writerow([record['file'], record['instruction'], record['path'], record['line'],
+                                      record['tag'], json.dumps(record['attributes'], sort_keys=True)])
+            else:
+                self.stream.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            if self.countOnly:
+                for index in self.searches:
+                    if self.format == 'csv':
+                        self.writer.writerow([self.sources[index], self.matches[index], self.files[index]])
+                    else:
+                        self.stream.write(json.dumps({'instruction': self.sources[index],
+                                                      'matches': self.matches[index], 'files': self.files[index]},
+                                                     sort_keys=True) + '\n')
+            self.stream.flush()
+
+
+class HitChunks:
+    """
+    Collect the hits found in a worker process and hand them to send in lists of at most size (name, hit) pairs
+
+    Called like ResultWriter.writeHit. Whatever is left once a file is done goes out with flush.
+    """
+
+    def __init__(self, send, size):
+        self.send = send
+        self.size = size
+        self.chunk = []
+
+    def __call__(self, name, hit):
+        self.chunk.append((name, hit))
+        if len(self.chunk) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            self.send(self.chunk)
+            self.chunk = []
+
+
+@contextlib.contextmanager
+def relayHits(writeHit, size):
+    """
+    Yield a queue of at most size chunks from HitChunks, whose hits are passed to writeHit by a thread as they come in
+
+    Workers wait while the queue is full, so hits never pile up faster than they are written. Once the block is done,
+    and the workers putting chunks on the queue have exited, the rest of the queue is written before returning.
+    """
+    hitQueue = multiprocessing.Queue(size)
+    errors = []
+
+    def relay():
+        for chunk in iter(hitQueue.get, None):
+            for name, hit in chunk:
+                if not errors:
+                    try:
+                        writeHit(name, hit)
+                    except BaseException as error:
+                        # Keep taking chunks so workers don't wait forever, the error is raised once they are done
+                        errors.append(error)
+
+    thread = threading.Thread(target=relay, name='xmlsrr-hits', daemon=True)
+    thread.start()
+    try:
+        yield hitQueue
+    finally:
+        hitQueue.put(None)
+        thread.join()
+        hitQueue.close()
+    if errors:
+        raise errors[0]
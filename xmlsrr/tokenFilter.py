@@ -0,0 +1,127 @@
+# coding=utf-8
+"""
+Skip parsing files that can't match any instruction, by looking for the text every match needs in the raw bytes
+
+Each part of a selector needs its element name, classes, ids and attributes to be written somewhere in the file, so a
+file missing any of them can't match that instruction. The filter may only ever let through files that turn out not to
+match: tokens that could be written differently in the file, through character references, entities, another encoding
+or whitespace normalization, aren't required, and HTML files with named references like &colon; are always parsed, and neither are elements the HTML parser adds by itself.
+"""
+import re
+
+# Elements the HTML parser adds to documents that don't contain them
+impliedElements = frozenset(['html', 'head', 'body', 'p'])
+# Tokens with these characters could be written as references, so they aren't required
+escapedCharacters = frozenset('&<>"\'')
+# HTML named references, apart from the ones giving one of escapedCharacters, can stand for any character
+namedReference = re.compile(rb'&(?!(?:amp|AMP|lt|LT|gt|GT|quot|QUOT|apos)[^0-9A-Za-z])[A-Za-z]')
+# Filters by instruction selectors and document format
+filters = {}
+
+
+def getFilter(instructions, documentFormat):
+    """
+    Get the filter of instructions for documents of documentFormat from compileFilter, compiling it only once
+    """
+    key = (tuple(instruction.selector for instruction in instructions), documentFormat)
+    if key not in filters:
+        filters[key] = compileFilter(instructions, documentFormat)
+    return filters[key]
+
+
+def compileFilter(instructions, documentFormat):
+    """
+    Get the tokens each instruction needs in a file, or None when an instruction could match any file
+
+    The filter is whether tokens are searched without case, as HTML names are, and a list with the requirements of each
+    instruction. A requirement is a tuple of tokens, one of which must be in the file.
+    """
+    html = documentFormat == 'html'
+    requirements = []
+    for instruction in instructions:
+        needed = []
+        link = instruction.selector
+        while link is not None:
+            for requirement in linkRequirements(link, html):
+                if requirement not in needed:
+                    needed.append(requirement)
+            link = link.subMatch
+        if not needed:
+            return None
+        requirements.append(needed)
+    return html, requirements
+
+
+def linkRequirements(link, html):
+    requirements = []
+    if link.elements:
+        # Elements match by local name in any namespace, the prefix of the selector may not be the one in the file
+        names = [name.split(':')[-1] for name in link.elements]
+        if not (html and any(name.lower() in impliedElements for name in names)):
+            addRequirement(requirements, names, html, '<' if html else '')
+    for name in link.classes:
+        addRequirement(requirements, [name], html)
+    if link.ids:
+        addRequirement(requirements, list(link.ids), html)
+    for name, value in link.attributes:
+        addRequirement(requirements, [name], html)
+        if value:
+            addRequirement(requirements, [value], html)
+    return requirements
+
+
+def addRequirement(requirements, alternatives, html, prefix=''):
+    """
+    Add a requirement for one of alternatives following prefix to requirements, unless one can't be found reliably
+    """
+    tokens = []
+    for alternative in alternatives:
+        if not alternative.isascii() or escapedCharacters.intersection(alternative):
+            return
+        parts = alternative.split()
+        if len(parts) != 1 and len(alternatives) != 1:
+            return
+        tokens.append([encodeToken(prefix + part, html) for part in parts])
+    if len(tokens) == 1:
+        # Whitespace in attribute values may be written as any other whitespace, each word is still needed
+        requirements.extend((token,) for token in tokens[0])
+    else:
+        requirements.append(tuple(parts[0] for parts in tokens))
+
+
+def encodeToken(text, html):
+    return (text.lower() if html else text).encode('ascii')
+
+
+def canMatch(data, compiled):
+    """
+    Check whether a document given as bytes or a memory map could match any instruction of a filter from getFilter
+    """
+    if compiled is None:
+        return True
+    html, requirements = compiled
+    if b'\0' in data[:4096]:
+        # UTF-16 and UTF-32 documents don't hold the tokens as they are encoded here
+        return True
+    if not html:
+        search = data.find
+    elif isinstance(data, bytes):
+        search = data.lower().find
+    else:
+        # Memory maps are searched in place rather than copied to change their case
+        def search(token):
+            match = re.search(re.escape(token), data, re.IGNORECASE)
+            return match.start() if match else -1
+    if search(b'&#') >= 0 or (not html and search(b'<!ENTITY') >= 0):
+        return True
+    if html and namedReference.search(data):
+        return True
+    found = {}
+    for needed in requirements:
+        for requirement in needed:
+            if not any(found[token] if token in found else found.setdefault(token, search(token) >= 0)
+                       for token in requirement):
+                break
+        else:
+            return True
+    return False
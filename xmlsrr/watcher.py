@@ -0,0 +1,262 @@
+# coding=utf-8
+"""
+Find the files created or changed in a folder as it changes, and report the progress of a watching run
+
+Changes come from inotify on Linux, or from rescanning the folder every few seconds anywhere else.
+"""
+import ctypes
+import ctypes.util
+import http.server
+import json
+import os
+import select
+import struct
+import threading
+import time
+
+# inotify event flags, see inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+watchMask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+eventHeader = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Watch every folder under targetFolder with inotify, files are reported once they are closed or moved in
+    """
+
+    def __init__(self, targetFolder):
+        self.targetFolder = targetFolder
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.descriptor = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.folders = {}
+        self.found = set()
+        self.addFolder('', report=False)
+
+    def addFolder(self, folder, report=True):
+        """
+        Watch folder and everything under it, if report is set the files already in it are reported as changed
+        """
+        folders = [folder]
+        while folders:
+            folder = folders.pop()
+            path = os.path.join(self.targetFolder, folder)
+            watch = self.libc.inotify_add_watch(self.descriptor, os.fsencode(path), watchMask)
+            if watch < 0:
+                # The folder was removed before it could be watched
+                continue
+            self.folders[watch] = folder
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        name = os.path.join(folder, entry.name)
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(name)
+                        elif report:
+                            self.found.add(name)
+            except FileNotFoundError:
+                continue
+
+    def changes(self, timeout):
+        """
+        Wait up to timeout seconds for files to change, returning the relative path of each changed file
+        """
+        if not self.found:
+            select.select([self.descriptor], [], [], timeout)
+        try:
+            data = os.read(self.descriptor, 1 << 16)
+        except BlockingIOError:
+            data = b''
+        offset = 0
+        while offset < len(data):
+            watch, mask, cookie, length = eventHeader.unpack_from(data, offset)
+            offset += eventHeader.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so everything may have changed
+                self.found.update(scanFiles(self.targetFolder))
+            elif mask & IN_IGNORED:
+                self.folders.pop(watch, None)
+            elif watch in self.folders:
+                path = os.path.join(self.folders[watch], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.addFolder(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self.found.add(path)
+        found, self.found = self.found, set()
+        return found
+
+    def close(self):
+        os.close(self.descriptor)
+
+
+class PollingWatcher:
+    """
+    Rescan targetFolder every interval seconds, reporting files whose size or mtime changed
+    """
+
+    def __init__(self, targetFolder, interval=1.0):
+        self.targetFolder = targetFolder
+        self.interval = interval
+        self.states = scanFiles(targetFolder)
+        self.lastScan = time.monotonic()
+
+    def changes(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            nextScan = self.lastScan + self.interval
+            if nextScan > deadline:
+                time.sleep(max(deadline - now, 0))
+                return set()
+            if nextScan > now:
+                time.sleep(nextScan - now)
+            states = scanFiles(self.targetFolder)
+            self.lastScan = time.monotonic()
+            found = {name for name, state in states.items() if self.states.get(name) != state}
+            self.states = states
+            if found or self.lastScan >= deadline:
+                return found
+
+    def close(self):
+        pass
+
+
+def scanFiles(targetFolder):
+    """
+    Get the size and mtime of every file under targetFolder by relative path
+    """
+    states = {}
+    folders = ['']
+    while folders:
+        folder = folders.pop()
+        try:
+            with os.scandir(os.path.join(targetFolder, folder)) as entries:
+                for entry in entries:
+                    name = os.path.join(folder, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(name)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        states[name] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            continue
+    return states
+
+
+def openWatcher(targetFolder, interval=1.0):
+    """
+    Watch targetFolder with inotify where it is available, or by polling it every interval seconds
+    """
+    try:
+        return InotifyWatcher(targetFolder)
+    except (OSError, AttributeError):
+        return PollingWatcher(targetFolder, interval)
+
+
+def collectChanges(watcher, delay, timeout=1.0):
+    """
+    Wait up to timeout seconds for a change, then keep collecting changes until none came for delay seconds
+
+    A burst of files written one after another is then processed as one batch, once it's over.
+    """
+    found = watcher.changes(timeout)
+    while found:
+        more = watcher.changes(delay)
+        if not more:
+            break
+        found.update(more)
+    return found
+
+
+class WatchStatus:
+    """
+    Progress of a watching run, updated by the run and read by the status server from another thread
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.queued = 0
+        self.processed = 0
+        self.errors = 0
+        self.filtered = 0
+        self.bytes = 0
+        self.batches = 0
+        self.batchFiles = 0
+        self.batchStarted = None
+        self.lastBatch = None
+
+    def startBatch(self):
+        with self.lock:
+            self.batchFiles = 0
+            self.batchStarted = time.monotonic()
+
+    def queue(self, fileList):
+        """
+        Yield each file of fileList, counting it as queued as soon as it is listed, so fileList can be a generator
+        """
+        for name in fileList:
+            with self.lock:
+                self.queued += 1
+                self.batchFiles += 1
+            yield name
+
+    def add(self, result):
+        with self.lock:
+            self.queued = max(self.queued - 1, 0)
+            if result['error']:
+                self.errors += 1
+            elif not result['skipped']:
+                self.processed += 1
+                self.filtered += result['filtered']
+                self.bytes += result['bytes']
+
+    def finishBatch(self):
+        with self.lock:
+            self.batches += 1
+            self.lastBatch = {'files': self.batchFiles, 'seconds': time.monotonic() - self.batchStarted}
+
+    def describe(self):
+        with self.lock:
+            uptime = time.monotonic() - self.started
+            return {'queued': self.queued, 'processed': self.processed, 'errors': self.errors,
+                    'filtered': self.filtered, 'bytes': self.bytes, 'batches': self.batches,
+                    'lastBatch': self.lastBatch, 'uptime': uptime,
+                    'files/s': self.processed / uptime if uptime else 0.0,
+                    'bytes/s': self.bytes / uptime if uptime else 0.0}
+
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = json.dumps(self.server.status.describe(), sort_keys=True).encode() + b'\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serveStatus(status, port):
+    """
+    Answer HTTP requests on localhost:port with the status as JSON from a background thread, returning the server
+
+    Port 0 picks a free port, see server.server_address. Call server.shutdown() to stop it.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+    server.status = status
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
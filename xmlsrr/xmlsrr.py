@@ -4,16 +4,58 @@
 Search, remove, and replace content in a set of XML documents
 """
 import argparse
+import collections
+import contextlib
+import fnmatch
+import functools
+import importlib
+import mmap
 import os
+import re
+import signal
 import sys
 import logging
-import shutil
-from lxml import html
-from lxml import etree
-import instructionSet
+import time
+try:
+    from . import instructionCache, instructionCheck, outputTree
+except ImportError:
+    # Run as a script from this folder rather than imported from the package
+    import instructionCache
+    import instructionCheck
+    import outputTree
 
 
-def argumentParser():
+class LazyModule:
+    """
+    Stand-in for a module that is only imported the first time one of its attributes is used
+
+    The module then replaces the stand-in under the same name in namespace, so only the first use goes through here.
+    """
+
+    def __init__(self, namespace, alias, name):
+        self.__dict__.update(lazyNamespace=namespace, lazyAlias=alias, lazyName=name)
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.lazyName)
+        self.lazyNamespace[self.lazyAlias] = module
+        return getattr(module, attribute)
+
+
+# Modules only needed to process documents, so verifying instructions doesn't pay for importing lxml
+localPrefix = __package__ + '.' if __package__ else ''
+concurrentFutures = LazyModule(globals(), 'concurrentFutures', 'concurrent.futures')
+cProfile = LazyModule(globals(), 'cProfile', 'cProfile')
+etree = LazyModule(globals(), 'etree', 'lxml.etree')
+html = LazyModule(globals(), 'html', 'lxml.html')
+manifest = LazyModule(globals(), 'manifest', localPrefix + 'manifest')
+profiling = LazyModule(globals(), 'profiling', localPrefix + 'profiling')
+searchResults = LazyModule(globals(), 'searchResults', localPrefix + 'searchResults')
+tokenFilter = LazyModule(globals(), 'tokenFilter', localPrefix + 'tokenFilter')
+watcher = LazyModule(globals(), 'watcher', localPrefix + 'watcher')
+xpathSelector = LazyModule(globals(), 'xpathSelector', localPrefix + 'xpathSelector')
+
+
+def argumentParser(arguments=None):
     logging.debug("Parsing provided arguments")
     #if arguments is None or arguments == '':
     #    raise ValueError('Must provide at least one argument')
@@ -23,39 +65,123 @@ def argumentParser():
     parser.add_argument('-i', '--instructions')
     parser.add_argument('-l', '--log')
     parser.add_argument('-o', '--output')
+    parser.add_argument('--force', action='store_true')
     parser.add_argument('-V', '--verify', action='store_true')
+    parser.add_argument('-b', '--backend', choices=['python', 'xpath'], default='python')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--include', action='append')
+    parser.add_argument('--exclude', action='append')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--manifest')
+    parser.add_argument('--assets', choices=['link', 'reflink', 'copy', 'skip'], default='link')
+    parser.add_argument('--durability', choices=['none', 'batch', 'each'], default='none')
+    parser.add_argument('--hardlinks', choices=['break', 'keep'], default='break')
+    parser.add_argument('-r', '--results', default='-')
+    parser.add_argument('--results-format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--count-only', action='store_true')
+    parser.add_argument('--stream', type=int, metavar='SIZE')
+    parser.add_argument('--mmap', type=int, metavar='SIZE')
+    parser.add_argument('--no-prefilter', action='store_true')
+    parser.add_argument('-f', '--format', choices=['html', 'xml', 'auto'], default='html')
+    parser.add_argument('--instruction-cache', metavar='FOLDER')
+    parser.add_argument('--timings', metavar='FILE')
+    parser.add_argument('--timings-format', choices=['json', 'csv'], default='json')
+    parser.add_argument('--profile', metavar='FILE')
+    parser.add_argument('--read-ahead', type=int, default=8, metavar='FILES')
+    parser.add_argument('--write-behind', type=int, default=8, metavar='FILES')
+    parser.add_argument('--watch', action='store_true')
+    parser.add_argument('--debounce', type=float, default=0.5, metavar='SECONDS')
+    parser.add_argument('--poll-interval', type=float, default=1.0, metavar='SECONDS')
+    parser.add_argument('--status-port', type=int, metavar='PORT')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-s', '--silent', action='store_true')
     group.add_argument('-v', '--verbose', action='count')
-    return parser.parse_args()
+    return parser.parse_args(arguments)
 
 
 def validateOptions(arguments):
     logging.debug("Validating option settings")
     options = {'verbosity': validateVerbosity(arguments.verbose, arguments.silent),
                'target': validateTarget(arguments.target, arguments.output)}
-    try:
-        options['output'] = validateOutput(arguments.output)
-    except NotADirectoryError:
-        options['output'] = None
+    options['output'] = validateOutput(arguments.output, arguments.force)
+    options['force'] = arguments.force
     try:
         options['instructionFile'] = validateInstructionFile(arguments.instructions)
     except ValueError:
         print("No instruction file provided, please provide search, remove, and replace instructions")
+        options['instructionFile'] = None
         options['instructionList'] = getInstructions()
     options['verify'] = arguments.verify
+    options['backend'] = arguments.backend
+    options['jobs'] = validateJobs(arguments.jobs)
+    options['format'] = arguments.format
+    options['include'] = arguments.include or formatPatterns[arguments.format]
+    options['exclude'] = arguments.exclude
+    options['incremental'] = arguments.incremental
+    options['manifest'] = arguments.manifest
+    options['assets'] = arguments.assets
+    options['durability'] = arguments.durability
+    options['hardlinks'] = arguments.hardlinks
+    options['results'] = arguments.results
+    options['resultsFormat'] = arguments.results_format
+    options['countOnly'] = arguments.count_only
+    options['stream'] = arguments.stream
+    options['mmap'] = arguments.mmap
+    options['prefilter'] = not arguments.no_prefilter
+    options['instructionCache'] = arguments.instruction_cache
+    options['timings'] = arguments.timings
+    options['timingsFormat'] = arguments.timings_format
+    options['profile'] = arguments.profile
+    options['readAhead'] = validateDepth(arguments.read_ahead)
+    options['writeBehind'] = validateDepth(arguments.write_behind)
+    if arguments.watch and arguments.output:
+        raise ValueError("Watched files are processed in place, --watch can't be used with --output")
+    options['watch'] = arguments.watch
+    options['debounce'] = arguments.debounce
+    options['pollInterval'] = arguments.poll_interval
+    options['statusPort'] = arguments.status_port
     return options
 
 
-def parseInstructions(instructionList):
+def parseInstructions(instructionList, cacheFolder=None):
     logging.debug("Parsing instructions")
-    instructions = []
-    for instruction in instructionList:
-        logging.debug("Instruction: {0}".format(instruction))
-        instructions.append(instructionSet.InstructionSet(instruction))
+    instructions = instructionCache.loadInstructions(instructionList, cacheFolder)
+    for instruction in instructions:
+        logging.debug("Instruction: {0}".format(instruction.source))
     return instructions
 
 
+def verifyInstructions(source, lines, backend='python'):
+    """
+    Check every instruction in lines at once, logging each problem found and the estimated cost of each instruction
+
+    Returns the exit status of the run, 1 if any instruction has an error.
+    """
+    logging.debug("Verifying instructions")
+    parsed, findings = instructionCheck.checkInstructions(lines)
+    logFindings(source, findings)
+    if any(finding['severity'] == 'error' for finding in findings):
+        return 1
+    logging.info('{0:>6}  {1:<14}  {2}'.format('cost', 'lookup', 'instruction'))
+    total = 0
+    for number, instruction in sorted(parsed.items()):
+        cost, strategy = instructionCheck.instructionCost(instruction)
+        total += cost
+        logging.info('{0:>6}  {1:<14}  {2}'.format(cost, strategy, instruction.source))
+    logging.info('{0:>6}  {1:<14}  {2} instructions'.format(total, 'total', len(parsed)))
+    if backend == 'xpath':
+        xpathSelector.compileInstructions(list(parsed.values()))
+    return 0
+
+
+def logFindings(source, findings):
+    for finding in findings:
+        if finding['severity'] == 'error':
+            logging.error(instructionCheck.formatFinding(source, finding))
+        else:
+            logging.warning(instructionCheck.formatFinding(source, finding))
+
+
 def validateInstructionFile(instructionFile):
     logging.debug("Validating instruction file exists")
     if instructionFile is None:
@@ -99,10 +225,25 @@ def validateTarget(targetFolder, outputFolder):
         raise NotADirectoryError
 
 
-def validateOutput(outputDirectory):
+def validateOutput(outputDirectory, force=False):
     logging.debug("Validating output folder: {0}".format(outputDirectory))
+    if outputDirectory is None:
+        return None
+    # The output is built next to the folder and moved in place at the end, so its parent has to be writable
+    parentDirectory = os.path.dirname(os.path.abspath(outputDirectory))
     if os.access(outputDirectory, os.F_OK):
-        if os.access(outputDirectory, os.W_OK):
+        if not os.path.isdir(outputDirectory):
+            raise NotADirectoryError
+        # The folder is replaced as a whole, anything in it that xmlsrr didn't write would be lost
+        if not force and not outputTree.isReplaceable(outputDirectory):
+            raise ValueError("Output folder {0} isn't empty and wasn't written by xmlsrr, use --force to replace "
+                             "it".format(outputDirectory))
+        if os.access(outputDirectory, os.W_OK) and os.access(parentDirectory, os.W_OK):
+            return outputDirectory
+        else:
+            raise PermissionError
+    elif os.access(parentDirectory, os.F_OK):
+        if os.access(parentDirectory, os.W_OK):
             return outputDirectory
         else:
             raise PermissionError
@@ -110,6 +251,23 @@ def validateOutput(outputDirectory):
         raise NotADirectoryError
 
 
+def validateJobs(jobs):
+    logging.debug("Validating number of jobs")
+    if jobs < 0:
+        raise ValueError("Number of jobs can't be negative")
+    elif jobs == 0:
+        return os.cpu_count() or 1
+    else:
+        return jobs
+
+
+def validateDepth(depth):
+    logging.debug("Validating queue depth")
+    if depth < 0:
+        raise ValueError("Queue depth can't be negative")
+    return depth
+
+
 def validateLog(logFile):
     logging.debug("Validating log file")
     if os.access(logFile, os.F_OK):
@@ -136,105 +294,671 @@ def validateInstructionsExist(instructionsList):
     return instructions
 
 
-def matchElement(element, instruction) -> bool:
-    elementMatch = True
-    if instruction.match['elements']:
-        if element.tag not in instruction.match['elements']:
-            elementMatch = False
-    return elementMatch
-
-
-def matchClass(element, instruction) -> bool:
-    classMatch = True
-    if instruction.match['classes']:
-        for name in instruction.match['classes']:
-            if classMatch:
-                classMatch = False
-                if element.get('class'):
-                    for eachClass in element.get('class').split(' '):
-                        if eachClass == name:
-                            classMatch = True
-    return classMatch
-
-
-def matchId(element, instruction) -> bool:
-    idMatch = True
-    if instruction.match['ids']:
-        if element.get('id') not in instruction.match['ids']:
-            idMatch = False
-    return idMatch
-
-
-def matchAttribute(element, instruction) -> bool:
-    attributeMatch = True
-    if instruction.match['attributes']:
-        for key, value in instruction.match['attributes'].items():
-            if attributeMatch:
-                attributeMatch = False
-                if value:
-                    if element.get(key) == value:
-                        attributeMatch = True
-                else:
-                    if element.get(key):
-                        attributeMatch = True
-    return attributeMatch
+def matchElement(element, selector) -> bool:
+    if not selector.elements or element.tag in selector.elements:
+        return True
+    if isinstance(element.tag, str) and element.tag[0] == '{':
+        # A plain name matches the local name in any namespace, prefix:name only the prefix of the document
+        localName, qualifiedName = elementNames(element)
+        return localName in selector.elements or qualifiedName in selector.elements
+    return False
+
+
+def elementNames(element):
+    """
+    Get the local name of an element and its name with the prefix used in the document
+    """
+    tag = element.tag
+    if not isinstance(tag, str) or tag[0] != '{':
+        return tag, tag
+    localName = tag.split('}', 1)[1]
+    if element.prefix:
+        return localName, element.prefix + ':' + localName
+    return localName, localName
+
+
+def matchClass(element, selector, classes=None) -> bool:
+    """
+    Check that an element has every class of selector, classes are the element's own if they were already split
+    """
+    if not selector.classes:
+        return True
+    if classes is None:
+        classList = element.get('class')
+        if not classList:
+            return False
+        classes = classList.split() if classList.isascii() else classTokens(classList)
+    return selector.classes.issubset(classes)
+
+
+# The encoding of an XML document as named by its declaration, which is at most declarationSize bytes into the file
+xmlDeclaration = re.compile(rb'(?:\xef\xbb\xbf)?<\?xml[^>]*?\sencoding\s*=\s*["\']([A-Za-z][A-Za-z0-9._-]*)["\']')
+declarationSize = 1024
+# Class names are separated by ASCII whitespace, str.split also splits on other Unicode spaces
+classSeparator = re.compile('[ \t\n\r\f]+')
+
+
+def classTokens(classList):
+    if not classList:
+        return []
+    if classList.isascii():
+        return classList.split()
+    return [name for name in classSeparator.split(classList) if name]
+
+
+def matchId(element, selector) -> bool:
+    return not selector.ids or element.get('id') in selector.ids
+
+
+def matchAttribute(element, selector) -> bool:
+    for key, value in selector.attributes:
+        if value:
+            if element.get(key) != value:
+                return False
+        elif not element.get(key):
+            return False
+    return True
+
+
+def matchAll(element, selector, classes=None) -> bool:
+    return matchElement(element, selector) \
+        and matchClass(element, selector, classes) \
+        and matchId(element, selector) \
+        and matchAttribute(element, selector)
 
 
 def processInstructions(element, instruction):
-    if matchElement(element, instruction) \
-        and matchClass(element, instruction) \
-        and matchId(element, instruction) \
-        and matchAttribute(element, instruction):
-        matchFound = True
-    else:
-        matchFound = False
-
-    if not matchFound and len(element) > 0:
-        [processInstructions(elem, instruction) for elem in element]
-    if matchFound and not instruction.match['subMatch']:
-        # Output we found a match
-        if instruction.mode == 'search':
-            # That's all we have to do for a search
-            pass
-        elif instruction.mode == 'remove':
-            element.getparent().remove(element)
-        elif instruction.mode == 'replace':
-            # Replace the element with the new element
-            newElement = element
-            if instruction.match['elements'] or instruction.replace['elements']:
-                newElement.tag = instruction.replace['elements'][0]
-            if instruction.match['classes'] or instruction.replace['classes']:
-                newElement.set('class', replaceClasses(newElement.get('class'), instruction))
-            if instruction.match['ids'] or instruction.replace['ids']:
-                newElement.set('id', instruction.replace['ids'][0])
-            if instruction.match['attributes'] or instruction.replace['attributes']:
-                for key, value in instruction.match['attributes'].items():
-                    if element.get(key):
-                        if value == '' or (value != '' and element.attrib[key] == value):
-                            element.attrib.pop(key)
-            if instruction.replace['attributes']:
-                for attribute in instruction.replace['attributes']:
-                    for key, value in attribute:
-                        element.set(key, value)
-
-            element.getparent().replace(element, newElement)
-
-    if matchFound and instruction.match['subMatch']:
-        [processInstructions(elem, instruction.match['subMatch']) for elem in element]
+    return processInstructionList(element, [instruction])
+
 
+def processInstructionList(element, instructions, backend='python', counts=None):
+    """
+    Apply every instruction to element and its descendants
+
+    Applying each instruction to the whole tree one after another gives the same result as evaluating them in order at
+    each node. Instructions that name an element, id or class on the last part of their selector only look at the
+    elements found through element.iter or an index of the document, see selectCandidates. Consecutive other
+    instructions are evaluated together in a single traversal, see walkInstructions. The xpath backend runs the queries
+    compiled by xpathSelector.compileInstructions one instruction at a time instead. If counts is given, the number of
+    matches of each instruction is added to the entry with the same index.
+    """
+    processDocument(element, instructions, backend, counts)
     return element
 
 
-def replaceClasses(classList, instruction):
-    classes = classList.split(" ")
-    if instruction.match['classes']:
-        for name in classes:
-            if name in instruction.match['classes']:
-                classes.remove(name)
-    if instruction.replace['classes']:
-        for name in instruction.replace['classes']:
-            if name not in classes:
-                classes.append(name)
+def processDocument(element, instructions, backend='python', counts=None, hits=None, timings=None) -> bool:
+    """
+    Apply every instruction like processInstructionList, returning whether the tree was changed
+
+    If hits is given, it is called with a description of each element matched by a search instruction. If timings is
+    given (see profiling.newTimings), the time spent finding and changing the elements of each instruction is added to
+    it, see timedWalk for instructions that share a walk. A remove instruction matching element itself while it has no
+    parent raises ValueError, the tree may already be changed by then.
+    """
+    if counts is None:
+        counts = [0] * len(instructions)
+    if backend == 'xpath':
+        return processEach(element, instructions, backend, counts, hits, timings)
+    changed = False
+    documentIndex = {}
+    pending = []
+    for index, instruction in enumerate(instructions):
+        link = lastLink(instruction)
+        if not isIndexed(link):
+            pending.append((index, instruction, instruction.selector))
+            continue
+        if pending:
+            if timedWalk(element, pending, counts, hits, timings):
+                changed = True
+                # There's no telling which ids and classes changed, the index is built again when it is needed
+                documentIndex.clear()
+            pending = []
+        if timings is not None:
+            start = time.perf_counter()
+        matches = selectCandidates(element, instruction, link, documentIndex)
+        if timings is not None:
+            selected = time.perf_counter()
+        changed = applyMatches(matches, index, instruction, link, counts, hits, documentIndex) or changed
+        if timings is not None:
+            addTimings(timings, index, start, selected)
+    if pending:
+        changed = timedWalk(element, pending, counts, hits, timings) or changed
+    return changed
+
+
+def timedWalk(element, pending, counts, hits, timings) -> bool:
+    """
+    Run walkInstructions, adding the time it took to timings if given
+
+    A walk finds and changes elements as it goes, so all of its time counts as matching, and each instruction of the
+    walk is given an even share of it.
+    """
+    if timings is None:
+        return walkInstructions(element, pending, counts, hits)
+    start = time.perf_counter()
+    changed = walkInstructions(element, pending, counts, hits)
+    elapsed = time.perf_counter() - start
+    timings['match'] += elapsed
+    for index, instruction, link in pending:
+        timings['instructions'][index] += elapsed / len(pending)
+    return changed
+
+
+def addTimings(timings, index, start, selected):
+    """
+    Add the time from start to selected as matching and from selected to now as changing, both for instruction index
+    """
+    finished = time.perf_counter()
+    timings['match'] += selected - start
+    timings['mutate'] += finished - selected
+    timings['instructions'][index] += finished - start
+
+
+def processEach(element, instructions, backend, counts, hits, timings):
+    """
+    Apply instructions one at a time, finding every element an instruction matches before changing any of them
+    """
+    changed = False
+    documentIndex = {}
+    depth = sum(1 for ancestor in element.iterancestors()) if backend == 'xpath' else 0
+    for index, instruction in enumerate(instructions):
+        if timings is not None:
+            start = time.perf_counter()
+        link = lastLink(instruction)
+        if backend == 'xpath':
+            matches = instruction.xpath(element, depth=depth)
+        else:
+            matches = selectCandidates(element, instruction, link, documentIndex)
+        if timings is None:
+            changed = applyMatches(matches, index, instruction, link, counts, hits, documentIndex) or changed
+            continue
+        selected = time.perf_counter()
+        changed = applyMatches(matches, index, instruction, link, counts, hits, documentIndex) or changed
+        addTimings(timings, index, start, selected)
+    return changed
+
+
+def applyMatches(matches, index, instruction, link, counts, hits, documentIndex) -> bool:
+    changed = False
+    counts[index] += len(matches)
+    for match in matches:
+        if hits is not None and instruction.mode == 'search':
+            hits(describeHit(match, instruction))
+        if applyInstruction(match, instruction, link):
+            changed = True
+            if instruction.mode == 'replace':
+                updateIndex(documentIndex, match)
+    return changed
+
+
+def lastLink(instruction):
+    link = instruction.selector
+    while link.subMatch:
+        link = link.subMatch
+    return link
+
+
+def isIndexed(link) -> bool:
+    """
+    Check whether the elements a selector link can match can be looked up instead of visiting every element
+    """
+    if link.elements:
+        # Prefixed names depend on the prefixes used in each document, they can't be looked up by tag
+        return not any(':' in name for name in link.elements)
+    return len(link.ids) == 1 or bool(link.classes)
+
+
+def selectCandidates(element, instruction, link, documentIndex):
+    """
+    Find the elements at or below element matched by an instruction
+
+    When the last link isIndexed, candidates come from element.iter for element names, otherwise from documentIndex,
+    which is filled in by indexDocument the first time it is needed. Any other link has every element as a candidate.
+    Each candidate is checked against the last link, then its ancestors against the rest of the chain, so the work grows
+    with the number of candidates rather than the size of the tree.
+    """
+    if not isIndexed(link):
+        candidates = element.iter()
+    elif link.elements:
+        candidates = element.iter(*['{*}' + name for name in link.elements])
+    else:
+        if not documentIndex:
+            indexDocument(element, documentIndex)
+        sortIndex(documentIndex)
+        if len(link.ids) == 1:
+            candidates = documentIndex['ids'].get(next(iter(link.ids)), [])
+        else:
+            classes = documentIndex['classes']
+            # Every class has to match, so the least common one gives the fewest candidates
+            candidates = classes.get(min(link.classes, key=lambda name: len(classes.get(name, ()))), [])
+    chain = []
+    selector = instruction.selector
+    while selector:
+        chain.append(selector)
+        selector = selector.subMatch
+    positions = {}
+    return [candidate for candidate in candidates
+            if matchAll(candidate, link) and entryPosition(element, candidate, chain, positions) == len(chain) - 1]
+
+
+def indexDocument(element, documentIndex):
+    """
+    Map each id and class to the elements at or below element that have it, in document order
+    """
+    ids = {}
+    classes = {}
+    order = {}
+    for position, descendant in enumerate(element.iter(etree.Element)):
+        order[descendant] = position
+        if descendant.get('id') is not None:
+            ids.setdefault(descendant.get('id'), []).append(descendant)
+        for name in classTokens(descendant.get('class')):
+            classes.setdefault(name, []).append(descendant)
+    documentIndex['ids'] = ids
+    documentIndex['classes'] = classes
+    documentIndex['order'] = order
+    # Sets of the elements under each key updateIndex added to, and the keys it left out of document order
+    documentIndex['members'] = {}
+    documentIndex['unsorted'] = set()
+
+
+def updateIndex(documentIndex, element):
+    """
+    Add an element that was replaced under its current id and classes
+
+    Replacing doesn't move elements, so the document order recorded by indexDocument still holds. Entries for the ids
+    and classes the element no longer has are left in place, candidates are matched again anyway. The element is added
+    at the end, sortIndex puts the entries back in document order before they are used.
+    """
+    if not documentIndex:
+        return
+    keys = [('ids', element.get('id'))] if element.get('id') is not None else []
+    keys.extend(('classes', name) for name in classTokens(element.get('class')))
+    for kind, key in keys:
+        elements = documentIndex[kind].setdefault(key, [])
+        members = documentIndex['members'].get((kind, key))
+        if members is None:
+            members = documentIndex['members'][kind, key] = set(elements)
+        if element not in members:
+            members.add(element)
+            elements.append(element)
+            documentIndex['unsorted'].add((kind, key))
+
+
+def sortIndex(documentIndex):
+    """
+    Put the entries updateIndex added to back in document order
+    """
+    for kind, key in documentIndex['unsorted']:
+        documentIndex[kind][key].sort(key=documentIndex['order'].__getitem__)
+    documentIndex['unsorted'].clear()
+
+
+def entryPosition(element, candidate, chain, positions):
+    """
+    Get the position in chain of the link a traversal from element would match candidate against
+
+    Like walkInstructions, the links are matched from the top down, each against the first element that matches it,
+    and a selector doesn't look below an element it has matched, in which case None is returned. None is also returned
+    for candidates that are no longer below element. positions remembers the position each ancestor passes on to its
+    children, so ancestors shared by several candidates are only matched once.
+    """
+    if candidate is element:
+        return 0
+    ancestors = []
+    ancestor = candidate.getparent()
+    while True:
+        if ancestor is None:
+            return None
+        if ancestor in positions:
+            position = positions[ancestor]
+            break
+        ancestors.append(ancestor)
+        if ancestor is element:
+            position = 0
+            break
+        ancestor = ancestor.getparent()
+    for ancestor in reversed(ancestors):
+        if position is not None and matchAll(ancestor, chain[position]):
+            position = None if position == len(chain) - 1 else position + 1
+        positions[ancestor] = position
+    return position
+
+
+def walkInstructions(element, pending, counts, hits) -> bool:
+    """
+    Match element and its descendants against pending instructions in document order, see matchPending
+
+    The tree is walked with a stack of child iterators rather than recursion, so any depth works. Removed elements are
+    only taken out once the walk is done, the tree doesn't change shape while it is iterated. Their descendants are
+    still matched against the instructions that came before the remove instruction, which would have seen them when
+    run one after another, but not against the later ones.
+    """
+    changed = False
+    removed = []
+    stack = [(iter((element,)), pending)]
+    while stack:
+        children, pending = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            continue
+        childPending, childChanged, childRemoved = matchPending(child, pending, counts, hits)
+        changed = changed or childChanged
+        if childRemoved:
+            removed.append(child)
+        if childPending and len(child):
+            stack.append((iter(child), childPending))
+    for child in removed:
+        child.getparent().remove(child)
+    return changed or bool(removed)
+
+
+def matchPending(element, pending, counts, hits):
+    """
+    Match an element against the instructions still pending from its ancestors and apply them in order
+
+    Each pending entry pairs the top level instruction (which decides the action) and its index with the part of its
+    descendant chain that still has to match at or below the element, in the order of the instructions. Returns the
+    entries pending for the children of the element, whether it was changed and whether a remove instruction matched
+    it. In that case, the caller removes it and the entries pending for its children only hold instructions that come
+    before the remove instruction, later ones never see the element or its descendants.
+    """
+    changed = False
+    childPending = []
+    # Split once for all the instructions, unless replacing the element changes its classes
+    classes = None
+    for index, instruction, link in pending:
+        if link.classes and classes is None:
+            classes = frozenset(classTokens(element.get('class')))
+        if not matchAll(element, link, classes):
+            childPending.append((index, instruction, link))
+        elif link.subMatch:
+            childPending.append((index, instruction, link.subMatch))
+        else:
+            counts[index] += 1
+            if hits is not None and instruction.mode == 'search':
+                hits(describeHit(element, instruction))
+            if instruction.mode == 'remove':
+                if element.getparent() is None:
+                    raise rootRemoved(instruction)
+                return childPending, changed, True
+            if applyInstruction(element, instruction, link):
+                changed = True
+                classes = None
+    return childPending, changed, False
+
+
+class NotStreamable(ValueError):
+    """
+    Raised by processStream before anything is matched or written when a document has to be processed as a whole tree
+    """
+
+
+def processStream(source, output, instructions, counts=None, hits=None) -> bool:
+    """
+    Apply every instruction to an XML document while it is parsed, writing the result to output as it goes
+
+    Matching only looks at an element and its ancestors, so each element is matched as soon as its start tag is parsed,
+    written out as its content comes in, and freed once it is complete. Memory stays bounded by the depth of the
+    document rather than its size. Since later siblings aren't known yet, the paths of hits always give the position
+    of each element. Returns whether the document was changed.
+
+    Documents whose DOCTYPE has an internal subset raise NotStreamable, since the subset can't be written back and the
+    entities it declares are only kept by the tree engine. Nothing is written to output before that. A remove
+    instruction matching the root element raises ValueError, like in processDocument. The output is written in the
+    encoding the XML declaration names, see declaredEncoding.
+    """
+    if counts is None:
+        counts = [0] * len(instructions)
+    changed = False
+    pendingStack = [[(index, instruction, instruction.selector) for index, instruction in enumerate(instructions)]]
+    contexts = []
+    paths = [('', {})]
+    removedElements = set()
+    removedDepth = 0
+    # Comments and processing instructions before the root wait for the DOCTYPE, which is only known with the root
+    prolog = []
+    finished = False
+    encoding = declaredEncoding(source)
+    with etree.xmlfile(output, encoding=encoding) as xf:
+        for event, element in etree.iterparse(source, events=('start', 'end', 'comment', 'pi'), huge_tree=True,
+                                              resolve_entities=False):
+            if prolog is not None and event != 'start':
+                prolog.append(element)
+                continue
+            if prolog is not None:
+                writeProlog(xf, element.getroottree(), prolog)
+                prolog = None
+            if finished:
+                # xmlfile refuses anything after the root element, so the epilog goes straight to output
+                xf.flush()
+                output.write(etree.tostring(element, encoding=encoding, xml_declaration=False, with_tail=False))
+                continue
+            if removedDepth and event == 'end':
+                removedDepth -= 1
+                pendingStack.pop()
+                paths.pop()
+                if not removedDepth:
+                    element.clear(keep_tail=True)
+                continue
+            if removedDepth and event != 'start':
+                continue
+            if event == 'start':
+                path, siblings = paths[-1]
+                name = elementNames(element)[1]
+                siblings[name] = siblings.get(name, 0) + 1
+                path = '{0}/{1}[{2}]'.format(path, name, siblings[name])
+                elementHits = []
+                childPending, elementChanged, removed = matchPending(element, pendingStack[-1], counts,
+                                                                     elementHits.append if hits is not None else None)
+                for hit in elementHits:
+                    hit['path'] = path
+                    hits(hit)
+                if removed or removedDepth:
+                    # Nothing in a removed element is written, but the instructions before the one that removed it
+                    # still match in it
+                    if not removedDepth:
+                        changed = True
+                        removedElements.add(element)
+                    removedDepth += 1
+                    pendingStack.append(childPending)
+                    paths.append((path, {}))
+                    continue
+                changed = changed or elementChanged
+                # Whatever comes in is inside the innermost open element, after the text preceding it. Removed
+                # elements don't open their parent, its text is written once something else comes in.
+                openElement(xf, contexts)
+                writePrecedingText(xf, element, removedElements, contexts)
+                # The start tag is only written once content comes in, so empty elements can be written as such
+                contexts.append([element, None])
+                pendingStack.append(childPending)
+                paths.append((path, {}))
+            elif event == 'end':
+                writeFinishedChildren(xf, element, removedElements, contexts)
+                if contexts[-1][1] is None and not element.nsmap:
+                    # Written on its own, an element would redeclare the namespaces in scope, so only elements
+                    # without any are written as empty elements
+                    xf.write(etree.Element(element.tag, dict(element.attrib)), with_tail=False)
+                else:
+                    openElement(xf, contexts)
+                    contexts[-1][1].__exit__(None, None, None)
+                contexts.pop()
+                pendingStack.pop()
+                paths.pop()
+                element.clear(keep_tail=True)
+                finished = not contexts
+            else:
+                openElement(xf, contexts)
+                writePrecedingText(xf, element, removedElements, contexts)
+                xf.write(element, with_tail=False)
+    return changed
+
+
+def writeProlog(xf, tree, prolog):
+    """
+    Write the XML declaration, the DOCTYPE and the comments and processing instructions before the root element
+    """
+    doctype = tree.docinfo.doctype
+    position = 0
+    if doctype:
+        # lxml doesn't describe every declaration an internal subset can hold, only the serialized DOCTYPE shows them.
+        # It also gives where the DOCTYPE goes among the nodes of the prolog.
+        position = etree.tostring(tree, encoding='utf-8').find(doctype.encode('utf-8') + b'\n')
+        if position < 0:
+            raise NotStreamable("The DOCTYPE has an internal subset")
+    if tree.docinfo.standalone is not None:
+        xf.write_declaration(standalone=tree.docinfo.standalone or None)
+    for node in prolog:
+        if doctype and position <= 0:
+            xf.write_doctype(doctype)
+            doctype = None
+        xf.write(node, with_tail=False)
+        position -= len(etree.tostring(node, encoding='utf-8', with_tail=False))
+    if doctype:
+        xf.write_doctype(doctype)
+
+
+def declaredEncoding(source) -> str:
+    """
+    Return the encoding named by the XML declaration of source, a path or a seekable file, or UTF-8 without one
+
+    Only declarations written in an ASCII compatible encoding are read, documents in UTF-16 or UTF-32 are streamed out
+    as UTF-8.
+    """
+    if hasattr(source, 'read'):
+        position = source.tell()
+        start = source.read(declarationSize)
+        source.seek(position)
+    else:
+        with open(source, 'rb') as f:
+            start = f.read(declarationSize)
+    declaration = xmlDeclaration.match(start)
+    return declaration.group(1).decode('ascii') if declaration else 'UTF-8'
+
+
+def openElement(xf, contexts):
+    """
+    Write the start tag of the innermost open element if it hasn't been written yet
+    """
+    if contexts and contexts[-1][1] is None:
+        element = contexts[-1][0]
+        contexts[-1][1] = xf.element(element.tag, dict(element.attrib), nsmap=newNamespaces(element))
+        contexts[-1][1].__enter__()
+
+
+def writePrecedingText(xf, element, removedElements, contexts):
+    """
+    Write the text between the start of the parent or the end of the previous sibling and element
+    """
+    parent = element.getparent()
+    if parent is not None:
+        writeFinishedChildren(xf, parent, removedElements, contexts, element)
+
+
+def writeFinishedChildren(xf, parent, removedElements, contexts, before=None):
+    """
+    Write the text of parent and what is left of its children before the child before, or all of them, then free them
+
+    Elements, comments and processing instructions were written as they were parsed, only their tails are left. Entity
+    references don't have events of their own and are written here. The start tag of parent is only written when
+    there is something to write, so elements whose children were all removed stay empty elements.
+    """
+    if parent.text:
+        openElement(xf, contexts)
+        xf.write(parent.text)
+        parent.text = None
+    while len(parent) and parent[0] is not before:
+        child = parent[0]
+        if child.tag is etree.Entity:
+            openElement(xf, contexts)
+            xf.write(child, with_tail=False)
+            if child.tail:
+                xf.write(child.tail)
+            parent.remove(child)
+        else:
+            writeFinishedSibling(xf, child, removedElements, contexts)
+
+
+def writeFinishedSibling(xf, sibling, removedElements, contexts):
+    # The sibling itself was already written, only its tail is left before it can be freed. The tail of a removed
+    # element goes with it, like when removing it from a parsed tree.
+    if sibling in removedElements:
+        removedElements.discard(sibling)
+    elif sibling.tail:
+        openElement(xf, contexts)
+        xf.write(sibling.tail)
+    sibling.getparent().remove(sibling)
+
+
+def describeHit(element, instruction):
+    return {'instruction': instruction.source, 'path': element.getroottree().getpath(element),
+            'line': element.sourceline, 'tag': element.tag, 'attributes': dict(element.attrib)}
+
+
+def rootRemoved(instruction):
+    # A document can't be left without a root, so the file is reported as an error rather than changed
+    return ValueError("Instruction {0} would remove the root element".format(instruction.source))
+
+
+def applyInstruction(element, instruction, link) -> bool:
+    """
+    Run the action of instruction on an element matched by link, the last part of its descendant chain
+
+    Returns True when the tree was changed, a replacement that leaves the element as it was doesn't count.
+    """
+    if instruction.mode == 'search':
+        # That's all we have to do for a search
+        return False
+    elif instruction.mode == 'remove':
+        if element.getparent() is None:
+            raise rootRemoved(instruction)
+        element.getparent().remove(element)
+        return True
+    elif instruction.mode == 'replace':
+        # Replace the element and its attributes, the contents stay the same
+        before = (element.tag, dict(element.attrib))
+        replacement = instruction.replacement
+        if replacement.element:
+            element.tag = replacementTag(element, replacement.element)
+        if link.classes or replacement.classes:
+            element.set('class', replaceClasses(element.get('class'), link, replacement))
+        if replacement.id:
+            element.set('id', replacement.id)
+        for key, value in link.attributes:
+            if element.get(key):
+                if value == '' or element.attrib[key] == value:
+                    element.attrib.pop(key)
+        for key, value in replacement.attributes:
+            element.set(key, value)
+        return before != (element.tag, dict(element.attrib))
+    return False
+
+
+def replacementTag(element, name):
+    """
+    Resolve the name of a replacement element, keeping the namespace of a namespaced element unless a prefix is given
+    """
+    if ':' in name:
+        prefix, localName = name.split(':', 1)
+        if prefix in element.nsmap:
+            return '{{{0}}}{1}'.format(element.nsmap[prefix], localName)
+        return name
+    if element.tag[0] == '{':
+        return element.tag.split('}', 1)[0] + '}' + name
+    return name
+
+
+def replaceClasses(classList, link, replacement):
+    """
+    Remove the classes matched by link and add the classes of the replacement, keeping the order of both
+    """
+    classes = [name for name in classTokens(classList) if name not in link.classes]
+    present = set(classes)
+    for name in replacement.classes:
+        if name not in present:
+            present.add(name)
+            classes.append(name)
     return ' '.join(classes)
 
 
@@ -255,54 +979,757 @@ def getInstructions():
     return instructionList
 
 
-def getFileList(targetFolder):
+def getFileList(targetFolder, include=None, exclude=None):
+    """
+    Yield the path of each file in targetFolder to process, relative to it, as soon as it is found
+
+    A file is listed when its name or relative path matches one of the include patterns (.htm and .html files by
+    default) and none of the exclude patterns. Excluded folders aren't scanned.
+    """
+    for name, _ in scanFolder(targetFolder, include, exclude):
+        yield name
+
+
+def scanFolder(targetFolder, include=None, exclude=None, assets=False):
+    """
+    Yield the relative path of each file in targetFolder along with whether it should be processed
+
+    Unless assets is set, only files to process are listed and excluded folders aren't scanned. Only the folders still
+    waiting to be scanned are kept in memory, never the files found so far.
+    """
     logging.debug("Loading files from folder")
-    fileList = []
-    # For all files in the target folder
-    for root, dirs, files in os.walk(targetFolder):
-        # For each file
-        for name in files:
-            # If the file has '.htm' in the name (covers .htm and .html)
-            if name.find('.htm') >= 0:
-                logging.debug("Found htm/l file: {0}".format(os.path.join(root, name)))
-                # Create the full targetFile path
-                targetFile = os.path.join(root, name)
-                # Remove the target directory prefix
-                targetFile = targetFile.split(targetFolder)[1]
-                # Append new file name to our list of files
-                fileList.append(targetFile)
+    if not include:
+        include = ['*.htm', '*.html']
+    if not exclude:
+        exclude = []
+    folders = [('', False)]
+    while folders:
+        folder, folderExcluded = folders.pop()
+        with os.scandir(os.path.join(targetFolder, folder)) as entries:
+            for entry in entries:
+                name = os.path.join(folder, entry.name)
+                excluded = folderExcluded or matchPatterns(entry.name, name, exclude)
+                if excluded and not assets:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append((name, excluded))
+                elif not excluded and entry.is_file() and matchPatterns(entry.name, name, include):
+                    logging.debug("Found file: {0}".format(name))
+                    yield name, True
+                elif assets:
+                    yield name, False
     logging.debug("Finished getting file list")
-    return fileList
 
 
-if __name__ == '__main__':
+def copyAssets(targetFolder, destinationFolder, scan, mode):
+    """
+    Pass on the files to process from scan and bring every other file into destinationFolder as they are found
+    """
+    for name, included in scan:
+        if included:
+            yield name
+        elif mode != 'skip':
+            logging.debug("Copying asset {0} ({1})".format(name, mode))
+            outputTree.copyAsset(targetFolder, destinationFolder, name, mode)
+
+
+def isIncluded(name, include, exclude) -> bool:
+    """
+    Check a relative path against the patterns like scanFolder does, so files in an excluded folder are excluded too
+    """
+    parts = name.split(os.sep)
+    for index in range(len(parts)):
+        if matchPatterns(parts[index], os.path.join(*parts[:index + 1]), exclude):
+            return False
+    return matchPatterns(parts[-1], name, include)
+
+
+def matchPatterns(fileName, relativePath, patterns) -> bool:
+    for pattern in patterns:
+        if fnmatch.fnmatch(fileName, pattern) or fnmatch.fnmatch(relativePath, pattern):
+            return True
+    return False
+
+
+workerState = {}
+# Parsers are built once per process and reused for every file
+parsers = {}
+# Mapped files are fed to the parser this many bytes at a time
+mapChunkSize = 1 << 20
+# Hits sent back by a worker process at a time, and chunks each worker can have waiting to be written
+hitChunkSize = 256
+hitQueueChunks = 4
+formatPatterns = {'html': ['*.htm', '*.html'], 'xml': ['*.xml'], 'auto': ['*.htm', '*.html', '*.xml']}
+
+
+def getParser(documentFormat):
+    if documentFormat not in parsers:
+        parsers[documentFormat] = newParser(documentFormat)
+    return parsers[documentFormat]
+
+
+def newParser(documentFormat):
+    if documentFormat == 'xml':
+        return etree.XMLParser(huge_tree=True, resolve_entities=False)
+    # Without huge_tree, libxml2 silently drops whatever is nested more than 255 levels deep
+    return html.HTMLParser(huge_tree=True)
+
+
+def isMapped(path, mapSize) -> bool:
+    return mapSize is not None and os.path.getsize(path) >= max(mapSize, 1)
+
+
+def parseMapped(path, documentFormat):
+    """
+    Parse a file by memory mapping it and feeding it to the parser in chunks of mapChunkSize bytes
+
+    The file is never read into a single bytes object, only one chunk is copied at a time and the kernel can drop the
+    pages already parsed. A parser of its own is used so a failed parse can't leave the shared one half fed.
+    """
+    parser = newParser(documentFormat)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        for offset in range(0, len(mapped), mapChunkSize):
+            parser.feed(mapped[offset:offset + mapChunkSize])
+    return parser.close()
+
+
+def fileFormat(name, documentFormat):
+    """
+    Pick the parser for a file, auto parses .htm and .html files as HTML and anything else as XML
+    """
+    if documentFormat != 'auto':
+        return documentFormat
+    if os.path.splitext(name)[1].lower() in ('.htm', '.html'):
+        return 'html'
+    return 'xml'
+
+
+def initWorker(instructions, settings, writeHit=None):
+    """
+    Keep the parsed instructions and run settings in this process so they are only sent to each worker once
+
+    When settings ask for hits, writeHit is what processFile passes them to.
+    """
+    if settings['backend'] == 'xpath':
+        # Compiled XPath queries can't be pickled, so every process compiles its own
+        xpathSelector.compileInstructions(instructions)
+    settings = dict(settings)
+    workerState['profile'] = settings.pop('profile', False)
+    settings['hits'] = writeHit if settings.get('hits') else None
+    workerState['instructions'] = instructions
+    workerState['settings'] = settings
+
+
+def processWorkerFile(targetFolder, name, previous=None):
+    try:
+        if not workerState['profile']:
+            return processFile(targetFolder, name, workerState['instructions'], previous=previous,
+                               **workerState['settings'])
+        # Profile statistics go back with the result, the parent adds them up
+        result, stats = profiling.profileCall(processFile, targetFolder, name, workerState['instructions'],
+                                              previous=previous, **workerState['settings'])
+        result['profile'] = stats
+        return result
+    finally:
+        if workerState.get('hitChunks'):
+            workerState['hitChunks'].flush()
+
+
+def newNamespaces(element):
+    parent = element.getparent()
+    inherited = parent.nsmap if parent is not None else {}
+    return {prefix: uri for prefix, uri in element.nsmap.items() if inherited.get(prefix) != uri}
+
+
+def processFile(targetFolder, name, instructions, backend='python', previous=None, destinationFolder=None,
+                previousFolder=None, record=False, assets='link', durability='none', hits=None, streamSize=None,
+                format='html', timings=False, data=None, mapSize=None, prefilter=False, hardlinks='break'):
+    """
+    Parse and process a single file, writing it back in place or to the same path in destinationFolder
+
+    Files are replaced atomically following the durability and hardlinks policies of outputTree.writeFile. Files that
+    no instruction changed aren't serialized or written, in destinationFolder they are linked or copied like other
+    assets. Files are parsed as HTML or XML following format, see fileFormat. XML files of at least streamSize bytes are
+    processed while they are read with processStream. Other files of at least mapSize bytes are memory mapped instead
+    of read, see parseMapped. data is the content of the file when it was already read, see readSource. With prefilter,
+    files that don't hold the text every match of an instruction needs aren't parsed at all, see tokenFilter.
+
+    When previous holds the recorded state of the file and the file still matches it, the file is skipped. With a
+    destinationFolder, the output of the previous run is then linked from previousFolder instead. If record is set, the
+    state of the file to compare against on the next run is returned. Nothing is logged here since this runs in worker
+    processes, the returned result is logged by the parent instead. If hits is given, it is called with name and a
+    description of each element matched by a search instruction as soon as it is found. If timings is set, the result
+    holds the time spent in each phase and on each instruction, see profiling.newTimings.
+    """
+    result, output, data = transformFile(targetFolder, name, instructions, backend, previous, destinationFolder,
+                                         previousFolder, record, durability, hits, streamSize, format, timings, data,
+                                         mapSize, prefilter, hardlinks)
+    finishFile(targetFolder, name, result, output, data, destinationFolder, record, assets, durability, hardlinks)
+    return result
+
+
+def transformFile(targetFolder, name, instructions, backend, previous, destinationFolder, previousFolder, record,
+                  durability, hits, streamSize, format, timings, data, mapSize=None, prefilter=False,
+                  hardlinks='break'):
+    """
+    First half of processFile, returning the result along with the new and the original content of the file
+
+    The new content is None when the file wasn't changed, or was written while it was streamed. The original content
+    is None when the file wasn't read into memory, because it was streamed or memory mapped.
+    """
+    result = {'name': name, 'matches': [0] * len(instructions), 'error': None, 'skipped': False, 'changed': False,
+              'filtered': False, 'bytes': 0, 'state': None,
+              'timings': profiling.newTimings(instructions) if timings else None}
+    if timings:
+        start = time.perf_counter()
+    path = os.path.join(targetFolder, name)
+    output = None
+    fileHits = functools.partial(hits, name) if hits else None
+    try:
+        if previous and manifest.isUnchanged(path, previous):
+            if not destinationFolder:
+                result['skipped'] = True
+            elif previousFolder and os.path.isfile(os.path.join(previousFolder, name)):
+                outputTree.copyAsset(previousFolder, destinationFolder, name)
+                result['skipped'] = True
+            if result['skipped']:
+                result['state'] = previous
+                return result, None, None
+        if record and destinationFolder:
+            # The source is what changes between runs when writing to another folder
+            result['state'] = manifest.fileState(path)
+        documentFormat = fileFormat(name, format)
+        streamed = isStreamed(path, documentFormat, streamSize)
+        if streamed:
+            data = None
+        elif data is None and not isMapped(path, mapSize):
+            if timings:
+                readStart = time.perf_counter()
+            with open(path, 'rb') as f:
+                data = f.read()
+            if timings:
+                result['timings']['parse'] += time.perf_counter() - readStart
+        if prefilter and not canMatch(path, data, instructions, documentFormat):
+            result['filtered'] = True
+        else:
+            if streamed:
+                outputPath = os.path.join(destinationFolder, name) if destinationFolder else path
+                if destinationFolder:
+                    os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+                streamed = streamFile(path, outputPath, instructions, result, durability, fileHits, hardlinks)
+            if not streamed:
+                # Files that couldn't be streamed are memory mapped like other large files
+                output = processTree(data, path, instructions, backend, result, documentFormat, fileHits)
+    except (OSError, ValueError, etree.LxmlError) as error:
+        result['error'] = str(error)
+        result['state'] = None
+        output = None
+    if timings:
+        result['timings']['total'] += time.perf_counter() - start
+    return result, output, data
+
+
+def finishFile(targetFolder, name, result, output, data, destinationFolder, record, assets, durability,
+               hardlinks='break'):
+    """
+    Second half of processFile, writing the new content of a file from transformFile and recording its state
+    """
+    if result['error'] or result['skipped']:
+        return result
+    timings = result['timings']
+    if timings is not None:
+        start = time.perf_counter()
+    path = os.path.join(targetFolder, name)
+    try:
+        if output is not None:
+            outputPath = os.path.join(destinationFolder, name) if destinationFolder else path
+            if destinationFolder:
+                os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+            outputTree.writeFile(outputPath, output, durability, hardlinks)
+            result['bytes'] = len(output)
+            if timings is not None:
+                timings['serialize'] += time.perf_counter() - start
+        elif not result['changed'] and destinationFolder:
+            # Bring the file over untouched to the destination
+            outputTree.copyAsset(targetFolder, destinationFolder, name, 'link' if assets == 'skip' else assets)
+        if record and not destinationFolder:
+            # Unchanged files still hold what was read, streamed files are hashed from disk
+            result['state'] = manifest.fileState(path, output if output is not None else data)
+    except (OSError, ValueError, etree.LxmlError) as error:
+        result['error'] = str(error)
+        result['state'] = None
+    if timings is not None:
+        timings['total'] += time.perf_counter() - start
+    return result
+
+
+def isStreamed(path, documentFormat, streamSize) -> bool:
+    return documentFormat == 'xml' and streamSize is not None and os.path.getsize(path) >= streamSize
+
+
+def canMatch(path, data, instructions, documentFormat) -> bool:
+    """
+    Check with tokenFilter whether a file could match any instruction, from data or else by memory mapping the file
+    """
+    compiled = tokenFilter.getFilter(instructions, documentFormat)
+    if compiled is None:
+        return True
+    if data is not None:
+        # Parsing empty files reports them as errors
+        return data == b'' or tokenFilter.canMatch(data, compiled)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return True
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return tokenFilter.canMatch(mapped, compiled)
+
+
+def readSource(targetFolder, name, previous=None, format='html', streamSize=None, mapSize=None):
+    """
+    Read a file ahead of processFile, or get None when it won't be parsed from memory
+
+    Files that are skipped as unchanged, streamed or memory mapped aren't read. Errors are left for processFile to
+    report when it reads the file again.
+    """
+    path = os.path.join(targetFolder, name)
+    try:
+        if previous and manifest.isUnchanged(path, previous):
+            return None
+        if isStreamed(path, fileFormat(name, format), streamSize) or isMapped(path, mapSize):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def processTree(data, path, instructions, backend, result, documentFormat='html', hits=None):
+    """
+    Parse a whole file from its content and process it, returning the new content or None if it wasn't changed
+
+    When data is None, the file at path is memory mapped instead. hits is passed on to processDocument.
+    """
+    timings = result['timings']
+    if timings is not None:
+        start = time.perf_counter()
+    if data is None:
+        element = parseMapped(path, documentFormat)
+    else:
+        # Parsing from memory keeps the disk out of this stage, path is only kept as the URL of the document
+        element = etree.fromstring(data, getParser(documentFormat), base_url=path)
+    if element is None:
+        raise ValueError("Document is empty")
+    if timings is not None:
+        timings['parse'] += time.perf_counter() - start
+    result['changed'] = processDocument(element, instructions, backend, result['matches'], hits, timings)
+    if not result['changed']:
+        return None
+    if timings is not None:
+        start = time.perf_counter()
+    if documentFormat == 'xml':
+        output = serializeTree(element.getroottree())
+    else:
+        output = etree.tostring(element)
+    if timings is not None:
+        timings['serialize'] += time.perf_counter() - start
+    return output
+
+
+def serializeTree(tree) -> bytes:
+    """
+    Serialize an XML document in the encoding it was read in, with its prolog and the nodes around the root element
+
+    The XML declaration is only written if the document had one. lxml doesn't tell a declaration without standalone
+    from standalone="no" apart, so both are written without it, which XML reads the same way.
+    """
+    standalone = tree.docinfo.standalone
+    return etree.tostring(tree, encoding=tree.docinfo.encoding, xml_declaration=standalone is not None,
+                          standalone=standalone or None)
+
+
+def streamFile(path, outputPath, instructions, result, durability, hits=None, hardlinks='break') -> bool:
+    """
+    Process a file while it is parsed, keeping the output only if it was changed
+
+    Returns False, without having matched or written anything, when the file has to be processed as a tree instead,
+    see processStream.
+    """
+    f, temporaryPath = outputTree.createTemporary(outputPath)
+    try:
+        result['changed'] = processStream(path, f, instructions, result['matches'], hits)
+        if result['changed']:
+            result['bytes'] = f.tell()
+            outputTree.commitTemporary(f, temporaryPath, outputPath, durability, hardlinks)
+        else:
+            outputTree.discardTemporary(f, temporaryPath)
+    except NotStreamable:
+        outputTree.discardTemporary(f, temporaryPath)
+        return False
+    except BaseException:
+        outputTree.discardTemporary(f, temporaryPath)
+        raise
+    return True
+
+
+def processFiles(targetFolder, fileList, instructions, options, fileManifest=None, destinationFolder=None,
+                 executor=None, writeHit=None):
+    """
+    Process every file in fileList, spread across options['jobs'] worker processes
+
+    Results are yielded in the order of fileList so they can be logged as if the files were processed one by one. Only
+    a few files per worker are queued at a time, so fileList can be a generator. Files recorded in fileManifest are
+    skipped when they haven't changed, and the manifest is updated with each result. With a destinationFolder, files
+    are written there instead of in place, and options['output'] holds the output of the previous run. executor is a
+    pool from newExecutor to reuse instead of starting worker processes for these files only.
+
+    With options['hits'], writeHit is called with the name of a file and each element matched by a search instruction
+    in it as soon as it is found, see processFile. Hits found by worker processes come back in chunks, see relayHits.
+    """
+    settings = fileSettings(options, fileManifest, destinationFolder)
+    depths = (options.get('readAhead', 0), options.get('writeBehind', 0))
+    for result in iterResults(targetFolder, fileList, instructions, options['jobs'], settings, fileManifest, depths,
+                              executor, writeHit):
+        if fileManifest:
+            fileManifest.update(result['name'], result['state'])
+        yield result
+
+
+def fileSettings(options, fileManifest=None, destinationFolder=None):
+    """
+    Get the arguments of processFile that are the same for every file of a run
+    """
+    return {'backend': options['backend'], 'destinationFolder': destinationFolder,
+            'previousFolder': options.get('output') if destinationFolder else None,
+            'record': fileManifest is not None, 'assets': options.get('assets', 'link'),
+            'durability': options.get('durability', 'none'), 'hardlinks': options.get('hardlinks', 'break'),
+            'hits': options.get('hits', False),
+            'streamSize': options.get('stream'), 'format': options.get('format', 'html'),
+            'timings': bool(options.get('timings')), 'mapSize': options.get('mmap'),
+            'prefilter': options.get('prefilter', False),
+            # A single process is profiled as a whole, workers profile each file they process
+            'profile': bool(options.get('profile')) and options['jobs'] > 1}
+
+
+def newExecutor(jobs, instructions, settings, hitQueue=None):
+    """
+    Start a pool of worker processes, which send the hits they find through hitQueue from relayHits
+    """
+    return concurrentFutures.ProcessPoolExecutor(jobs, initializer=startWorker,
+                                                 initargs=(instructions, settings, hitQueue))
+
+
+def startWorker(instructions, settings, hitQueue=None):
+    # Interrupting the run is left to the parent, which shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    workerState['hitChunks'] = searchResults.HitChunks(hitQueue.put, hitChunkSize) if hitQueue else None
+    initWorker(instructions, settings, workerState['hitChunks'])
+
+
+def relayHits(settings, writeHit, jobs):
+    """
+    Get a context giving the queue worker processes send their hits to writeHit through, or None without hits
+
+    Each worker can have a few chunks of hitChunkSize hits waiting to be written, see searchResults.relayHits. The
+    context has to outlive the workers, so it is entered before newExecutor.
+    """
+    if not settings.get('hits') or writeHit is None:
+        return contextlib.nullcontext()
+    return searchResults.relayHits(writeHit, jobs * hitQueueChunks)
+
+
+def iterResults(targetFolder, fileList, instructions, jobs, settings, fileManifest, depths=(0, 0), executor=None,
+                writeHit=None):
+    if jobs == 1:
+        initWorker(instructions, settings, writeHit)
+        if any(depths):
+            yield from iterPipeline(targetFolder, fileList, fileManifest, *depths)
+            return
+        for name in fileList:
+            yield processWorkerFile(targetFolder, name, fileManifest.lookup(name) if fileManifest else None)
+        return
+    if executor is None:
+        with relayHits(settings, writeHit, jobs) as hitQueue:
+            with newExecutor(jobs, instructions, settings, hitQueue) as executor:
+                yield from iterSubmitted(executor, targetFolder, fileList, jobs, fileManifest)
+        return
+    yield from iterSubmitted(executor, targetFolder, fileList, jobs, fileManifest)
+
+
+def iterSubmitted(executor, targetFolder, fileList, jobs, fileManifest):
+    pending = collections.deque()
+    for name in fileList:
+        pending.append(executor.submit(processWorkerFile, targetFolder, name,
+                                       fileManifest.lookup(name) if fileManifest else None))
+        if len(pending) >= jobs * 4:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iterPipeline(targetFolder, fileList, fileManifest, readAhead, writeBehind):
+    """
+    Process files in this process while a reader thread reads the next files and a writer thread writes the last ones
+
+    Up to readAhead files are read and writeBehind files are waiting to be written at a time, so memory stays bounded
+    however far the disk is behind. Parsing and matching stay in this thread, along with the manifest since SQLite
+    connections can't be shared between threads. Results are yielded in the order of fileList once files are written.
+    """
+    instructions = workerState['instructions']
+    settings = workerState['settings']
+    with concurrentFutures.ThreadPoolExecutor(1) as reader, concurrentFutures.ThreadPoolExecutor(1) as writer:
+        reads = collections.deque()
+        writes = collections.deque()
+        for name in fileList:
+            previous = fileManifest.lookup(name) if fileManifest else None
+            reads.append((name, previous, reader.submit(readSource, targetFolder, name, previous, settings['format'],
+                                                        settings['streamSize'], settings['mapSize'])))
+            if len(reads) > readAhead:
+                writes.append(submitFinish(writer, targetFolder, instructions, reads.popleft(), settings))
+            while len(writes) > writeBehind:
+                yield writes.popleft().result()
+        while reads:
+            writes.append(submitFinish(writer, targetFolder, instructions, reads.popleft(), settings))
+            while len(writes) > writeBehind:
+                yield writes.popleft().result()
+        while writes:
+            yield writes.popleft().result()
+
+
+def submitFinish(writer, targetFolder, instructions, read, settings):
+    """
+    Process a file that was read ahead and hand it to the writer thread
+    """
+    name, previous, data = read
+    result, output, data = transformFile(targetFolder, name, instructions, settings['backend'], previous,
+                                         settings['destinationFolder'], settings['previousFolder'], settings['record'],
+                                         settings['durability'], settings['hits'], settings['streamSize'],
+                                         settings['format'], settings['timings'], data.result(), settings['mapSize'],
+                                         settings['prefilter'], settings['hardlinks'])
+    return writer.submit(finishFile, targetFolder, name, result, output, data, settings['destinationFolder'],
+                         settings['record'], settings['assets'], settings['durability'], settings['hardlinks'])
+
+
+def watchFolder(targetFolder, instructions, options, fileManifest=None, resultWriter=None, stop=None):
+    """
+    Process every file in targetFolder, then the files created or changed in it until stop is set
+
+    Changes are collected until none came for options['debounce'] seconds and processed as one batch, see
+    watcher.collectChanges. Instructions are parsed once and worker processes keep running between batches. The state
+    of each file is recorded in fileManifest, or in a manifest kept in memory, so a file isn't processed again because
+    it was just written. With options['statusPort'], the progress of the run is served as JSON on localhost.
+    """
+    memoryManifest = None
+    if fileManifest is None:
+        fileManifest = memoryManifest = manifest.Manifest(':memory:', instructions, None)
+    include = options.get('include') or formatPatterns[options.get('format', 'html')]
+    exclude = options.get('exclude') or []
+    # Start watching before the first pass, so files changed while it runs aren't missed
+    folderWatcher = watcher.openWatcher(targetFolder, options.get('pollInterval', 1.0))
+    logging.info("Watching {0} with {1}".format(targetFolder, type(folderWatcher).__name__))
+    status = watcher.WatchStatus()
+    server = None
+    if options.get('statusPort') is not None:
+        server = watcher.serveStatus(status, options['statusPort'])
+        logging.info("Serving status on http://{0}:{1}/".format(*server.server_address))
+    writeHit = resultWriter.writeHit if resultWriter else None
+    workers = contextlib.ExitStack()
+    executor = None
+    if options['jobs'] > 1:
+        settings = fileSettings(options, fileManifest)
+        hitQueue = workers.enter_context(relayHits(settings, writeHit, options['jobs']))
+        executor = workers.enter_context(newExecutor(options['jobs'], instructions, settings, hitQueue))
+    try:
+        # The first pass goes through the folder as it is scanned, like a run without watching
+        fileList = getFileList(targetFolder, include, exclude)
+        while True:
+            status.startBatch()
+            for result in processFiles(targetFolder, status.queue(fileList), instructions, options, fileManifest,
+                                       executor=executor, writeHit=writeHit):
+                status.add(result)
+                if result['error']:
+                    logging.error("Unable to process file {0}: {1}".format(os.path.join(targetFolder, result['name']),
+                                                                            result['error']))
+                elif not result['skipped']:
+                    logging.debug("Processed file {0}: {1} matches".format(os.path.join(targetFolder, result['name']),
+                                                                           sum(result['matches'])))
+                    if resultWriter:
+                        resultWriter.add(result['name'], result['matches'])
+            status.finishBatch()
+            if options.get('durability') == 'batch':
+                # Workers only sync every few files, syncing the file system covers what they wrote since
+                outputTree.syncPending(targetFolder if options['jobs'] > 1 else None)
+            if resultWriter:
+                resultWriter.flush()
+            fileList = []
+            while not fileList:
+                if stop is not None and stop.is_set():
+                    return
+                changes = watcher.collectChanges(folderWatcher, options.get('debounce', 0.5))
+                fileList = sorted(name for name in changes if isIncluded(name, include, exclude)
+                                  and os.path.isfile(os.path.join(targetFolder, name)))
+    finally:
+        folderWatcher.close()
+        if server:
+            server.shutdown()
+            server.server_close()
+        # Workers are shut down before the hits they sent last are written
+        workers.close()
+        if memoryManifest:
+            memoryManifest.close()
+
+
+def main(arguments=None):
+    """
+    Run the command line with arguments, or the arguments of this process, returning the exit status
+    """
     # set up logging to file - see previous section for more details
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s  %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
     logging.debug("Starting script")
-    arguments = argumentParser()
+    arguments = argumentParser(arguments)
     options = validateOptions(arguments)
     if options['instructionFile']:
         with open(options['instructionFile']) as f:
             logging.debug("Reading instruction file: {0}".format(options['instructionFile']))
-            instructions = parseInstructions(f.readlines())
+            lines = f.readlines()
+        source = options['instructionFile']
     else:
-        instructions = parseInstructions(options['instructionList'])
+        lines = options['instructionList']
+        source = 'input'
     if options['verify']:
-        sys.exit(0)
+        validateInstructionsExist(lines)
+        return verifyInstructions(source, lines, options['backend'])
+    try:
+        instructions = parseInstructions(validateInstructionsExist(lines),
+                                         options['instructionCache'] if options['instructionFile'] else None)
+    except ValueError:
+        # Report every broken instruction rather than only the first one
+        findings = [finding for finding in instructionCheck.checkInstructions(lines)[1]
+                    if finding['severity'] == 'error']
+        if not findings:
+            raise
+        logFindings(source, findings)
+        return 1
+    targetFolder = options['target']
+    destinationFolder = None
+    fileList = getFileList(targetFolder, options['include'], options['exclude'])
     if options['output']:
-        logging.debug("Copying file tree in {0} to {1}".format(options['target'], options['output']))
-        shutil.copytree(options['target'], options['output'])
-        targetFolder = options['output']
-    else:
-        targetFolder = options['target']
-    fileList = getFileList(targetFolder)
-    for name in fileList:
-        logging.debug("Processing file: {0}".format(targetFolder + name))
-        element = html.parse(targetFolder + name).getroot()
-        for instruction in instructions:
-            processInstructions(element, instruction)
-        with open(targetFolder + name, 'wb') as f:
-            logging.debug("Writing file to {0}".format(targetFolder + name))
-            f.write(etree.tostring(element))
\ No newline at end of file
+        destinationFolder = outputTree.createStaging(options['output'], targetFolder)
+        logging.debug("Writing output for {0} to {1}".format(targetFolder, destinationFolder))
+        fileList = copyAssets(targetFolder, destinationFolder,
+                              scanFolder(targetFolder, options['include'], options['exclude'], assets=True),
+                              options['assets'])
+    fileManifest = None
+    if options['incremental']:
+        manifestPath = options['manifest'] or manifest.defaultPath(options['output'] or targetFolder)
+        logging.debug("Loading manifest: {0}".format(manifestPath))
+        # A separate output folder is replaced as a whole, so its manifest must only change along with it
+        fileManifest = manifest.Manifest(manifestPath, instructions, None if destinationFolder else 1000)
+    resultWriter = None
+    if any(instruction.mode == 'search' for instruction in instructions):
+        resultStream = sys.stdout if options['results'] == '-' else open(options['results'], 'w', newline='')
+        resultWriter = searchResults.ResultWriter(resultStream, instructions, options['resultsFormat'],
+                                                  options['countOnly'])
+        options['hits'] = not options['countOnly']
+    if options['watch']:
+        try:
+            watchFolder(targetFolder, instructions, options, fileManifest, resultWriter)
+        except KeyboardInterrupt:
+            logging.info("Stopped watching {0}".format(targetFolder))
+        finally:
+            if fileManifest:
+                fileManifest.close()
+            if resultWriter:
+                resultWriter.close()
+                if resultStream is not sys.stdout:
+                    resultStream.close()
+        return 0
+    timingReport = profiling.TimingReport(instructions) if options['timings'] else None
+    profileStats = None
+    profiler = None
+    if options['profile'] and options['jobs'] == 1:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    totals = [0] * len(instructions)
+    errors = 0
+    skipped = 0
+    filtered = 0
+    written = 0
+    startTime = time.monotonic()
+    try:
+        for result in processFiles(targetFolder, fileList, instructions, options, fileManifest, destinationFolder,
+                                   writeHit=resultWriter.writeHit if resultWriter else None):
+            if result.get('profile'):
+                profileStats = profiling.mergeStats(profileStats, result.pop('profile'))
+            if result['skipped']:
+                skipped += 1
+                logging.debug("Skipped unchanged file {0}".format(os.path.join(targetFolder, result['name'])))
+            elif result['error']:
+                errors += 1
+                logging.error("Unable to process file {0}: {1}".format(os.path.join(targetFolder, result['name']),
+                                                                        result['error']))
+                if destinationFolder:
+                    # Keep the output tree complete with the unprocessed file
+                    outputTree.copyAsset(targetFolder, destinationFolder, result['name'], 'copy')
+            else:
+                if result['filtered']:
+                    filtered += 1
+                    logging.debug("Filtered file {0}, it can't match any instruction".format(
+                        os.path.join(targetFolder, result['name'])))
+                else:
+                    logging.debug("Processed file {0}: {1} matches{2}".format(
+                        os.path.join(targetFolder, result['name']), sum(result['matches']),
+                        '' if result['changed'] else ', unchanged'))
+                totals = [total + count for total, count in zip(totals, result['matches'])]
+                written += result['bytes']
+                if resultWriter:
+                    resultWriter.add(result['name'], result['matches'])
+                if timingReport:
+                    timingReport.add(result['name'], result['timings'], result['matches'])
+        if destinationFolder:
+            logging.debug("Moving {0} to {1}".format(destinationFolder, options['output']))
+            outputTree.commitStaging(destinationFolder, options['output'], options['durability'], options['force'])
+        elif options['durability'] == 'batch':
+            # Workers sync every few files, what they wrote since then is only covered by syncing the file system
+            outputTree.syncPending(targetFolder if options['jobs'] > 1 else None)
+    except BaseException:
+        if fileManifest:
+            fileManifest.close(commit=not destinationFolder)
+        if destinationFolder:
+            logging.error("Run failed, removing partial output {0}".format(destinationFolder))
+            outputTree.discardStaging(destinationFolder)
+        raise
+    if resultWriter:
+        resultWriter.close()
+        if resultStream is not sys.stdout:
+            resultStream.close()
+    if profiler:
+        profiler.disable()
+        profiler.create_stats()
+        profileStats = profiling.mergeStats(profileStats, profiler.stats)
+    if profileStats:
+        logging.debug("Writing profile statistics to {0}".format(options['profile']))
+        profileStats.dump_stats(options['profile'])
+    if timingReport:
+        for line in timingReport.summary():
+            logging.info(line)
+        with open(options['timings'], 'w', newline='') as f:
+            timingReport.write(f, options['timingsFormat'])
+    elapsed = time.monotonic() - startTime
+    logging.info("Wrote {0} bytes in {1:.2f}s ({2:.0f} bytes/s)".format(written, elapsed,
+                                                                       written / elapsed if elapsed else 0))
+    if fileManifest:
+        fileManifest.close()
+        logging.info("Skipped {0} unchanged files".format(skipped))
+    if options['prefilter']:
+        logging.info("Skipped parsing {0} files that can't match any instruction".format(filtered))
+    for instruction, total in zip(instructions, totals):
+        logging.info("{0} matches for instruction {1}".format(total, instruction.source))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
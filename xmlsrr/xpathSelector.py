@@ -0,0 +1,101 @@
+# coding=utf-8
+"""
+Compile instruction selectors into precompiled lxml XPath queries
+"""
+import re
+from lxml import etree
+
+attributeName = re.compile(r'^[A-Za-z_][\w.-]*$')
+
+
+def compileInstructions(instructions):
+    for instruction in instructions:
+        instruction.xpath = compileSelector(instruction)
+    return instructions
+
+
+def compileSelector(instruction):
+    return SelectorQuery(selectorExpressions(instruction))
+
+
+class SelectorQuery:
+    """
+    Precompiled XPath queries for the links of an instruction's subMatch chain, called like a single etree.XPath
+
+    The first query finds the matches of the first link at or below the element it is called on, each following query
+    finds the matches of the next link below one match of the previous link. Matches of the same link are never nested,
+    so every element is looked at once per link and the matches stay in document order.
+    """
+
+    def __init__(self, expressions):
+        self.queries = [etree.XPath(expression) for expression in expressions]
+
+    def __call__(self, element, depth=0):
+        matches = self.queries[0](element, depth=depth)
+        for query in self.queries[1:]:
+            if not matches:
+                break
+            matches = [match for parent in matches
+                       for match in query(parent, depth=sum(1 for ancestor in parent.iterancestors()))]
+        return matches
+
+
+def selectorExpressions(instruction):
+    """
+    Build one XPath expression for each link of an instruction's subMatch chain, see SelectorQuery
+
+    The expressions select the same elements as the Python matcher: a selector stops matching below an element it has
+    already matched, so an element only matches the first link of the chain when no ancestor does, and each following
+    link only when no other element matches it between the element and the match of the previous link. Ancestors above
+    the element the first query is run on are ignored, the caller passes their number as $depth. The following queries
+    get the number of ancestors of the match of the previous link as $depth, so each expression only holds its own link.
+    Only the nearest ancestor matching a link needs its depth checked, the ones above it are even higher up.
+    """
+    link = instruction.selector
+    predicate = matchPredicate(link)
+    expressions = ['descendant-or-self::*[{0} and count(ancestor::*) >= $depth and '
+                   'not(ancestor::*[{0}][1][count(ancestor::*) >= $depth])]'.format(predicate)]
+    link = link.subMatch
+    while link:
+        expressions.append('descendant::*[{0} and not(ancestor::*[{0}][1][count(ancestor::*) > $depth])]'.format(
+            matchPredicate(link)))
+        link = link.subMatch
+    return expressions
+
+
+def matchPredicate(selector):
+    predicates = []
+    if selector.elements:
+        # Like the Python matcher, prefix:name is compared with the name in the document, a plain name with the local
+        # name in any namespace
+        predicates.append(anyOf(['{0}() = {1}'.format('name' if ':' in name else 'local-name', xpathLiteral(name))
+                                 for name in sorted(selector.elements)]))
+    for name in sorted(selector.classes):
+        # normalize-space turns every whitespace separating class names into a single space
+        predicates.append("contains(concat(' ', normalize-space(@class), ' '), {0})".format(
+            xpathLiteral(' ' + name + ' ')))
+    if selector.ids:
+        predicates.append(anyOf(['@id = {0}'.format(xpathLiteral(name)) for name in sorted(selector.ids)]))
+    for key, value in selector.attributes:
+        if not attributeName.match(key):
+            raise ValueError("Attribute {0} cannot be compiled to XPath".format(key))
+        if value:
+            predicates.append('@{0} = {1}'.format(key, xpathLiteral(value)))
+        else:
+            predicates.append("@{0} != ''".format(key))
+    if not predicates:
+        return 'true()'
+    return ' and '.join(predicates)
+
+
+def anyOf(predicates):
+    return '(' + ' or '.join(predicates) + ')'
+
+
+def xpathLiteral(value):
+    if "'" not in value:
+        return "'" + value + "'"
+    if '"' not in value:
+        return '"' + value + '"'
+    # XPath 1.0 has no escapes, split around single quotes instead
+    return 'concat(' + ", \"'\", ".join("'" + part + "'" for part in value.split("'")) + ')'